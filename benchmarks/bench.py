@@ -0,0 +1,245 @@
+'''
+Offline benchmark of the extraction and persistence hot paths.
+
+Runs Stock.get_prices_av, the AlphaVantage payload parser, DBWrapper.executeWriteQuery,
+Stock.get_list_stock_prices and Earnings.get_earnings_features_ticker against
+deterministic fake API clients and a local SQLite stand-in for MySQL. Reports rows/sec,
+per-call latency percentiles and peak traced memory per stage, and saves them as JSON so
+runs can be compared between commits:
+
+    python benchmarks/bench.py --tickers 500 --output bench_results.json
+    python benchmarks/bench.py --tickers 50 --compare bench_results.json
+'''
+
+import argparse
+import datetime as dt
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ST_HOME = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, os.path.join(ST_HOME, 'data_extraction'))
+sys.path.insert(0, ST_HOME)
+
+# The benchmark never calls the real APIs, so neither credentials nor the API clients are needed
+sys.modules.setdefault('auth', types.ModuleType('auth'))
+import fakes
+yec_module = types.ModuleType('yahoo_earnings_calendar')
+yec_module.YahooEarningsCalendar = fakes.FakeEarningsCalendar
+sys.modules['yahoo_earnings_calendar'] = yec_module
+av_module = types.ModuleType('alpha_vantage')
+av_module.timeseries = types.ModuleType('alpha_vantage.timeseries')
+av_module.timeseries.TimeSeries = fakes.FakeTimeSeries
+sys.modules['alpha_vantage'] = av_module
+sys.modules['alpha_vantage.timeseries'] = av_module.timeseries
+
+from extract_prices import Stock
+from extract_earnings import Earnings
+from av_parser import parse_av_payload, to_frame
+from libs.st_logger.logger import logger
+
+
+def percentiles(latencies):
+    if not latencies:
+        return {}
+    ms = np.asarray(latencies) * 1000
+    return {'p50': round(float(np.percentile(ms, 50)), 3),
+            'p90': round(float(np.percentile(ms, 90)), 3),
+            'p99': round(float(np.percentile(ms, 99)), 3),
+            'max': round(float(ms.max()), 3)}
+
+
+class Stage(object):
+    '''Times calls of one benchmark stage and traces its peak memory'''
+
+    def __init__(self, name, trace_memory=True):
+        self.name = name
+        self.trace_memory = trace_memory
+        self.latencies = []
+        self.rows = 0
+
+
+    def __enter__(self):
+        if self.trace_memory:
+            tracemalloc.start()
+        self.t_start = time.perf_counter()
+        return self
+
+
+    def __exit__(self, *exc):
+        self.wall_sec = time.perf_counter() - self.t_start
+        self.peak_mem_mb = None
+        if self.trace_memory:
+            self.peak_mem_mb = round(tracemalloc.get_traced_memory()[1] / 1024**2, 2)
+            tracemalloc.stop()
+
+
+    def call(self, fn, *args):
+        '''Time one call, fn returns the number of rows processed'''
+        t_start = time.perf_counter()
+        rows = fn(*args)
+        self.latencies.append(time.perf_counter() - t_start)
+        self.rows += rows
+        return rows
+
+
+    def result(self):
+        busy = sum(self.latencies) if self.latencies else self.wall_sec
+        return {'calls': len(self.latencies), 'rows': self.rows,
+                'wall_sec': round(self.wall_sec, 4),
+                'rows_per_sec': round(self.rows / busy, 1) if busy > 0 else None,
+                'latency_ms': percentiles(self.latencies),
+                'peak_mem_mb': self.peak_mem_mb}
+
+
+def make_stock(price_type, st_db=None, write_db=False):
+    return Stock(tickers_list=[], stock_index='NASDAQ', price_type=price_type,
+                 ts=fakes.FakeTimeSeries(), after_hours=False, write_db=write_db,
+                 st_db=st_db, st_logger=logger('Bench'), calls_per_min=10**9,
+                 db_batch_size=fakes.SQLITE_BATCH_SIZE)
+
+
+def bench_prices(tickers, price_type, trace_memory):
+    results = {}
+    stock = make_stock(price_type)
+    stock._check_start_date_format()
+    ts = fakes.FakeTimeSeries()
+    fetch = ts.get_intraday if price_type == 'intraday' else ts.get_daily
+
+    def parse(ticker):
+        price, _ = fetch(ticker, outputsize='full')
+        t_start = time.perf_counter()
+        arrays = parse_av_payload(price, start=stock.start_date,
+                                  session_only=price_type == 'intraday')
+        frame = to_frame(ticker, arrays)
+        return time.perf_counter() - t_start, frame.shape[0]
+
+    with Stage('parse[{}]'.format(price_type), trace_memory) as stage:
+        for ticker in tickers:
+            # Payload generation stands in for the network and is excluded
+            latency, rows = parse(ticker)
+            stage.latencies.append(latency)
+            stage.rows += rows
+    results[stage.name] = stage.result()
+
+    with Stage('get_prices_av[{}]'.format(price_type), trace_memory) as stage:
+        for ticker in tickers:
+            stage.call(lambda t: stock.get_prices_av(t).shape[0], ticker)
+    results[stage.name] = stage.result()
+    return results
+
+
+def bench_write(tickers, price_type, db_path, trace_memory):
+    st_db = fakes.SQLiteDBWrapper(db_path)
+    stock = make_stock(price_type)
+    stock._check_start_date_format()
+    frames = [stock.get_prices_av(ticker) for ticker in tickers]
+    table = '{}_prices'.format(price_type)
+    if price_type == 'intraday':
+        frames = [frame.rename_axis(['ticker', 'ts']) for frame in frames]
+    with Stage('executeWriteQuery[{}]'.format(table), trace_memory) as stage:
+        for frame in frames:
+            stage.call(lambda f: st_db.executeWriteQuery(f, table, index=True,
+                                                         batch_size=fakes.SQLITE_BATCH_SIZE)['rows'],
+                       frame)
+    st_db.close()
+    return {stage.name: stage.result()}
+
+
+def bench_pipeline(tickers, price_type, db_path, trace_memory):
+    st_db = fakes.SQLiteDBWrapper(db_path)
+    stock = make_stock(price_type, st_db=st_db, write_db=True)
+    stock.tickers_list = list(tickers)
+    table = '{}_prices'.format(price_type)
+    with Stage('get_list_stock_prices[{}]'.format(price_type), trace_memory) as stage:
+        stock.get_list_stock_prices()
+    stage.rows = int(st_db.executeReadQuery('SELECT COUNT(*) AS n FROM {}'.format(table))['n'][0])
+    st_db.close()
+    return {stage.name: stage.result()}
+
+
+def bench_earnings(tickers, trace_memory):
+    earnings = Earnings(st_db=None, st_logger=logger('Bench'), historical_earnings=True)
+    with Stage('get_earnings_features_ticker', trace_memory) as stage:
+        for ticker in tickers:
+            stage.call(lambda t: earnings.get_earnings_features_ticker(t).shape[0], ticker)
+    return {stage.name: stage.result()}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ST_HOME,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print('\n{:<40} {:>14} {:>14} {:>8}'.format('stage', 'rows/sec base', 'rows/sec now', 'ratio'))
+    for name, res in results['stages'].items():
+        base = baseline['stages'].get(name, {}).get('rows_per_sec')
+        now = res['rows_per_sec']
+        ratio = '{:.2f}x'.format(now / base) if base and now else '-'
+        print('{:<40} {:>14} {:>14} {:>8}'.format(name, str(base), str(now), ratio))
+
+
+def parse_bench_args():
+    parser = argparse.ArgumentParser(description='Offline benchmark of extraction hot paths.')
+    parser.add_argument('--tickers', type=int, default=500,
+        help='Number of fake tickers.')
+    parser.add_argument('--stages', nargs='+', default=['prices', 'write', 'pipeline', 'earnings'],
+        help='Stages to run - "prices", "write", "pipeline" and/or "earnings".')
+    parser.add_argument('--no-trace-memory', action='store_true', default=False,
+        help='Skip tracing peak memory, which slows down allocation heavy stages.')
+    parser.add_argument('--output', type=str, default='bench_results.json',
+        help='Path of the JSON results file.')
+    parser.add_argument('--compare', type=str, default=None,
+        help='Path of a previous JSON results file to compare rows/sec against.')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_bench_args()
+    # Per ticker info logs would dominate the timings
+    logging.disable(logging.INFO)
+    tickers = ['T{:03d}'.format(i) for i in range(args.tickers)]
+    trace_memory = not args.no_trace_memory
+    stages = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for price_type in ['intraday', 'daily']:
+            if 'prices' in args.stages:
+                stages.update(bench_prices(tickers, price_type, trace_memory))
+            if 'write' in args.stages:
+                stages.update(bench_write(tickers, price_type,
+                                          os.path.join(tmp_dir, 'write.db'), trace_memory))
+            if 'pipeline' in args.stages:
+                stages.update(bench_pipeline(tickers, price_type,
+                                             os.path.join(tmp_dir, 'pipeline.db'), trace_memory))
+        if 'earnings' in args.stages:
+            stages.update(bench_earnings(tickers, trace_memory))
+
+    results = {'commit': git_commit(), 'created': dt.datetime.now().isoformat(),
+               'tickers': args.tickers, 'python': sys.version.split()[0],
+               'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+               'stages': stages}
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    for name, res in stages.items():
+        print('{:<40} {:>10} rows {:>12} rows/sec  p50 {} ms  p99 {} ms  peak {} MB'.format(
+            name, res['rows'], str(res['rows_per_sec']), res['latency_ms'].get('p50'),
+            res['latency_ms'].get('p99'), res['peak_mem_mb']))
+    print('Saved results to {}'.format(args.output))
+    if args.compare:
+        compare(results, args.compare)
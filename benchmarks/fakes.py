@@ -0,0 +1,134 @@
+'''
+Deterministic offline stand-ins for the AlphaVantage and Yahoo earnings clients and for
+MySQL, so the extraction and persistence hot paths can be benchmarked without network
+or a database server.
+'''
+
+import datetime as dt
+import sqlite3
+import zlib
+
+import numpy as np
+
+from libs.PyDB.DBWrapper import DBWrapper
+from libs.PyDB.backends import EmbeddedBackend
+
+
+INTRADAY_DAYS = 30 # calendar days of 15 minute bars per intraday payload
+DAILY_YEARS = 25 # years of daily bars per daily payload
+COMPACT_SIZE = 100 # bars returned with outputsize='compact'
+
+SQLITE_BATCH_SIZE = 4000 # keeps multi-row upserts under SQLite's 32766 bound parameters
+
+
+def _seed(*keys):
+    return zlib.crc32('|'.join(str(k) for k in keys).encode('utf-8'))
+
+
+def _bars(seed, ts_strings):
+    '''Random walk OHLCV bars as AlphaVantage string-valued dicts, latest first'''
+    rng = np.random.default_rng(seed)
+    n = len(ts_strings)
+    close = 50 + np.abs(np.cumsum(rng.normal(0, 0.5, n)))
+    open_ = close + rng.normal(0, 0.2, n)
+    high = np.maximum(open_, close) + np.abs(rng.normal(0, 0.2, n))
+    low = np.minimum(open_, close) - np.abs(rng.normal(0, 0.2, n))
+    volume = rng.integers(1000, 5000000, n)
+    return {ts: {'1. open': '%.4f' % o, '2. high': '%.4f' % h, '3. low': '%.4f' % l,
+                 '4. close': '%.4f' % c, '5. volume': '%d' % v}
+            for ts, o, h, l, c, v in zip(ts_strings[::-1], open_, high, low, close, volume)}
+
+
+class FakeTimeSeries(object):
+    '''Stand-in for alpha_vantage.timeseries.TimeSeries with realistic payload sizes
+
+    Intraday payloads hold INTRADAY_DAYS of 15 minute bars from 4:00 to 20:00 on
+    weekdays, daily payloads DAILY_YEARS of weekday bars, both ending on `end`.
+    '''
+
+    def __init__(self, end=dt.date(2026, 10, 16)):
+        self.end = end
+
+
+    def _weekdays(self, n_days):
+        days = np.arange(np.datetime64(self.end) - np.timedelta64(n_days, 'D'),
+                         np.datetime64(self.end) + np.timedelta64(1, 'D'))
+        return days[np.is_busday(days)]
+
+
+    def get_intraday(self, symbol, interval='15min', outputsize='compact'):
+        days = self._weekdays(INTRADAY_DAYS)
+        offsets = np.arange(4*60, 20*60 + 1, 15).astype('timedelta64[m]')
+        ts = (days.astype('datetime64[m]')[:, None] + offsets[None, :]).ravel()
+        ts_strings = np.datetime_as_string(ts, unit='s').astype(object)
+        ts_strings = [t.replace('T', ' ') for t in ts_strings]
+        if outputsize == 'compact':
+            ts_strings = ts_strings[-COMPACT_SIZE:]
+        return _bars(_seed(symbol, 'intraday'), ts_strings), {'2. Symbol': symbol}
+
+
+    def get_daily(self, symbol, outputsize='compact'):
+        days = self._weekdays(int(DAILY_YEARS * 365.25))
+        ts_strings = list(np.datetime_as_string(days, unit='D'))
+        if outputsize == 'compact':
+            ts_strings = ts_strings[-COMPACT_SIZE:]
+        return _bars(_seed(symbol, 'daily'), ts_strings), {'2. Symbol': symbol}
+
+
+class FakeEarningsCalendar(object):
+    '''Stand-in for yahoo_earnings_calendar.YahooEarningsCalendar, 25 years of quarters'''
+
+    def __init__(self, end=dt.datetime(2026, 10, 16)):
+        self.end = end
+
+
+    def get_earnings_of(self, symbol):
+        rng = np.random.default_rng(_seed(symbol, 'earnings'))
+        records = []
+        for q in range(100):
+            earnings_dt = self.end - dt.timedelta(days=91*q + int(rng.integers(0, 10)))
+            estimate = round(float(rng.uniform(0.1, 2.0)), 2)
+            actual = round(estimate + float(rng.normal(0, 0.1)), 2)
+            records.append({
+                'ticker': symbol, 'companyshortname': symbol + ' Inc',
+                'startdatetime': earnings_dt.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                'startdatetimetype': 'AMC', 'epsestimate': estimate,
+                'epsactual': actual if q > 0 else None,
+                'epssurprisepct': round(100 * (actual - estimate) / abs(estimate), 2) if q > 0 else None,
+                'timeZoneShortName': 'EDT', 'gmtOffsetMilliSeconds': -14400000,
+                'quoteType': 'EQUITY'})
+        return records
+
+
+SQLITE_TABLES = [
+    '''create table if not exists daily_prices (ticker varchar(8) not null, dt date not null,
+       open float, high float, low float, close float, volume int, primary key (ticker, dt))''',
+    '''create table if not exists intraday_prices (ticker varchar(8) not null, ts timestamp not null,
+       open float, high float, low float, close float, volume int, primary key (ticker, ts))''',
+    '''create table if not exists earnings (ticker varchar(8) not null, ds date not null,
+       company_name varchar(64), earnings_dt timestamp, datetime_type varchar(12),
+       eps_estimate float, eps_actual float, eps_surprise_pct float, time_zone varchar(6),
+       gmt_offset_ms float, quote_type varchar(32), primary key (ticker, ds))''',
+    '''create table if not exists tickers (ticker varchar(8) not null, company varchar(64),
+       stock_index varchar(64) not null, created_at timestamp default current_timestamp,
+       primary key (ticker, stock_index))''',
+    '''create table if not exists ticker_membership (ticker varchar(8) not null,
+       stock_index varchar(64) not null, valid_from date not null, valid_to date,
+       company varchar(64), primary key (ticker, stock_index, valid_from))''',
+    '''create table if not exists row_hashes (table_name varchar(64) not null,
+       row_key varchar(64) not null, row_hash bigint not null, row_dt date,
+       primary key (table_name, row_key))''',
+]
+
+class SQLiteDBWrapper(DBWrapper):
+    '''DBWrapper writing to a local SQLite file instead of MySQL, through the embedded backend'''
+
+    def __init__(self, path):
+        super(SQLiteDBWrapper, self).__init__('SMART_TRADING',
+                                              backend=EmbeddedBackend(path, engine='sqlite'))
+        self.path = path
+        con = sqlite3.connect(path)
+        for ddl in SQLITE_TABLES:
+            con.execute(ddl)
+        con.commit()
+        con.close()
@@ -1,4 +1,5 @@
 from argparse import ArgumentParser
+from constants import DB_BATCH_SIZE, AV_CALLS_PER_MIN, EARNINGS_CALLS_PER_MIN, EARNINGS_WORKERS
 
 def parse_args():
     parser = ArgumentParser()
@@ -11,6 +12,12 @@ def parse_args():
     parser.add_argument('--price-type', 
         type=str, required=False, default=None,
         help='Frequency of prices - "daily" or "intraday".')
+    parser.add_argument('--as-of',
+        type=str, required=False, default=None,
+        help='Date "yyyy-mm-dd" to read index members on, defaults to today.')
+    parser.add_argument('--refresh-universe',
+        action='store_true', required=False, default=False,
+        help='Whether to record additions and removals of the index from Wiki before extracting.')
     parser.add_argument('--after-hours', 
         action='store_true', required=False, default=False,
         help='If intraday prices, whether to keep after hours prices or not.')
@@ -21,10 +28,73 @@ def parse_args():
         action='store_true', required=False, default=False,
         help='''Set True to bootstrap historical earnings or False to save 
                 only recent within last TRUNCATE_BUFFER days.''')
+    parser.add_argument('--earnings-calls-per-min',
+        type=int, required=False, default=EARNINGS_CALLS_PER_MIN,
+        help='Yahoo earnings calendar requests allowed per minute.')
+    parser.add_argument('--earnings-workers',
+        type=int, required=False, default=EARNINGS_WORKERS,
+        help='Number of concurrent Yahoo earnings calendar requests.')
     parser.add_argument('--write-csv', 
         action='store_true', required=False, default=False,
         help='Whether to write prices to csvs.')
     parser.add_argument('--write-db', 
         action='store_true', required=False, default=False,
         help='Whether to write prices to db.')
+    parser.add_argument('--incremental',
+        action='store_true', required=False, default=False,
+        help='''Whether to extract only prices newer than the latest stored per ticker,
+                using compact API output when it covers the gap.''')
+    parser.add_argument('--use-cache',
+        action='store_true', required=False, default=False,
+        help='Whether to serve API payloads from the local response cache when fresh.')
+    parser.add_argument('--replay',
+        action='store_true', required=False, default=False,
+        help='Whether to serve API payloads only from the local response cache, without network calls.')
+    parser.add_argument('--calls-per-min',
+        type=int, required=False, default=AV_CALLS_PER_MIN,
+        help='AlphaVantage API calls allowed per minute for the API key.')
+    parser.add_argument('--write-parquet',
+        action='store_true', required=False, default=False,
+        help='Whether to append prices to the partitioned parquet price store.')
+    parser.add_argument('--compact-store',
+        action='store_true', required=False, default=False,
+        help='Whether to compact daily delta files of the parquet price store after the run.')
+    parser.add_argument('--update-snapshot',
+        action='store_true', required=False, default=False,
+        help='Whether to append prices to the memory mapped in-memory price store snapshot.')
+    parser.add_argument('--update-rollups',
+        action='store_true', required=False, default=False,
+        help='Whether to update hourly, session and weekly rollups after writing intraday prices.')
+    parser.add_argument('--db-batch-size',
+        type=int, required=False, default=DB_BATCH_SIZE,
+        help='Rows per multi-row upsert statement (and transaction) when writing to db.')
+    parser.add_argument('--load-infile',
+        action='store_true', required=False, default=False,
+        help='Whether to stage db writes through LOAD DATA LOCAL INFILE, for very large loads.')
+    parser.add_argument('--diff-upsert',
+        action='store_true', required=False, default=False,
+        help='''Whether to write only new or changed rows to db, compared by content hash,
+                for earnings bootstraps and full price reloads.''')
+    parser.add_argument('--spool',
+        action='store_true', required=False, default=False,
+        help='''Whether to spool fetched prices to local segments drained to db in the background,
+                resuming tickers completed by an interrupted run of the same day.''')
+    parser.add_argument('--backfill',
+        action='store_true', required=False, default=False,
+        help='''Whether to fetch only bars missing from db since start date, found by comparing
+                stored prices against the exchange session calendar.''')
+    parser.add_argument('--migrate',
+        action='store_true', required=False, default=False,
+        help='''Whether to migrate price tables to monthly partitions keyed by ticker ids before
+                maintaining their partitions.''')
+    parser.add_argument('--query-cache',
+        action='store_true', required=False, default=False,
+        help='''Whether to cache results of db reads in memory and on disk, shared by processes and
+                invalidated by writes to the tables they read.''')
+    parser.add_argument('--full-sync',
+        action='store_true', required=False, default=False,
+        help='Whether to mirror whole tables to the embedded store instead of their latest rows.')
+    parser.add_argument('--write-metrics',
+        action='store_true', required=False, default=False,
+        help='Whether to write per stage timings and counters of the run as JSON and Prometheus text.')
     return parser.parse_args()
@@ -0,0 +1,166 @@
+'''
+Parser converting AlphaVantage time series payloads straight into typed NumPy arrays
+'''
+
+import os
+import sys
+import weakref
+from collections import namedtuple
+from contextlib import contextmanager
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+import pandas as pd
+
+
+AV_OHLC_FIELDS = ['1. open', '2. high', '3. low', '4. close']
+AV_VOLUME_FIELD = '5. volume'
+PRICE_COLS = ['open', 'high', 'low', 'close', 'volume']
+
+SEC_PER_DAY = 86400
+SESSION_START_SEC = 9*3600 + 30*60 # regular session open (9:30) as seconds of day
+SESSION_END_SEC = 16*3600 # regular session close (16:00) as seconds of day
+
+PriceArrays = namedtuple('PriceArrays', ['ts'] + PRICE_COLS)
+PriceArrays.__doc__ = '''Bars sorted by time, ts as int64 epoch seconds, float32 OHLC and int64 volume'''
+
+SharedArrays = namedtuple('SharedArrays', ['name', 'n'])
+SharedArrays.__doc__ = '''Name of a shared memory block holding n bars of PriceArrays, name None if n is 0'''
+
+# Column dtypes in the order they are packed in a shared memory block, 32 bytes per bar
+SHARED_DTYPES = [np.int64, np.float32, np.float32, np.float32, np.float32, np.int64]
+
+
+
+
+def _to_epoch_sec(timestamp):
+    return int(pd.Timestamp(timestamp).value // 10**9)
+
+
+def parse_av_payload(price, start=None, after=None, session_only=False):
+    '''Parse an AlphaVantage time series payload in one pass
+
+    Parameters
+    ----------
+    price : dict[str, dict[str, str]]
+        Payload of bars keyed by timestamp string, as returned by TimeSeries
+    start : pandas.Timestamp, optional
+        Keep bars at or after start
+    after : pandas.Timestamp, optional
+        Keep bars strictly after this timestamp, e.g. the latest stored bar
+    session_only : bool, optional
+        True to keep only bars within the 9:30-16:00 regular session (default=False)
+
+    Returns
+    -------
+    PriceArrays
+        Bars sorted by time
+    '''
+    n = len(price)
+    ts = np.array(list(price.keys()), dtype='datetime64[s]').astype(np.int64)
+    bars = price.values()
+    ohlc = np.array([bar[f] for bar in bars for f in AV_OHLC_FIELDS],
+                    dtype=np.float32).reshape(n, len(AV_OHLC_FIELDS))
+    volume = np.array([bar[AV_VOLUME_FIELD] for bar in bars], dtype=np.int64)
+
+    mask = np.ones(n, dtype=bool)
+    if start is not None:
+        mask &= ts >= _to_epoch_sec(start)
+    if after is not None:
+        mask &= ts > _to_epoch_sec(after)
+    if session_only:
+        sec_of_day = ts % SEC_PER_DAY
+        mask &= (sec_of_day >= SESSION_START_SEC) & (sec_of_day <= SESSION_END_SEC)
+
+    idx = np.flatnonzero(mask)
+    idx = idx[np.argsort(ts[idx], kind='stable')]
+    return PriceArrays(ts[idx], ohlc[idx, 0], ohlc[idx, 1], ohlc[idx, 2], ohlc[idx, 3],
+                       volume[idx])
+
+
+def select_spans(arrays, spans):
+    '''Keep bars within any of the sorted, non-overlapping (start, end) spans, bounds included'''
+    starts = np.array([_to_epoch_sec(start) for start, _ in spans], dtype=np.int64)
+    ends = np.array([_to_epoch_sec(end) for _, end in spans], dtype=np.int64)
+    i = np.searchsorted(starts, arrays.ts, side='right') - 1
+    mask = (i >= 0) & (arrays.ts <= ends[np.maximum(i, 0)])
+    return PriceArrays(*(values[mask] for values in arrays))
+
+
+def to_frame(stock_ticker, arrays, ts_name='dt', copy=True):
+    '''Build a dataframe indexed by ticker and timestamp from parsed arrays
+
+    With copy False the price columns are the given arrays themselves.
+    '''
+    index = pd.MultiIndex.from_arrays(
+        [np.full(len(arrays.ts), stock_ticker, dtype=object),
+         pd.to_datetime(arrays.ts, unit='s')], names=['ticker', ts_name])
+    return pd.DataFrame({col: getattr(arrays, col) for col in PRICE_COLS}, index=index,
+                        copy=copy)
+
+
+def _shared_views(raw, n):
+    '''PriceArrays of views into the bytes of a shared memory block holding n bars'''
+    views, offset = [], 0
+    for dtype in SHARED_DTYPES:
+        nbytes = n * np.dtype(dtype).itemsize
+        views.append(raw[offset:offset+nbytes].view(dtype))
+        offset += nbytes
+    return PriceArrays(*views)
+
+
+def _block_bytes(shm):
+    return np.ndarray(shm.size, dtype=np.uint8, buffer=shm.buf)
+
+
+def arrays_to_shm(arrays):
+    '''Copy parsed arrays into a new shared memory block, in a worker process
+
+    The block outlives this process and is unlinked by `shared_frame` in the
+    parent, so only the small SharedArrays descriptor is pickled back.
+    '''
+    n = len(arrays.ts)
+    if n == 0:
+        return SharedArrays(None, 0)
+    size = n * sum(np.dtype(dtype).itemsize for dtype in SHARED_DTYPES)
+    if sys.version_info >= (3, 13):
+        # The parent unlinks the block, so this process' resource tracker must not clean it up
+        shm = shared_memory.SharedMemory(create=True, size=size, track=False)
+    else:
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        # Registered by its POSIX name, the public name without the leading slash
+        resource_tracker.unregister(('/' if os.name == 'posix' else '') + shm.name,
+                                    'shared_memory')
+    try:
+        for view, values in zip(_shared_views(_block_bytes(shm), n), arrays):
+            view[:] = values
+    except:
+        shm.close()
+        shm.unlink()
+        raise
+    shm.close()
+    return SharedArrays(shm.name, n)
+
+
+@contextmanager
+def shared_frame(stock_ticker, shared, ts_name='dt'):
+    '''Ticker frame over a worker's shared memory block, unlinked when the block exits
+
+    The price columns are views of the shared pages, so bars are neither unpickled
+    nor copied on their way from the worker to the outputs. The frame is to be
+    persisted within the with block. The block is closed once the views, and so
+    the frame and any column taken from it, are garbage collected.
+    '''
+    if shared.n == 0:
+        yield to_frame(stock_ticker, parse_av_payload({}), ts_name)
+        return
+    shm = shared_memory.SharedMemory(name=shared.name)
+    try:
+        raw = _block_bytes(shm)
+        # NumPy views do not pin the mapping, so it is closed only after the last view
+        weakref.finalize(raw, shm.close).atexit = False
+        frame = to_frame(stock_ticker, _shared_views(raw, shared.n), ts_name, copy=False)
+        raw = None
+        yield frame
+    finally:
+        shm.unlink()
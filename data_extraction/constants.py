@@ -6,10 +6,20 @@ sys.path.append(ST_HOME)
 
 today = dt.date.today().isoformat()
 PRICE_STORE_PATH = '/Users/akshit/SmartTrading_data/prices/{}/'.format(today)
+RESPONSE_CACHE_PATH = '/Users/akshit/SmartTrading_data/cache/'
+PARQUET_STORE_PATH = '/Users/akshit/SmartTrading_data/parquet/'
+PRICE_SNAPSHOT_PATH = '/Users/akshit/SmartTrading_data/snapshots/'
+METRICS_PATH = '/Users/akshit/SmartTrading_data/metrics/'
+SPOOL_PATH = '/Users/akshit/SmartTrading_data/spool/'
+QUERY_CACHE_PATH = '/Users/akshit/SmartTrading_data/query_cache/'
+EMBEDDED_STORE_PATH = '/Users/akshit/SmartTrading_data/smart_trading.db' # DuckDB (or SQLite) mirror of MySQL
 
 DEFAULT_DAYS_INTRA = 30 # trucate intraday prices older than 'default_days_intra' days
 DEFAULT_DAYS_DAILY = 10000 # trucate daily prices older than 'default_days_intra' days
-SLEEP_TIME_SEC = 70 # sleep time between AlphaVantage API requests
+AV_CALLS_PER_MIN = 5 # AlphaVantage API calls allowed per minute for the API key
+AV_COMPACT_SIZE = 100 # number of latest bars returned by AlphaVantage with outputsize='compact'
+INTRADAY_BARS_PER_DAY = 64 # 15 minute bars per day including pre-market and after-hours (4:00-20:00)
+INTRADAY_SESSION_END_HOUR = 20 # hour of the last intraday bar including after-hours
 
 # When extracting tickers from indices, exception wll shown 
 # if ticker count not between the following range
@@ -18,4 +28,51 @@ NASDAQ_UL = 130
 SP500_LL = 450
 SP500_UL = 600
 
-TRUNCATE_BUFFER = 90 # today-TRUNCATE_BUFFER is date before which earnings to get truncated
\ No newline at end of file
+TRUNCATE_BUFFER = 90 # today-TRUNCATE_BUFFER is date before which earnings to get truncated
+EARNINGS_CALLS_PER_MIN = 30 # Yahoo earnings calendar requests allowed per minute
+EARNINGS_WORKERS = 8 # concurrent Yahoo earnings calendar requests
+
+DB_BATCH_SIZE = 5000 # rows per multi-row upsert statement and transaction when writing to db
+PARTITION_MONTHS_AHEAD = 3 # monthly price partitions created ahead of today
+RETENTION_DAYS = {'intraday': DEFAULT_DAYS_INTRA, 'daily': DEFAULT_DAYS_DAILY} # partitions older are dropped
+SPOOL_BATCH_ROWS = 200000 # spooled rows drained to db per batch
+SPOOL_MAX_RETRIES = 5 # attempts per spooled batch before leaving it for the next run
+
+# Tables mirrored to the embedded store: primary key, time column synced incrementally (None
+# for full copies) and days before the latest mirrored row replaced on each sync, catching restatements
+SYNC_TABLES = {'daily_prices': (['ticker', 'dt'], 'dt', 7),
+               'intraday_prices': (['ticker', 'ts'], 'ts', 2),
+               'intraday_rollups': (['ticker', 'bucket_type', 'bucket_start'], 'bucket_start', 7),
+               'earnings': (['ticker', 'ds'], 'ds', TRUNCATE_BUFFER),
+               'price_features': (['ticker', 'price_type', 'ts'], 'ts', 7),
+               'forecasts': (['ticker', 'price_type', 'model', 'origin_ts', 'horizon'], 'origin_ts', 0),
+               'forecast_backtests': (['ticker', 'price_type', 'model', 'horizon'], None, 0),
+               'tickers': (['ticker', 'stock_index'], None, 0),
+               'ticker_membership': (['ticker', 'stock_index', 'valid_from'], None, 0)}
+
+# Ingestion daemon: market hours (US/Eastern), refresh intervals in seconds and scheduling
+MARKET_TZ = 'America/New_York'
+MARKET_OPEN = dt.time(9, 30)
+MARKET_CLOSE = dt.time(16, 0)
+HALF_DAY_CLOSE = dt.time(13, 0) # early close before Independence Day, after Thanksgiving and on Christmas Eve
+EXTENDED_OPEN = dt.time(4, 0) # pre-market open, for after-hours bars
+EXTENDED_CLOSE = dt.time(20, 0) # after-hours close, 17:00 on half days
+SPECIAL_CLOSURES = ['2001-09-11', '2001-09-12', '2001-09-13', '2001-09-14', '2004-06-11',
+                    '2007-01-02', '2012-10-29', '2012-10-30', '2018-12-05', '2025-01-09'] # unscheduled closures
+DAEMON_INTERVAL_SEC = {'intraday': 15*60, 'daily': 24*3600, 'earnings': 7*24*3600}
+DAEMON_RETRY_SEC = {'intraday': 15*60, 'daily': 3600, 'earnings': 24*3600} # min time between calls per pair
+DAEMON_INTRADAY_WEIGHT = 4 # priority multiplier of intraday staleness during market hours
+DAEMON_TICKERS_REFRESH_SEC = 24*3600 # refresh of index members from Wiki
+DAEMON_MAX_IN_FLIGHT = 8 # dispatched requests not yet saved, per API budget
+DAEMON_IDLE_SEC = 30 # sleep when nothing is due
+
+# Time to live in seconds of cached API payloads per endpoint, and max cache size
+RESPONSE_CACHE_TTL_SEC = {'intraday': 15*60, 'daily': 12*3600, 'earnings': 24*3600,
+                          'index_members': 24*3600}
+RESPONSE_CACHE_MAX_BYTES = 2 * 1024**3
+
+# Read-through cache of query results: memory and disk sizes, and max age bounding staleness
+# from writes made outside DBWrapper
+QUERY_CACHE_MAX_BYTES = 256 * 1024**2
+QUERY_CACHE_DISK_MAX_BYTES = 2 * 1024**3
+QUERY_CACHE_TTL_SEC = 15*60
\ No newline at end of file
@@ -0,0 +1,317 @@
+'''
+Long-running ingestion daemon replacing the separate cron runs of extract_prices.py and
+extract_earnings.py. It keeps database connections, worker processes and high-water marks
+warm, and spends each API budget on the stalest (ticker, dataset) pairs first.
+'''
+
+import asyncio
+import datetime as dt
+import signal
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import cpu_count
+
+import numpy as np
+import pandas as pd
+from alpha_vantage.timeseries import TimeSeries
+
+from constants import *
+from args import parse_args
+from rate_limiter import TokenBucket
+from extract_prices import Stock, init_worker, fetch_shared
+from av_parser import shared_frame
+from trading_calendar import TradingCalendar
+from partitions import VIEW_DEPENDENCIES, PartitionManager, TickerIds
+from extract_earnings import Earnings
+from libs.st_logger.logger import logger
+from libs.st_logger.metrics import get_metrics
+from libs.PyDB.DBWrapper import DBWrapper
+from libs.PyDB.QueryCache import QueryCache
+
+# API budget each dataset is fetched with
+BUDGETS = {'intraday': 'alphavantage', 'daily': 'alphavantage', 'earnings': 'yahoo'}
+
+
+class IngestionDaemon(object):
+    '''
+    A daemon refreshing intraday prices, daily prices, earnings and index members
+
+    Prices are behind when the latest stored bar is older than the latest bar the
+    market has published by now. Staleness is the number of intervals behind: 15
+    minute bars for intraday and sessions for daily, weighted up for intraday during
+    market hours. Earnings are due a week after their last successful fetch, and
+    then score the weeks since. Whenever a token of a budget is available, the stalest due pair of that budget is dispatched, so
+    every API call goes where the data is oldest.
+
+    ...
+
+    Attributes
+    ----------
+    st_db : PyDB.DBWrapper.DBWrapper
+        DBWrapper object for interacting with database, its connections stay warm
+    logger : st_logger.logger
+        object of class st_logger.logger
+    stock_index : str
+        stock index to ingest, 'SP500' or 'NASDAQ'
+    stocks : dict[str, Stock]
+        Stock object per price type, holding the high-water marks of stored prices
+    earnings : Earnings
+        Earnings object fetching earnings per ticker
+    buckets : dict[str, rate_limiter.TokenBucket]
+        shared rate budget per API
+    last_attempt : dict[tuple, float]
+        epoch seconds of the last call per (dataset, ticker)
+    last_success : dict[str, float]
+        epoch seconds of the last successful earnings fetch per ticker
+    calendar : trading_calendar.TradingCalendar
+        exchange session calendar, so holidays and early closes are not counted as behind
+
+    Methods
+    -------
+    staleness(dataset, ticker, now)
+        priority of refreshing the pair, 0 if it is up to date
+    maintain_partitions()
+        adds and drops monthly price partitions, daily along with index members
+    run()
+        runs the daemon until SIGINT or SIGTERM
+    stop()
+        stops dispatching and lets in-flight requests finish
+    '''
+
+    def __init__(self, st_db, st_logger, stock_index='NASDAQ', ts=None,
+                 calls_per_min=AV_CALLS_PER_MIN, earnings_calls_per_min=EARNINGS_CALLS_PER_MIN,
+                 after_hours=False, db_batch_size=DB_BATCH_SIZE, metrics=None):
+        self.st_db = st_db
+        self.logger = st_logger
+        self.stock_index = stock_index
+        self.metrics = metrics or get_metrics('Daemon')
+        self.partitions = PartitionManager(st_db, st_logger)
+        self.stocks = {price_type: Stock(stock_index=stock_index, price_type=price_type, ts=ts,
+                                         after_hours=after_hours, write_db=True, st_db=st_db,
+                                         st_logger=st_logger, db_batch_size=db_batch_size,
+                                         incremental=True, metrics=self.metrics,
+                                         ticker_ids=TickerIds(st_db)
+                                         if self.partitions.is_partitioned(price_type) else None)
+                       for price_type in ['intraday', 'daily']}
+        self.earnings = Earnings(st_db=st_db, st_logger=st_logger, db_batch_size=db_batch_size,
+                                 metrics=self.metrics)
+        self.buckets = {'alphavantage': TokenBucket(calls_per_min),
+                        'yahoo': TokenBucket(earnings_calls_per_min)}
+        self.tickers_list = []
+        self.last_attempt = {}
+        self.last_success = {}
+        self.calendar = TradingCalendar()
+        self._in_flight = set()
+        self._stopping = False
+
+
+    def _market_now(self):
+        '''Current time in the exchange time zone, naive like the stored timestamps'''
+        return pd.Timestamp.now(tz=MARKET_TZ).tz_localize(None)
+
+
+    def in_market_hours(self, now):
+        if not self.calendar.is_session(now):
+            return False
+        close = HALF_DAY_CLOSE if np.datetime64(now.date()) in self.calendar.half_days else MARKET_CLOSE
+        return MARKET_OPEN <= now.time() < close
+
+
+    def _roll_start_dates(self):
+        '''Move the start date of each price type to the default window ending today'''
+        for price_type, stock in self.stocks.items():
+            days = DEFAULT_DAYS_INTRA if price_type == 'intraday' else DEFAULT_DAYS_DAILY
+            stock.start_date = pd.Timestamp(dt.date.today() - dt.timedelta(days=days))
+
+
+    def _expected_latest(self, dataset, now):
+        '''Latest bar the market has published by now'''
+        return self.calendar.latest_bar(dataset, now, self.stocks[dataset].after_hours)
+
+
+    def staleness(self, dataset, ticker, now):
+        '''Priority of refreshing (dataset, ticker), 0 if it is up to date or called too recently'''
+        last_attempt = self.last_attempt.get((dataset, ticker), 0.0)
+        if time.time() - last_attempt < DAEMON_RETRY_SEC[dataset]:
+            return 0.0
+        interval = pd.Timedelta(seconds=DAEMON_INTERVAL_SEC[dataset])
+        if dataset == 'earnings':
+            due = (time.time() - self.last_success.get(ticker, 0.0)) / interval.total_seconds()
+            return due if due >= 1 else 0.0
+        hwm = self.stocks[dataset].high_water_marks.get(ticker)
+        if hwm is None:
+            return float('inf')
+        behind = (self._expected_latest(dataset, now) - hwm) / interval
+        if dataset == 'intraday' and self.in_market_hours(now):
+            behind *= DAEMON_INTRADAY_WEIGHT
+        return max(behind, 0.0)
+
+
+    def _next_due(self, budget):
+        '''Stalest pair of the budget not in flight, None if nothing is due'''
+        now = self._market_now()
+        best, best_score = None, 0.0
+        for dataset in [d for d, b in BUDGETS.items() if b == budget]:
+            for ticker in self.tickers_list:
+                if (dataset, ticker) in self._in_flight:
+                    continue
+                score = self.staleness(dataset, ticker, now)
+                if score > best_score:
+                    best, best_score = (dataset, ticker), score
+        return best
+
+
+    def refresh_tickers(self):
+        '''Refresh index members from Wiki and reload high-water marks for new tickers'''
+        stock = self.stocks['daily']
+        try:
+            stock.update_tickers_db()
+        except:
+            self.logger.warning('Could not refresh tickers of {}.'.format(self.stock_index))
+        stock.get_tickers_from_index()
+        self.tickers_list = list(stock.tickers_list)
+        for stock in self.stocks.values():
+            stock.tickers_list = self.tickers_list
+            if self.tickers_list:
+                stock.get_high_water_marks()
+        self.logger.info('Tracking {} tickers of {}.'.format(len(self.tickers_list),
+                                                             self.stock_index))
+
+
+    async def _fetch_prices(self, dataset, ticker):
+        loop = asyncio.get_running_loop()
+        stock = self.stocks[dataset]
+        shared = await loop.run_in_executor(self.pool, fetch_shared, stock._task(ticker))
+        if shared is None:
+            raise Exception('skipped by AlphaVantage')
+        today = dt.date.today().strftime('%Y_%m_%d')
+        with shared_frame(ticker, shared) as ticker_prices:
+            written = await loop.run_in_executor(self._writer, stock._save_prices, ticker,
+                                                 ticker_prices, today)
+            latest = pd.Timestamp(ticker_prices.index.get_level_values(1).max()) \
+                if len(ticker_prices.index) > 0 else None
+        # Advanced only once written, so the next fetch of a failed write covers its bars again
+        if not written:
+            raise Exception('prices not written to db')
+        if latest is not None:
+            stock.high_water_marks[ticker] = latest
+
+
+    async def _fetch_earnings(self, ticker):
+        loop = asyncio.get_running_loop()
+        earnings_df = await loop.run_in_executor(self._threads,
+                                                 self.earnings.get_earnings_features_ticker, ticker)
+        if earnings_df.shape[0] > 0:
+            await loop.run_in_executor(self._writer, self.earnings.write_earnings_to_db,
+                                       earnings_df)
+        self.last_success[ticker] = time.time()
+
+
+    async def _run_job(self, dataset, ticker, slots):
+        try:
+            with self.metrics.timer('job', dataset=dataset):
+                if dataset == 'earnings':
+                    await self._fetch_earnings(ticker)
+                else:
+                    await self._fetch_prices(dataset, ticker)
+            self.metrics.inc('jobs', dataset=dataset)
+        except Exception as e:
+            self.metrics.inc('jobs_failed', dataset=dataset)
+            self.logger.warning('{}: Could not refresh {} - {}'.format(ticker, dataset, e))
+        finally:
+            self._in_flight.discard((dataset, ticker))
+            slots.release()
+
+
+    async def _schedule(self, budget):
+        '''Spend the budget's tokens on the stalest due pair at the time each token is available'''
+        slots = asyncio.Semaphore(DAEMON_MAX_IN_FLIGHT)
+        bucket = self.buckets[budget]
+        while not self._stopping:
+            # Tasks carry the start date, so the window keeps moving with the days
+            self._roll_start_dates()
+            if self._next_due(budget) is None:
+                await asyncio.sleep(DAEMON_IDLE_SEC)
+                continue
+            await slots.acquire()
+            self.metrics.observe('rate_limit_wait', await bucket.acquire_async(), budget=budget)
+            pair = self._next_due(budget)
+            if pair is None or self._stopping:
+                slots.release()
+                continue
+            self._in_flight.add(pair)
+            self.last_attempt[pair] = time.time()
+            asyncio.ensure_future(self._run_job(pair[0], pair[1], slots))
+
+
+    async def _refresh_tickers_loop(self):
+        loop = asyncio.get_running_loop()
+        while not self._stopping:
+            await asyncio.sleep(DAEMON_TICKERS_REFRESH_SEC)
+            await loop.run_in_executor(self._writer, self.refresh_tickers)
+            await loop.run_in_executor(self._writer, self.maintain_partitions)
+
+
+    def maintain_partitions(self):
+        '''Add partitions ahead and drop expired ones of the migrated price tables'''
+        for price_type, stock in self.stocks.items():
+            if stock.ticker_ids is None:
+                continue
+            try:
+                self.partitions.maintain(price_type)
+            except:
+                self.logger.warning('Could not maintain {} partitions.'.format(price_type))
+
+
+    async def _main(self):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stop)
+        await loop.run_in_executor(self._writer, self.refresh_tickers)
+        tasks = [asyncio.ensure_future(self._schedule(budget)) for budget in set(BUDGETS.values())]
+        refresh = asyncio.ensure_future(self._refresh_tickers_loop())
+        await asyncio.gather(*tasks)
+        refresh.cancel()
+        while self._in_flight:
+            await asyncio.sleep(1)
+
+
+    def run(self):
+        '''Run until SIGINT or SIGTERM, with worker processes and connections kept warm'''
+        self._roll_start_dates()
+        self.pool = ProcessPoolExecutor(max(cpu_count()-1, 1), initializer=init_worker,
+                                        initargs=({price_type: stock._for_worker()
+                                                   for price_type, stock in self.stocks.items()},))
+        self._threads = ThreadPoolExecutor(EARNINGS_WORKERS)
+        # One writer thread serializes database writes, as in Stock.get_list_stock_prices
+        self._writer = ThreadPoolExecutor(1)
+        try:
+            asyncio.run(self._main())
+        finally:
+            self._writer.shutdown(wait=True)
+            self._threads.shutdown(wait=True)
+            self.pool.shutdown(wait=True)
+            self.st_db.close()
+        self.logger.info('Stopped ingestion daemon.')
+
+
+    def stop(self):
+        self.logger.info('Stopping ingestion daemon after in-flight requests .....')
+        self._stopping = True
+
+
+if __name__ == '__main__':
+    st_logger = logger('Daemon')
+    args = parse_args()
+    query_cache = None
+    if args.query_cache:
+        query_cache = QueryCache(QUERY_CACHE_MAX_BYTES, cache_dir=QUERY_CACHE_PATH,
+                                 disk_max_bytes=QUERY_CACHE_DISK_MAX_BYTES,
+                                 ttl_sec=QUERY_CACHE_TTL_SEC, dependents=VIEW_DEPENDENCIES)
+    st_db = DBWrapper('SMART_TRADING', cache=query_cache)
+    daemon = IngestionDaemon(st_db=st_db, st_logger=st_logger,
+                             stock_index=args.stock_index or 'NASDAQ', ts=TimeSeries(),
+                             calls_per_min=args.calls_per_min,
+                             earnings_calls_per_min=args.earnings_calls_per_min,
+                             after_hours=args.after_hours, db_batch_size=args.db_batch_size)
+    daemon.run()
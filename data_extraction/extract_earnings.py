@@ -3,53 +3,67 @@ import pandas as pd
 import numpy as np
 import auth
 import datetime as dt
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from constants import *
 
 from libs.PyDB.DBWrapper import DBWrapper
+from libs.PyDB.QueryCache import QueryCache
+from libs.st_cache.response_cache import ResponseCache
 from libs.st_logger.logger import logger
+from libs.st_logger.metrics import get_metrics
 from args import parse_args
+from rate_limiter import TokenBucket
+from universe import Universe
+from partitions import VIEW_DEPENDENCIES
 
 class Earnings(object):
     
-    def __init__(self, st_db, st_logger, historical_earnings=False):
+    def __init__(self, st_db, st_logger, historical_earnings=False,
+                 db_batch_size=DB_BATCH_SIZE, diff_upsert=False, cache=None,
+                 calls_per_min=EARNINGS_CALLS_PER_MIN, n_workers=EARNINGS_WORKERS,
+                 metrics=None):
         import yahoo_earnings_calendar as YEC
         self._yec = YEC.YahooEarningsCalendar()
         self.st_db = st_db
         self.logger = st_logger
         self.historical_earnings = historical_earnings
+        self.db_batch_size = db_batch_size
+        self.diff_upsert = diff_upsert
+        self.cache = cache
+        self.calls_per_min = calls_per_min
+        self.n_workers = n_workers
+        self.metrics = metrics or get_metrics('Earnings')
         self._cols = cols = ['ticker', 'ds', 'company_name', 'earnings_dt', 'datetime_type', 
             'eps_estimate', 'eps_actual','eps_surprise_pct', 'time_zone',
             'gmt_offset_ms', 'quote_type']
         
     def _extract_earnings_json(self, ticker):
-        return self._yec.get_earnings_of(ticker)
+        with self.metrics.timer('fetch'):
+            if self.cache is None:
+                return self._yec.get_earnings_of(ticker)
+            return self.cache.fetch('yahoo', 'earnings', ticker, {},
+                                    lambda: self._yec.get_earnings_of(ticker))
     
-    def get_earnings_features_ticker(self, ticker):
-        earnings_payload = self._extract_earnings_json(ticker)
-        earnings_df = pd.DataFrame([], columns=self._cols)
+    def _parse_earnings_records(self, earnings_payload):
+        '''Parse payload into a list of row tuples in the order of self._cols'''
         try:
-            for d in earnings_payload:
-                ticker = d['ticker']
-                ds = d['startdatetime'][:10]
-                company_name = d['companyshortname']
-                earnings_dt = d['startdatetime']
-                datetime_type = d['startdatetimetype']
-                eps_estimate = d['epsestimate']
-                eps_actual = d['epsactual']
-                eps_surprise_pct = d['epssurprisepct']
-                time_zone = d['timeZoneShortName']
-                gmt_offset_ms = d['gmtOffsetMilliSeconds']
-                quote_type = d['quoteType']
-                parsed_series = pd.Series(
-                    [ticker, ds, company_name, earnings_dt, 
-                     datetime_type, eps_estimate, eps_actual, 
-                     eps_surprise_pct, time_zone, gmt_offset_ms,
-                     quote_type], index=self._cols)
-                earnings_df = earnings_df.append(parsed_series, 
-                                                 ignore_index=True)
+            return [(d['ticker'], d['startdatetime'][:10], d['companyshortname'],
+                     d['startdatetime'], d['startdatetimetype'], d['epsestimate'],
+                     d['epsactual'], d['epssurprisepct'], d['timeZoneShortName'],
+                     d['gmtOffsetMilliSeconds'], d['quoteType'])
+                    for d in earnings_payload]
         except:
             self.logger.warning('Could not get earnings data, \
                                 returning empty data frame...')
+            return []
+
+    def _build_earnings_frame(self, records):
+        '''Build one typed earnings frame from row tuples of any number of tickers'''
+        if records:
+            columns = dict(zip(self._cols, [list(col) for col in zip(*records)]))
+        else:
+            columns = {col: [] for col in self._cols}
+        earnings_df = pd.DataFrame(columns, columns=self._cols)
         cols_float = ['eps_estimate', 'eps_actual', 'eps_surprise_pct']
         earnings_df[cols_float] = earnings_df[cols_float].astype(float)
         earnings_df.set_index(['ticker', 'ds'], inplace=True)
@@ -61,6 +75,11 @@ class Earnings(object):
                     (dt.date.today()-dt.timedelta(days=TRUNCATE_BUFFER)).isoformat()]
         return earnings_df
     
+    def get_earnings_features_ticker(self, ticker):
+        earnings_payload = self._extract_earnings_json(ticker)
+        with self.metrics.timer('parse'):
+            return self._build_earnings_frame(self._parse_earnings_records(earnings_payload))
+    
     def write_earnings_to_db(self, earnings_df):
         
         # MySQL doesn't write NaN's for float cols, so convert to -99.0
@@ -79,44 +98,87 @@ class Earnings(object):
         if bool(cols_not_exist):
             raise ValueError('Missing columns: ', cols_not_exist)
         else:
-            self.st_db.executeWriteQuery(earnings_df, 'earnings')
+            with self.metrics.timer('db_write'):
+                if self.diff_upsert:
+                    # Re-bootstraps only write restated quarters, avoiding updated_at churn
+                    stats = self.st_db.executeDiffWriteQuery(earnings_df, 'earnings',
+                                                             key_cols=['ticker', 'ds'],
+                                                             batch_size=self.db_batch_size)
+                    for count in ['inserted', 'updated', 'unchanged']:
+                        self.metrics.inc('rows_' + count, stats[count])
+                else:
+                    stats = self.st_db.executeWriteQuery(earnings_df, 'earnings',
+                                                         batch_size=self.db_batch_size)
+            self.metrics.inc('rows_written_db', stats['rows'])
             self.logger.info('Successfully written earnings...')
             
             
     def load_earnings_all_tickers(self, stock_index):
-        if stock_index in ['SP500', 'NASDAQ']:
-            qry = '''
-            SELECT 
-                ticker
-            FROM
-                tickers
-            WHERE
-                stock_index = '{}'
-            '''.format(stock_index)
-        else:
+        if stock_index not in ['SP500', 'NASDAQ']:
             raise ValueError('stock_index must be in ["SP500", "NASDAQ"]')
-        
-        pdf_earnings_all = pd.DataFrame([], columns=self._cols) \
-            .set_index(['ticker', 'ds'])
-        
-        stocks_list = list(st_db.executeReadQuery(qry)['ticker'])
-        for ticker in stocks_list:
-            try:
-                pdf_earnings = self.get_earnings_features_ticker(ticker)
-                pdf_earnings_all = pd.concat([pdf_earnings_all, pdf_earnings], axis=0)
-                self.logger.info('Extracted earnings data for ticker: {}'.format(ticker))
-            except:
-                self.logger.info('Skipped earnings for ticker: {}'.format(ticker))
+
+        # Current members only, so no requests are spent on removed constituents
+        stocks_list = Universe(self.st_db, self.logger).get_members(stock_index)
+        bucket = TokenBucket(self.calls_per_min)
+
+        def fetch_records(ticker):
+            # Cached payloads do not use API quota, and replay never calls the API
+            if self.cache is not None and self.cache.contains('yahoo', 'earnings', ticker, {}):
+                self.metrics.inc('cache_hits')
+            elif self.cache is None or not self.cache.replay:
+                self.metrics.observe('rate_limit_wait', bucket.acquire())
+            earnings_payload = self._extract_earnings_json(ticker)
+            with self.metrics.timer('parse'):
+                return self._parse_earnings_records(earnings_payload)
+
+        # Fetch concurrently within the rate limit, collect rows and build one frame at the end
+        records = []
+        with ThreadPoolExecutor(self.n_workers) as executor:
+            futures = {executor.submit(fetch_records, ticker): ticker for ticker in stocks_list}
+            for future in as_completed(futures):
+                ticker = futures[future]
+                try:
+                    ticker_records = future.result()
+                    records.extend(ticker_records)
+                    self.metrics.inc('rows_fetched', len(ticker_records))
+                    self.logger.info('Extracted earnings data for ticker: {}'.format(ticker))
+                except:
+                    self.metrics.inc('tickers_skipped')
+                    self.logger.info('Skipped earnings for ticker: {}'.format(ticker))
+        self.logger.info('Waited {} sec in total for API quota.'.format(round(bucket.wait_sec, 2)))
+
+        pdf_earnings_all = self._build_earnings_frame(records)
         if pdf_earnings_all.shape[0] > 0:
             self.write_earnings_to_db(pdf_earnings_all)
         
 
 
 if __name__ == '__main__':
-    st_db = DBWrapper('SMART_TRADING')
     st_logger = logger('Earnings')
     args = parse_args()
+    query_cache = None
+    if args.query_cache:
+        query_cache = QueryCache(QUERY_CACHE_MAX_BYTES, cache_dir=QUERY_CACHE_PATH,
+                                 disk_max_bytes=QUERY_CACHE_DISK_MAX_BYTES,
+                                 ttl_sec=QUERY_CACHE_TTL_SEC, dependents=VIEW_DEPENDENCIES)
+    st_db = DBWrapper('SMART_TRADING', cache=query_cache)
     earnings_bootstrap = args.earnings_bootstrap
     stock_index = args.stock_index
-    ern = Earnings(st_db=st_db, st_logger=st_logger, historical_earnings=earnings_bootstrap)
-    ern.load_earnings_all_tickers(stock_index)
+    metrics = None
+    if args.write_metrics:
+        metrics = get_metrics('Earnings', os.path.join(METRICS_PATH, 'extract_earnings_{}'.format(
+            dt.datetime.now().strftime('%Y%m%d_%H%M%S'))))
+    cache = None
+    if args.use_cache or args.replay:
+        cache = ResponseCache(RESPONSE_CACHE_PATH, ttl_sec=RESPONSE_CACHE_TTL_SEC,
+                              max_bytes=RESPONSE_CACHE_MAX_BYTES, replay=args.replay)
+    ern = Earnings(st_db=st_db, st_logger=st_logger, historical_earnings=earnings_bootstrap,
+                   db_batch_size=args.db_batch_size, diff_upsert=args.diff_upsert, cache=cache,
+                   calls_per_min=args.earnings_calls_per_min, n_workers=args.earnings_workers,
+                   metrics=metrics)
+    with st_db.session():
+        ern.load_earnings_all_tickers(stock_index)
+    st_db.close()
+    if args.write_metrics:
+        summary = metrics.write_summary()
+        st_logger.info('Wrote run metrics to {}: {}'.format(metrics.metrics_dir, summary['timers']))
@@ -6,18 +6,67 @@ and extracting historical stock prices and writing
 import pandas as pd
 import numpy as np
 import os
-from string import digits
 import datetime as dt
 from alpha_vantage.timeseries import TimeSeries
-from multiprocessing import Pool, cpu_count
-import time
+from multiprocessing import cpu_count
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import asyncio
 
 from constants import *
 from args import parse_args
+from rate_limiter import TokenBucket
+from av_parser import parse_av_payload, select_spans, to_frame, arrays_to_shm, shared_frame
+from gaps import GapScanner
+from partitions import PARTITIONED, VIEW_DEPENDENCIES, PartitionManager, TickerIds
+from trading_calendar import TradingCalendar
+from rollups import Rollup
+from universe import Universe
 from libs.st_logger.logger import logger
+from libs.st_logger.metrics import get_metrics
 from libs.PyDB.DBWrapper import DBWrapper
+from libs.PyDB.QueryCache import QueryCache
+from libs.st_cache.response_cache import ResponseCache
+from libs.st_spool.spool import Spool, SpoolWriter
 import auth
 
+
+# Stock objects of a worker process by price type, set once when the worker starts
+_worker_stocks = {}
+
+# Attributes of a Stock that workers fetch and parse prices with, everything else stays in the parent
+WORKER_FIELDS = ['logger', 'price_type', 'ts', 'after_hours', 'cache', 'calls_per_min', 'metrics']
+
+
+def init_worker(stocks):
+    '''Process pool initializer, so tasks only carry a small descriptor instead of the Stock
+
+    Parameters
+    ----------
+    stocks : dict[str, Stock]
+        Worker copies of Stock objects by price type, as built by Stock._for_worker
+    '''
+    _worker_stocks.update(stocks)
+
+
+def fetch_shared(task):
+    '''Fetch and parse prices in a worker, returning a shared memory descriptor of the arrays
+
+    Parameters
+    ----------
+    task : tuple
+        Price type, ticker, outputsize, start date, high-water mark and gap spans, as
+        built by Stock._task
+
+    Returns
+    -------
+    tuple
+        Shared memory descriptor, None if the fetch failed
+    '''
+    price_type, stock_ticker, outputsize, start, hwm, spans = task
+    arrays = _worker_stocks[price_type]._fetch_arrays(stock_ticker, outputsize, start, hwm, spans)
+    return None if arrays is None else arrays_to_shm(arrays)
+
+
 class Stock(object):
     '''
     A class to represent stock tickers and their prices
@@ -48,25 +97,68 @@ class Stock(object):
         True if output is to be written in database
     st_db : PyDB.DBWrapper.DBWrappper
         DBWrapper object for interacting with database
+    db_batch_size : int
+        rows per multi-row upsert statement when writing to database
+    load_infile : bool
+        True if database writes are to be staged through LOAD DATA LOCAL INFILE
+    diff_upsert : bool
+        True if only new or changed rows are to be written to database, by content hash
+    calls_per_min : int
+        AlphaVantage API calls allowed per minute for the API key
+    incremental : bool
+        True if only prices newer than the latest stored per ticker are to be extracted
+    high_water_marks : dict[str, pandas.Timestamp]
+        latest stored price timestamp per ticker, populated in incremental mode
+    cache : st_cache.response_cache.ResponseCache
+        on-disk cache of API payloads, None to always call the API
+    parquet_store : PriceStore.ParquetStore.ParquetStore
+        columnar price store to append prices to, None to skip
+    price_store : PriceStore.PriceStore.PriceStore
+        in-memory price store to append prices to, None to skip
+    rollup : rollups.Rollup
+        rollup maintainer updated after every intraday write to database, None to skip
+    metrics : st_logger.metrics.Metrics
+        registry of per stage timings and counters, reported by worker processes too
+    spool : st_spool.spool.Spool
+        durable spool of fetched prices drained to database in the background, None to
+        write to database directly
+    ticker_ids : partitions.TickerIds
+        ticker id dimension of the partitioned price tables, None if prices are stored
+        by ticker
+    calendar : trading_calendar.TradingCalendar
+        exchange session calendar
+    gap_spans : dict[str, list[tuple]]
+        (start, end) spans of bars missing per ticker, set by backfill() to fetch only those
 
     Methods
     -------
     update_tickers_db()
-        reads tickers list in the given index from Wiki and writes to database
-    get_tickers_from_index()
-        reads list of tickers in the given index from database
+        records additions and removals of the given index from Wiki in database
+    get_tickers_from_index(as_of=None)
+        reads list of tickers in the given index on a date from database
+    get_high_water_marks()
+        reads latest stored price timestamp per ticker from database
     get_prices_av(stock_ticker)
         extracts stock price for gven ticker using AlphaVantage API
     write_to_db(ticker_prices)
         write ticker prices to database
     write_to_csv(ticker_prices, today)
         write ticker prices to csv in the folder under directory specified in config
+    write_to_parquet(ticker_prices)
+        append ticker prices to the columnar price store
+    get_list_stock_prices()
+        extracts and saves prices for all tickers, paced by the API rate limit
+    backfill()
+        extracts and saves only bars missing from database since the start date
     '''
 
     def __init__(self, tickers_list=[],stock_index=None,
                  price_type=None, ts=None, after_hours=False, 
                  start_date=None, write_csv=False, write_db=False,
-                 st_db=None, st_logger=None):
+                 st_db=None, st_logger=None, db_batch_size=DB_BATCH_SIZE,
+                 load_infile=False, diff_upsert=False, calls_per_min=AV_CALLS_PER_MIN, incremental=False,
+                 cache=None, parquet_store=None, price_store=None, rollup=None,
+                 metrics=None, spool=None, ticker_ids=None):
         '''
         Parameters
         ----------
@@ -90,6 +182,34 @@ class Stock(object):
             DBWrapper object for interacting with database (default=None)
         st_logger : st_logger.logger
             An object of class logger
+        db_batch_size : int, optional
+            Rows per multi-row upsert statement when writing to database (default from config)
+        load_infile : bool, optional
+            True if database writes are to be staged through LOAD DATA LOCAL INFILE (default=False)
+        diff_upsert : bool, optional
+            True if only new or changed rows are to be written to database, for full reloads
+            that mostly repeat stored history (default=False)
+        calls_per_min : int, optional
+            AlphaVantage API calls allowed per minute for the API key (default from config)
+        incremental : bool, optional
+            True if only prices newer than the latest stored per ticker are to be extracted,
+            requires st_db (default=False)
+        cache : st_cache.response_cache.ResponseCache, optional
+            On-disk cache of API payloads, None to always call the API (default=None)
+        parquet_store : PriceStore.ParquetStore.ParquetStore, optional
+            Columnar price store to append prices to, None to skip (default=None)
+        price_store : PriceStore.PriceStore.PriceStore, optional
+            In-memory price store to append prices to, None to skip (default=None)
+        rollup : rollups.Rollup, optional
+            Rollup maintainer updated after every intraday write to database (default=None)
+        metrics : st_logger.metrics.Metrics, optional
+            Registry of per stage timings and counters, kept in memory only if missing
+        spool : st_spool.spool.Spool, optional
+            Durable spool of fetched prices drained to database in the background, which
+            also records completed tickers to resume interrupted runs (default=None)
+        ticker_ids : partitions.TickerIds, optional
+            Ticker id dimension, to write prices to the partitioned tables once migrated
+            with partitions.py (default=None)
         '''
         self.logger = st_logger
         self.tickers_df = None
@@ -109,15 +229,23 @@ class Stock(object):
         self.write_csv = write_csv
         self.write_db = write_db
         self.st_db = st_db
+        self.db_batch_size = db_batch_size
+        self.load_infile = load_infile
+        self.diff_upsert = diff_upsert
+        self.calls_per_min = calls_per_min
+        self.incremental = incremental
+        self.high_water_marks = {}
+        self.cache = cache
+        self.parquet_store = parquet_store
+        self.price_store = price_store
+        self.rollup = rollup
+        self.metrics = metrics or get_metrics('ExtractPrices')
+        self.spool = spool
+        self.ticker_ids = ticker_ids
+        self.calendar = TradingCalendar()
+        self.gap_spans = {}
         
 
-    def _remove_digits(self, input_str):
-        '''Removes digits from input string'''
-        remove_digits = str.maketrans('', '', digits)
-        res = input_str.translate(remove_digits)
-        return res
-
-
     def _check_start_date_format(self):
         '''Check if start date provided else set default start date'''
         if not self.start_date:
@@ -146,57 +274,101 @@ class Stock(object):
             ValueError('Check "start_date" format - should be passed as "yyyy-mm-dd" string.')
 
         
-    def _refresh_tickers_index(self):
-        '''Get the list of all stocks in a given index'''
-        if self.stock_index == 'SP500':
-            self.logger.info('Getting stock tickers for SP500 from Wiki .....')
-            payload = pd.read_html('https://en.wikipedia.org/wiki/List_of_S%26P_500_companies', header=0)
-            self.tickers_df = payload[0]
-            self.tickers_df = self.tickers_df.rename({'Symbol':'Ticker'}, axis=1)
-            if not (len(self.tickers_df.index) > SP500_LL) and (len(self.tickers_df.index) < SP500_UL):
-                ValueError('Check wikipedia data source for SP 500 at \
-                             https://en.wikipedia.org/wiki/List_of_S%26P_500_companies')
-            self.logger.info('Fetched stock tickers from SP500.')
-            
-        elif self.stock_index == 'NASDAQ':
-            self.logger.info('Getting stock tickers for NASDAQ from Wiki .....')
-            payload = pd.read_html('https://en.wikipedia.org/wiki/NASDAQ-100#Components', header=0)
-            self.tickers_df = payload[3]
-            if not (len(self.tickers_df.index) > NASDAQ_LL) and (len(self.tickers_df.index) < NASDAQ_UL):
-                ValueError('Check wikipedia data source for NASDAQ at \
-                             https://en.wikipedia.org/wiki/NASDAQ-100#Components')
-            self.logger.info('Fetched stock tickers from NASDAQ.')
+    def update_tickers_db(self):
+        '''Record additions and removals of the index in the membership table'''
+        Universe(self.st_db, self.logger, self.cache).refresh(self.stock_index)
 
 
-    def update_tickers_db(self):
-        '''Write updated tickers to database'''
-        self._refresh_tickers_index()
-        if self.stock_index == 'SP500':
-            df = self.tickers_df.rename({'Symbol': 'ticker', 'Security': 'company'},
-                                        axis=1)
-            df['stock_index'] = 'SP500'
-            self.st_db.executeWriteQuery(df[['ticker', 'company', 'stock_index']], 
-                                         'tickers')
-        elif self.stock_index == 'NASDAQ':
-            df = self.tickers_df.rename({'Company': 'company', 'Ticker': 'ticker'}, 
-                                        axis=1)
-            df['stock_index'] = 'NASDAQ'
-            self.st_db.executeWriteQuery(df, 'tickers')
-        
+    def get_tickers_from_index(self, as_of=None):
+        '''Read tickers in given index on a date from database, today by default'''
+        self.tickers_list = Universe(self.st_db, self.logger).get_members(self.stock_index, as_of)
+        self.tickers_df = pd.DataFrame({'ticker': self.tickers_list, 'stock_index': self.stock_index})
 
 
-    def get_tickers_from_index(self):
-        '''Read tickers in given index from database'''
+    def get_high_water_marks(self):
+        '''Read latest stored price timestamp per ticker in one query'''
+        if self.price_type == 'daily':
+            table, ts_col = 'daily_prices', 'dt'
+        elif self.price_type == 'intraday':
+            table, ts_col = 'intraday_prices', 'ts'
+        else:
+            raise ValueError('"price_type" must be one of "intraday" or "daily".')
+        if len(self.tickers_list) == 0:
+            self.high_water_marks = {}
+            return
         qry = '''
         SELECT
-            *
+            ticker, MAX({ts_col}) AS hwm
         FROM
-            SMART_TRADING.tickers
-        WHERE 
-            stock_index = '{}'
-        '''.format(self.stock_index)
-        self.tickers_df = self.st_db.executeReadQuery(qry)
-        self.tickers_list = list(self.tickers_df['ticker'])
+            SMART_TRADING.{table}
+        WHERE
+            ticker IN ({tickers})
+        GROUP BY
+            ticker
+        '''.format(ts_col=ts_col, table=table, tickers=', '.join(['%s'] * len(self.tickers_list)))
+        hwm_df = self.st_db.executeReadQuery(qry, tuple(self.tickers_list))
+        self.high_water_marks = dict(zip(hwm_df['ticker'], pd.to_datetime(hwm_df['hwm'])))
+        self.logger.info('Found stored prices for {} of {} tickers.'.format(
+            len(self.high_water_marks), len(self.tickers_list)))
+
+
+    def _bars_since(self, hwm):
+        '''Upper bound of bars published after the high-water mark, up to today'''
+        today = dt.date.today()
+        next_day = (hwm + pd.Timedelta(days=1)).date()
+        n_days = int(np.busday_count(next_day, today + dt.timedelta(days=1)))
+        if self.price_type == 'daily':
+            return n_days
+        session_end = hwm.normalize() + pd.Timedelta(hours=INTRADAY_SESSION_END_HOUR)
+        left_on_day = max(int((session_end - hwm) / pd.Timedelta(minutes=15)), 0)
+        return left_on_day + n_days * INTRADAY_BARS_PER_DAY
+
+
+    def _get_outputsize(self, stock_ticker):
+        '''Use compact output if it covers all bars since the last stored one'''
+        spans = self.gap_spans.get(stock_ticker)
+        if spans:
+            # AlphaVantage counts pre-market and after-hours bars towards compact output
+            now = pd.Timestamp.now(tz=MARKET_TZ).tz_localize(None)
+            n_bars = len(self.calendar.grid(self.price_type, spans[0][0], now, after_hours=True))
+            return 'compact' if n_bars <= AV_COMPACT_SIZE else 'full'
+        hwm = self.high_water_marks.get(stock_ticker)
+        if self.incremental and hwm is not None and self._bars_since(hwm) < AV_COMPACT_SIZE:
+            return 'compact'
+        return 'full'
+
+
+    def _is_cached(self, stock_ticker):
+        '''True if the API payload for ticker can be served from cache'''
+        return self.cache is not None and self.cache.contains(
+            'alphavantage', self.price_type, stock_ticker,
+            {'outputsize': self._get_outputsize(stock_ticker)})
+
+
+    def _fetch_prices_av(self, stock_ticker, outputsize):
+        '''Call the API for ticker prices, through the response cache if enabled'''
+        if self.price_type == 'intraday':
+            fetch_fn = lambda: self.ts.get_intraday(stock_ticker, outputsize=outputsize)
+        else:
+            fetch_fn = lambda: self.ts.get_daily(stock_ticker, outputsize=outputsize)
+        if self.cache is None:
+            return fetch_fn()
+        return self.cache.fetch('alphavantage', self.price_type, stock_ticker,
+                                {'outputsize': outputsize}, fetch_fn)
+
+
+    def _task(self, stock_ticker):
+        '''Descriptor of one fetch, built in the parent where high-water marks are current'''
+        hwm = self.high_water_marks.get(stock_ticker) if self.incremental else None
+        return (self.price_type, stock_ticker, self._get_outputsize(stock_ticker),
+                self.start_date, hwm, self.gap_spans.get(stock_ticker))
+
+
+    def _for_worker(self):
+        '''Copy holding only WORKER_FIELDS, sent once to every worker process'''
+        worker = Stock.__new__(Stock)
+        worker.__dict__.update({name: getattr(self, name) for name in WORKER_FIELDS})
+        return worker
 
 
     def get_prices_av(self, stock_ticker):
@@ -212,34 +384,41 @@ class Stock(object):
         ValueError 
             If price_type not in 'intraday' or 'daily'
         '''
-        if self.price_type in ['intraday', 'daily']:
-            try:
-                if self.price_type == 'intraday':
-                    price, _ = self.ts.get_intraday(stock_ticker, outputsize='full')
-                elif self.price_type == 'daily':
-                    price, _ = self.ts.get_daily(stock_ticker, outputsize='full')
-                price_df = pd.DataFrame(price).transpose()
-            except:
-                self.logger.info('{ticker}: Skipped by Alphavantage.'.format(ticker=stock_ticker))
-                price_df = pd.DataFrame(columns=['index', '1. open', '2. high', '3. low',
-                     '4. close', '5. volume']).set_index('index')
-        else:
-            ValueError('"price_type" must be one of "intraday" or "daily".')
-        
-        price_df.index = pd.to_datetime(price_df.index)
-        price_df = price_df[price_df.index >= self.start_date]
-        if self.price_type == 'intraday' and not self.after_hours:
+        _, _, outputsize, start, hwm, spans = self._task(stock_ticker)
+        arrays = self._fetch_arrays(stock_ticker, outputsize, start, hwm, spans)
+        return to_frame(stock_ticker, parse_av_payload({}) if arrays is None else arrays)
+
+
+    def _fetch_arrays(self, stock_ticker, outputsize, start, hwm, spans):
+        '''Fetch and parse prices of one ticker into arrays, None if the fetch failed'''
+        if self.price_type not in ['intraday', 'daily']:
+            raise ValueError('"price_type" must be one of "intraday" or "daily".')
+
+        session_only = self.price_type == 'intraday' and not self.after_hours
+        if session_only:
             self.logger.info('''{ticker}: Truncating pre-market and after-hours data.
                         '''.format(ticker=stock_ticker))
-            price_df = price_df[(price_df.index.time>=dt.time(9,30)) & 
-                                (price_df.index.time<=dt.time(16,0))]
-
-        price_df.columns = [self._remove_digits(col) for col in price_df.columns]
-        price_df.columns = [col.replace('. ', '') for col in price_df.columns]
-        price_df['ticker'] = stock_ticker
-        price_df = price_df.reset_index().rename({'index':'dt'}, axis=1) \
-            .set_index(['ticker', 'dt'])
-        return price_df
+        labels = {'price_type': self.price_type}
+        try:
+            with self.metrics.timer('fetch', outputsize=outputsize, **labels):
+                price, _ = self._fetch_prices_av(stock_ticker, outputsize)
+            with self.metrics.timer('parse', **labels):
+                arrays = parse_av_payload(price, start=start, after=hwm,
+                                          session_only=session_only)
+                if spans:
+                    arrays = select_spans(arrays, spans)
+        except:
+            self.logger.info('{ticker}: Skipped by Alphavantage.'.format(ticker=stock_ticker))
+            self.metrics.inc('tickers_skipped', **labels)
+            self.metrics.flush()
+            return None
+        if hwm is not None:
+            self.logger.info('{ticker}: {n} new prices after {hwm} ({o} output).'.format(
+                ticker=stock_ticker, n=len(arrays.ts), hwm=hwm, o=outputsize))
+        self.metrics.inc('rows_fetched', len(arrays.ts), **labels)
+        # Runs in pool workers, which report through their per process file
+        self.metrics.flush()
+        return arrays
 
 
     def write_to_db(self, ticker_prices):
@@ -254,18 +433,66 @@ class Stock(object):
         ------
         ValueError
             If price_type not in 'intraday' or 'daily'
+
+        Returns
+        -------
+        bool
+            True if the prices were written, failures are logged and counted
         '''
         try:
-            if self.price_type == 'daily':
-                self.st_db.executeWriteQuery(ticker_prices, 'daily_prices', index=True)
-            elif self.price_type == 'intraday':
-                ticker_prices.index.names = ['ticker', 'ts']
-                self.st_db.executeWriteQuery(ticker_prices, 'intraday_prices', index=True)
-            else:
-                ValueError('"price_type" must be in "daily" or "intraday"')
+            ticker_prices = self._write_prices_db(ticker_prices)
         except:
             ticker = ticker_prices.index.levels[0][0]
             self.logger.info('{}: Could not write to DB.'.format(ticker))
+            self.metrics.inc('db_write_errors', price_type=self.price_type)
+            return False
+        self._update_rollups(ticker_prices)
+        return True
+
+
+    def _write_prices_db(self, ticker_prices):
+        '''Upsert prices of one or more tickers, raising on failure'''
+        if self.price_type == 'daily':
+            table = 'daily_prices'
+        elif self.price_type == 'intraday':
+            table = 'intraday_prices'
+            ticker_prices = ticker_prices.rename_axis(['ticker', 'ts'])
+        else:
+            raise ValueError('"price_type" must be in "daily" or "intraday"')
+        rows = ticker_prices
+        if self.ticker_ids is not None:
+            table = PARTITIONED[self.price_type]['table']
+            rows = self.ticker_ids.to_bars(ticker_prices)
+        with self.metrics.timer('db_write', price_type=self.price_type):
+            if self.diff_upsert:
+                stats = self.st_db.executeDiffWriteQuery(rows, table,
+                                                         key_cols=list(rows.index.names),
+                                                         index=True, batch_size=self.db_batch_size)
+                for count in ['inserted', 'updated', 'unchanged']:
+                    self.metrics.inc('rows_' + count, stats[count], price_type=self.price_type)
+            else:
+                stats = self.st_db.executeWriteQuery(rows, table, index=True,
+                                                     batch_size=self.db_batch_size,
+                                                     load_infile=self.load_infile)
+        self.metrics.inc('rows_written_db', stats['rows'], price_type=self.price_type)
+        return ticker_prices
+
+
+    def _update_rollups(self, ticker_prices):
+        '''Update rollups touched by written intraday prices, one ticker at a time'''
+        if self.price_type != 'intraday' or self.rollup is None:
+            return
+        for ticker, bars in ticker_prices.groupby(level=0, sort=False):
+            try:
+                with self.metrics.timer('rollup_update'):
+                    self.rollup.update(bars)
+            except:
+                self.logger.info('{}: Could not update rollups.'.format(ticker))
+
+
+    def _write_spooled(self, prices):
+        '''Write a batch of spooled prices of many tickers, raising so the batch is retried'''
+        self._update_rollups(self._write_prices_db(prices))
 
 
     def write_to_csv(self, ticker_prices, today):
@@ -287,12 +514,103 @@ class Stock(object):
         try:
             filepath = PRICE_STORE_PATH + ticker + '_' + \
                        self.price_type + '_' + today + '.csv'
-            ticker_prices.to_csv(filepath, index=True)
+            with self.metrics.timer('csv_write', price_type=self.price_type):
+                ticker_prices.to_csv(filepath, index=True)
             self.logger.info('{}: Saved prices.'.format(ticker))
         except:
             self.logger.warning('{}: Could not save prices.'.format(ticker))
     
 
+    def write_to_parquet(self, ticker_prices):
+        '''Appends ticker prices to the columnar price store
+
+        Attributes
+        ----------
+        ticker_prices : pd.DataFrame
+            A dataframe of extracted prices to append
+        '''
+        ticker = ticker_prices.index.get_level_values('ticker')[0]
+        try:
+            with self.metrics.timer('parquet_write', price_type=self.price_type):
+                self.parquet_store.append(ticker_prices, self.price_type)
+            self.logger.info('{}: Appended prices to parquet store.'.format(ticker))
+        except:
+            self.logger.warning('{}: Could not append prices to parquet store.'.format(ticker))
+
+
+    def _save_prices(self, stock_ticker, ticker_prices, today):
+        '''Write extracted prices of one ticker to the enabled outputs
+
+        With a spool, database writes are left to the spool writer, and the ticker is
+        recorded as completed only after all other outputs are written. Returns False
+        if a direct database write failed, so callers keep their high water marks.
+        '''
+        written = True
+        if len(ticker_prices.index) > 0:
+            if self.write_db and self.spool is None:
+                written = self.write_to_db(ticker_prices)
+            if self.write_csv:
+                self.write_to_csv(ticker_prices, today)
+            if self.parquet_store is not None:
+                self.write_to_parquet(ticker_prices)
+            if self.price_store is not None:
+                self.price_store.append_frame(ticker_prices)
+        if self.spool is not None:
+            with self.metrics.timer('spool_write', price_type=self.price_type):
+                self.spool.put(self._run, stock_ticker,
+                               ticker_prices if self.write_db else ticker_prices.iloc[:0])
+            self._spool_writer.notify()
+        return written
+
+
+    async def _extract_and_save(self, stock_ticker, today, slots):
+        '''Fetch and parse prices in a worker process, then save on the writer thread
+
+        Workers receive a small task descriptor and hand back parsed arrays in shared
+        memory, which are saved in place, so neither the Stock nor the frames are
+        pickled or copied per ticker. The
+        worker slot is released once the fetch is done, before saving.
+        '''
+        loop = asyncio.get_running_loop()
+        try:
+            shared = await loop.run_in_executor(self.pool, fetch_shared, self._task(stock_ticker))
+        finally:
+            slots.release()
+        if shared is None:
+            # Not saved, so a spooled run resumed later retries the ticker
+            return
+        with shared_frame(stock_ticker, shared) as ticker_prices:
+            await loop.run_in_executor(self._writer, self._save_prices, stock_ticker,
+                                       ticker_prices, today)
+
+
+    async def _extract_all(self, tickers_list, today, n_workers):
+        '''Dispatch one request per ticker as soon as the rate limiter has a token
+
+        Requests already dispatched are parsed and written while the dispatcher
+        waits for the next token, so wall time is bound by the API quota. At most
+        one request per worker is in flight, taking its token only once a worker is
+        free, so requests queued behind busy workers never start back to back.
+        '''
+        bucket = TokenBucket(self.calls_per_min)
+        slots = asyncio.Semaphore(n_workers)
+        tasks = []
+        for stock_ticker in tickers_list:
+            await slots.acquire()
+            # Cached payloads do not use API quota, and replay never calls the API
+            if self._is_cached(stock_ticker):
+                self.metrics.inc('cache_hits', price_type=self.price_type)
+            elif self.cache is None or not self.cache.replay:
+                self.metrics.observe('rate_limit_wait', await bucket.acquire_async())
+            tasks.append(asyncio.ensure_future(self._extract_and_save(stock_ticker, today, slots)))
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        for stock_ticker, res in zip(tickers_list, results):
+            if isinstance(res, Exception):
+                self.logger.warning('{}: Could not extract prices - {}'.format(stock_ticker, res))
+                self.metrics.inc('tickers_failed', price_type=self.price_type)
+        self.logger.info('Waited {} sec in total for API quota.'.format(round(bucket.wait_sec, 2)))
+
+
     def get_list_stock_prices(self):
         '''Fetch stock price for list of tickers
 
@@ -305,42 +623,84 @@ class Stock(object):
         if not self.tickers_list:
             raise KeyError('tickers_list not provided, either pass as argument or \
                 call get_tickers_from_index() method with index name to fetch tickers.')
-        n_proc = max(cpu_count()-1, 4)
-        self.pool = Pool(n_proc)
+        if self.incremental:
+            self.get_high_water_marks()
+        n_proc = max(cpu_count()-1, 1)
         today = dt.date.today().strftime('%Y_%m_%d')
-        if not os.path.isdir(PRICE_STORE_PATH):
+        if self.write_csv and not os.path.isdir(PRICE_STORE_PATH):
             os.mkdir(PRICE_STORE_PATH)
             self.logger.info('Created directory to save csvs: {}'.format(PRICE_STORE_PATH))
-        
-        # Split into chunks of no more than 5 since Alpha Vantage API takes 5 calls per min 
-        tickers_list_chunked = [self.tickers_list[i:i+n_proc] 
-                                for i in range(0, len(self.tickers_list), n_proc)]
-        for chunk in tickers_list_chunked:
-            prices_df_list = self.pool.map_async(self.get_prices_av, chunk).get()
-            t_start = time.time()
-
-            if self.write_db:
-                for ticker_prices in prices_df_list:
-                    if len(ticker_prices.index) > 0:
-                        self.write_to_db(ticker_prices)
-            
-            if self.write_csv:
-                for ticker_prices in prices_df_list:
-                    if len(ticker_prices.index) > 0:
-                        self.write_to_csv(ticker_prices, today)
-
-            t_elapsed = round(time.time() - t_start, 2)
-            if t_elapsed < SLEEP_TIME_SEC:
-                self.logger.info("System sleep {} sec ....".format(SLEEP_TIME_SEC - t_elapsed))
-                time.sleep(SLEEP_TIME_SEC - t_elapsed)
 
-        self.pool.close()
-        self.pool.join() 
+        tickers_list = self.tickers_list
+        if self.spool is not None:
+            # Resume an interrupted run of the day, its spooled prices are drained first
+            self._run = '{}_{}{}'.format(self.price_type, today,
+                                         '_backfill' if self.gap_spans else '')
+            completed = self.spool.completed_tickers(self._run)
+            tickers_list = [t for t in tickers_list if t not in completed]
+            if completed:
+                self.logger.info('Resuming run {}: {} of {} tickers already completed.'.format(
+                    self._run, len(self.tickers_list) - len(tickers_list), len(self.tickers_list)))
+            self._spool_writer = SpoolWriter(self.spool, self._write_spooled, self.logger,
+                                             batch_rows=SPOOL_BATCH_ROWS,
+                                             max_retries=SPOOL_MAX_RETRIES)
+            self._spool_writer.start()
+
+        # Workers fetch and parse, a single writer thread saves results in the meantime
+        self.pool = ProcessPoolExecutor(n_proc, initializer=init_worker,
+                                        initargs=({self.price_type: self._for_worker()},))
+        self._writer = ThreadPoolExecutor(1)
+        try:
+            asyncio.run(self._extract_all(tickers_list, today, n_proc))
+        finally:
+            self._writer.shutdown(wait=True)
+            self.pool.shutdown(wait=True)
+            if self.spool is not None:
+                drained = self._spool_writer.stop()
+        if self.spool is not None:
+            completed = self.spool.completed_tickers(self._run)
+            complete = drained and completed.issuperset(self.tickers_list)
+            if not complete:
+                self.logger.warning('Run {} incomplete, rerun to resume from the spool.'.format(
+                    self._run))
+            # Records of earlier runs are dropped even if a ticker of theirs never completed
+            self.spool.compact(keep_runs=() if complete else (self._run,))
+
+
+    def backfill(self):
+        '''Fetch and save only the bars missing from database since the start date
+
+        Stored prices are scanned for gaps against the session calendar, and only tickers
+        with gaps are fetched, with compact output when it reaches back to the first gap.
+        Fetched bars outside the gaps are dropped, so repairs do not rewrite stored history.
+        '''
+        self._check_start_date_format()
+        spans = GapScanner(self.st_db, self.logger, self.calendar).scan(
+            self.price_type, self.tickers_list, self.start_date, after_hours=self.after_hours)
+        self.gap_spans = {ticker: list(zip(ticker_spans['start'], ticker_spans['end']))
+                          for ticker, ticker_spans in spans.groupby('ticker', sort=False)}
+        if not self.gap_spans:
+            self.logger.info('No missing {} prices to backfill.'.format(self.price_type))
+            return
+        tickers_list, incremental = self.tickers_list, self.incremental
+        self.tickers_list, self.incremental = list(self.gap_spans), False
+        try:
+            self.get_list_stock_prices()
+        finally:
+            self.tickers_list, self.incremental = tickers_list, incremental
+            self.gap_spans = {}
 
     
     def __getstate__(self):
         self_dict = self.__dict__.copy()
-        del self_dict['pool']
+        self_dict.pop('pool', None)
+        self_dict.pop('_writer', None)
+        self_dict.pop('spool', None)
+        self_dict.pop('_spool_writer', None)
+        # Outputs are written by the parent only, so workers are not sent the stores
+        self_dict.pop('parquet_store', None)
+        self_dict.pop('price_store', None)
+        self_dict.pop('rollup', None)
         return self_dict
 
 
@@ -358,14 +718,68 @@ if __name__=='__main__':
     start_date = args.start_date
     write_csv = args.write_csv
     write_db = args.write_db
-    st_db = DBWrapper('SMART_TRADING')
+    db_batch_size = args.db_batch_size
+    load_infile = args.load_infile
+    diff_upsert = args.diff_upsert
+    calls_per_min = args.calls_per_min
+    incremental = args.incremental
+    metrics = None
+    if args.write_metrics:
+        metrics = get_metrics('ExtractPrices', os.path.join(METRICS_PATH, 'extract_prices_{}_{}'.format(
+            price_type, dt.datetime.now().strftime('%Y%m%d_%H%M%S'))))
+    spool = Spool(os.path.join(SPOOL_PATH, str(price_type))) if args.spool else None
+    cache = None
+    if args.use_cache or args.replay:
+        cache = ResponseCache(RESPONSE_CACHE_PATH, ttl_sec=RESPONSE_CACHE_TTL_SEC,
+                              max_bytes=RESPONSE_CACHE_MAX_BYTES, replay=args.replay)
+    parquet_store = None
+    if args.write_parquet or args.compact_store:
+        from libs.PriceStore.ParquetStore import ParquetStore
+        parquet_store = ParquetStore(PARQUET_STORE_PATH)
+    price_store = None
+    snapshot_path = os.path.join(PRICE_SNAPSHOT_PATH, str(price_type))
+    if args.update_snapshot:
+        from libs.PriceStore.PriceStore import PriceStore
+        if os.path.isdir(snapshot_path):
+            price_store = PriceStore.restore(snapshot_path)
+        else:
+            price_store = PriceStore()
+    query_cache = None
+    if args.query_cache:
+        query_cache = QueryCache(QUERY_CACHE_MAX_BYTES, cache_dir=QUERY_CACHE_PATH,
+                                 disk_max_bytes=QUERY_CACHE_DISK_MAX_BYTES,
+                                 ttl_sec=QUERY_CACHE_TTL_SEC, dependents=VIEW_DEPENDENCIES)
+    st_db = DBWrapper('SMART_TRADING', cache=query_cache)
+    rollup = Rollup(st_db=st_db, st_logger=st_logger) if args.update_rollups else None
+    ticker_ids = None
+    if PartitionManager(st_db, st_logger).is_partitioned(price_type):
+        ticker_ids = TickerIds(st_db)
     ts = TimeSeries()
     s = Stock(tickers_list=tickers_list, stock_index=stock_index,
               price_type=price_type, ts=ts, after_hours=after_hours, 
               start_date=start_date, write_csv=write_csv, write_db=write_db,
-              st_db=st_db, st_logger=st_logger)
-    if not s.tickers_list:
-        s.get_tickers_from_index()
-        st_logger.info('Extracted stock tickers from Index: {}'.format(s.stock_index))
-    s.get_list_stock_prices()
+              st_db=st_db, st_logger=st_logger, db_batch_size=db_batch_size,
+              load_infile=load_infile, diff_upsert=diff_upsert, calls_per_min=calls_per_min,
+              incremental=incremental, cache=cache,
+              parquet_store=parquet_store if args.write_parquet else None,
+              price_store=price_store, rollup=rollup, metrics=metrics, spool=spool,
+              ticker_ids=ticker_ids)
+    with st_db.session():
+        if args.refresh_universe:
+            s.update_tickers_db()
+        if not s.tickers_list:
+            s.get_tickers_from_index(as_of=args.as_of)
+            st_logger.info('Extracted stock tickers from Index: {}'.format(s.stock_index))
+        if args.backfill:
+            s.backfill()
+        else:
+            s.get_list_stock_prices()
+    st_db.close()
+    if args.compact_store:
+        parquet_store.compact(price_type)
+    if args.update_snapshot:
+        price_store.snapshot(snapshot_path)
+    if args.write_metrics:
+        summary = metrics.write_summary()
+        st_logger.info('Wrote run metrics to {}: {}'.format(metrics.metrics_dir, summary['timers']))
 
@@ -0,0 +1,182 @@
+'''
+This module finds bars missing from intraday_prices and daily_prices against the exchange
+session calendar, as a minimal list of (ticker, start, end) spans to backfill.
+'''
+
+import datetime as dt
+import numpy as np
+import pandas as pd
+
+from constants import *
+from args import parse_args
+from trading_calendar import TradingCalendar
+from universe import Universe
+from libs.st_logger.logger import logger
+from libs.PyDB.DBWrapper import DBWrapper
+
+PRICE_TABLES = {'intraday': ('intraday_prices', 'ts'), 'daily': ('daily_prices', 'dt')}
+SPAN_COLS = ['ticker', 'start', 'end', 'bars']
+
+
+def find_spans(grid, tickers, stored_tickers, stored_ts, first_bars=None):
+    '''Spans of consecutive grid bars missing per ticker, in one vectorized pass
+
+    Stored bars are placed on a (ticker x grid) bitmap, so runs of missing bars are
+    the runs of unset positions, split where the ticker changes. Grid bars before the
+    first stored bar of a ticker are not counted as missing.
+
+    Parameters
+    ----------
+    grid : pandas.DatetimeIndex
+        Sorted, unique timestamps of all expected bars
+    tickers : list[str]
+        Tickers to scan
+    stored_tickers, stored_ts : array-like
+        Ticker and timestamp of every stored bar, bars off the grid are ignored
+    first_bars : array-like, optional
+        First stored bar of every ticker in tickers, NaT for tickers without bars,
+        the whole grid is scanned by default
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per span with ticker, first and last missing bar and bar count
+    '''
+    n = len(grid)
+    codes = pd.Index(tickers).get_indexer(stored_tickers)
+    pos = grid.get_indexer(pd.DatetimeIndex(stored_ts))
+    on_grid = (codes >= 0) & (pos >= 0)
+    missing = np.ones(len(tickers) * n, dtype=bool)
+    missing[codes[on_grid] * n + pos[on_grid]] = False
+    if first_bars is not None:
+        first_bars = pd.DatetimeIndex(first_bars)
+        first_pos = np.where(first_bars.isna(), 0, grid.searchsorted(first_bars.fillna(grid[0])))
+        missing.reshape(len(tickers), n)[np.arange(n) < first_pos[:, None]] = False
+    idx = np.flatnonzero(missing)
+    if len(idx) == 0:
+        return pd.DataFrame(columns=SPAN_COLS)
+    breaks = np.flatnonzero((np.diff(idx) != 1) | (np.diff(idx // n) != 0)) + 1
+    first = idx[np.r_[0, breaks]]
+    last = idx[np.r_[breaks, len(idx)] - 1]
+    return pd.DataFrame({'ticker': np.asarray(tickers, dtype=object)[first // n],
+                         'start': grid[first % n], 'end': grid[last % n],
+                         'bars': last - first + 1})
+
+
+class GapScanner(object):
+    '''
+    A class to find bars missing from stored prices
+
+    Holes are left by tickers skipped by AlphaVantage and by failed database writes.
+    Stored timestamps of all tickers are read in one query and compared against the
+    session calendar (holidays, half days and the 15 minute grid), so weekends,
+    holidays and early closes are never reported as missing. Each ticker is scanned
+    from its first stored bar, so bars from before its listing or its first available
+    history, which can never be filled, are not reported either.
+
+    ...
+
+    Attributes
+    ----------
+    st_db : PyDB.DBWrapper.DBWrapper
+        DBWrapper object for interacting with database
+    logger : st_logger.logger
+        object of class st_logger.logger
+    calendar : trading_calendar.TradingCalendar
+        session calendar the stored bars are compared against
+
+    Methods
+    -------
+    scan(price_type, tickers_list, start, end=None, after_hours=False)
+        missing spans per ticker between start and the latest published bar
+    '''
+
+    def __init__(self, st_db, st_logger, calendar=None):
+        self.st_db = st_db
+        self.logger = st_logger
+        self.calendar = calendar or TradingCalendar()
+
+
+    def _stored(self, price_type, tickers_list, start, end):
+        table, ts_col = PRICE_TABLES[price_type]
+        qry = '''
+        SELECT
+            ticker, {ts_col} AS ts
+        FROM
+            SMART_TRADING.{table}
+        WHERE
+            ticker IN ({tickers}) AND {ts_col} BETWEEN %s AND %s
+        '''.format(ts_col=ts_col, table=table, tickers=', '.join(['%s'] * len(tickers_list)))
+        return self.st_db.executeReadQuery(qry, tuple(tickers_list) + (start, end))
+
+
+    def _first_bars(self, price_type, tickers_list):
+        '''First stored bar per ticker, aligned to tickers_list with NaT for tickers without bars'''
+        table, ts_col = PRICE_TABLES[price_type]
+        qry = '''
+        SELECT
+            ticker, MIN({ts_col}) AS first
+        FROM
+            SMART_TRADING.{table}
+        WHERE
+            ticker IN ({tickers})
+        GROUP BY
+            ticker
+        '''.format(ts_col=ts_col, table=table, tickers=', '.join(['%s'] * len(tickers_list)))
+        first_df = self.st_db.executeReadQuery(qry, tuple(tickers_list))
+        first = pd.Series(pd.to_datetime(first_df['first']).values, index=first_df['ticker'])
+        return pd.DatetimeIndex(first.reindex(tickers_list).values)
+
+
+    def scan(self, price_type, tickers_list, start, end=None, after_hours=False):
+        '''Missing spans per ticker between start and end
+
+        Parameters
+        ----------
+        price_type : str
+            'intraday' or 'daily'
+        tickers_list : list[str]
+            Tickers to scan
+        start : pandas.Timestamp
+            First bar to expect
+        end : pandas.Timestamp, optional
+            Last bar to expect, the latest bar published by now by default
+        after_hours : bool, optional
+            True if pre-market and after-hours bars are stored (default=False)
+
+        Returns
+        -------
+        pandas.DataFrame
+            Columns ticker, start, end and bars, sorted by ticker and start
+        '''
+        if price_type not in PRICE_TABLES:
+            raise ValueError('"price_type" must be one of "intraday" or "daily".')
+        if end is None:
+            end = self.calendar.latest_bar(price_type, pd.Timestamp.now(tz=MARKET_TZ)
+                                           .tz_localize(None), after_hours)
+        grid = self.calendar.grid(price_type, start, end, after_hours)
+        if len(grid) == 0 or len(tickers_list) == 0:
+            return pd.DataFrame(columns=SPAN_COLS)
+        stored = self._stored(price_type, tickers_list, grid[0].to_pydatetime(),
+                              grid[-1].to_pydatetime())
+        spans = find_spans(grid, tickers_list, stored['ticker'].values,
+                           pd.to_datetime(stored['ts']),
+                           self._first_bars(price_type, tickers_list))
+        self.logger.info('{}: {} missing bars in {} spans of {} tickers between {} and {}.'.format(
+            price_type, int(spans['bars'].sum()), len(spans.index),
+            spans['ticker'].nunique(), grid[0], grid[-1]))
+        return spans
+
+
+if __name__ == '__main__':
+    st_logger = logger('Gaps')
+    args = parse_args()
+    st_db = DBWrapper('SMART_TRADING')
+    tickers_list = args.tickers_list or Universe(st_db, st_logger).get_members(
+        args.stock_index or 'NASDAQ', args.as_of)
+    days = DEFAULT_DAYS_INTRA if args.price_type == 'intraday' else DEFAULT_DAYS_DAILY
+    start = pd.Timestamp(args.start_date or dt.date.today() - dt.timedelta(days=days))
+    spans = GapScanner(st_db, st_logger).scan(args.price_type, tickers_list, start,
+                                              after_hours=args.after_hours)
+    print(spans.to_string(index=False))
+    st_db.close()
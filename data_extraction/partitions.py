@@ -0,0 +1,357 @@
+'''
+This module migrates intraday_prices and daily_prices to monthly range-partitioned tables
+keyed by compact integer ticker ids, and maintains their partitions: creating months ahead
+and dropping whole months past retention.
+'''
+
+import datetime as dt
+import numpy as np
+import pandas as pd
+
+from constants import *
+from args import parse_args
+from libs.st_logger.logger import logger
+from libs.PyDB.DBWrapper import DBWrapper, ROW_HASHES_TABLE
+
+# Partitioned table behind each price view, its time column and partitioning expression
+PARTITIONED = {
+    'intraday': {'view': 'intraday_prices', 'table': 'intraday_bars', 'ts_col': 'ts',
+                 'ts_type': 'TIMESTAMP', 'part_fn': 'UNIX_TIMESTAMP'},
+    'daily': {'view': 'daily_prices', 'table': 'daily_bars', 'ts_col': 'dt',
+              'ts_type': 'DATE', 'part_fn': 'TO_DAYS'},
+}
+TICKER_IDS_TABLE = 'ticker_ids'
+# Price views reading each table, so cached reads of a view are invalidated by writes to its tables
+VIEW_DEPENDENCIES = {spec['table']: [spec['view']] for spec in PARTITIONED.values()}
+VIEW_DEPENDENCIES[TICKER_IDS_TABLE] = [spec['view'] for spec in PARTITIONED.values()]
+PRICE_COLS = ['open', 'high', 'low', 'close', 'volume']
+
+
+def _month_start(day):
+    return dt.date(day.year, day.month, 1)
+
+
+def _next_month(month):
+    return dt.date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def _partition_name(month):
+    return 'p{:%Y%m}'.format(month)
+
+
+class TickerIds(object):
+    '''
+    A cache of the ticker_ids dimension, assigning ids to new tickers on first write
+
+    ...
+
+    Attributes
+    ----------
+    st_db : PyDB.DBWrapper.DBWrapper
+        DBWrapper object for interacting with database
+
+    Methods
+    -------
+    ids(tickers)
+        ticker ids of the tickers, creating missing ones
+    to_bars(prices)
+        prices indexed by ticker id instead of ticker, to write to the partitioned table
+    '''
+
+    def __init__(self, st_db):
+        self.st_db = st_db
+        self._ids = {}
+
+
+    def _read_ids(self, tickers):
+        qry = '''
+        SELECT
+            ticker, ticker_id
+        FROM
+            SMART_TRADING.{table}
+        WHERE
+            ticker IN ({tickers})
+        '''.format(table=TICKER_IDS_TABLE, tickers=', '.join(['%s'] * len(tickers)))
+        ids_df = self.st_db.executeReadQuery(qry, tuple(tickers))
+        self._ids.update(zip(ids_df['ticker'], ids_df['ticker_id'].astype(int)))
+
+
+    def ids(self, tickers):
+        missing = [t for t in tickers if t not in self._ids]
+        if missing:
+            self._read_ids(missing)
+            # Only tickers not stored yet are inserted, so no auto increment values are burnt
+            missing = [t for t in missing if t not in self._ids]
+            if missing:
+                self.st_db.executeQuery('''
+                INSERT IGNORE INTO SMART_TRADING.{table} (ticker) VALUES {rows}
+                '''.format(table=TICKER_IDS_TABLE, rows=', '.join(['(%s)'] * len(missing))),
+                                        tuple(missing))
+                self._read_ids(missing)
+        return [self._ids[t] for t in tickers]
+
+
+    def to_bars(self, prices):
+        '''Replace the ticker level of the prices index by ticker ids'''
+        codes, tickers = pd.factorize(prices.index.get_level_values(0))
+        ids = np.array(self.ids(list(tickers)), dtype=np.int64)[codes]
+        index = pd.MultiIndex.from_arrays([ids, prices.index.get_level_values(1)],
+                                          names=['ticker_id', prices.index.names[1]])
+        return prices.set_axis(index, axis=0)
+
+
+class PartitionManager(object):
+    '''
+    A class to migrate price tables to monthly partitions and maintain them
+
+    The partitioned tables (intraday_bars, daily_bars) are keyed by (ticker_id, ts)
+    and range-partitioned by month, with an empty catch-all partition pmax the next
+    months are split off from. intraday_prices and daily_prices become views joining
+    the ticker_ids dimension, so readers keep querying by ticker while inserts and
+    range scans only touch the B-trees of the months involved. Retention drops whole
+    partitions, which is a metadata change instead of a DELETE scan.
+
+    ...
+
+    Attributes
+    ----------
+    st_db : PyDB.DBWrapper.DBWrapper
+        DBWrapper object for interacting with database
+    logger : st_logger.logger
+        object of class st_logger.logger
+
+    Methods
+    -------
+    is_partitioned(price_type)
+        True if the prices of price_type are stored in the partitioned table
+    migrate(price_type)
+        copies the retained prices into a new partitioned table and swaps in the view
+    add_partitions(price_type, months_ahead=PARTITION_MONTHS_AHEAD)
+        creates partitions up to months_ahead months from today
+    drop_expired(price_type, retention_days=None)
+        drops partitions holding only prices older than retention
+    maintain(price_type)
+        adds partitions ahead and drops expired ones
+    '''
+
+    def __init__(self, st_db, st_logger):
+        self.st_db = st_db
+        self.logger = st_logger
+
+
+    def _partitions(self, price_type):
+        '''Monthly partitions of the partitioned table, oldest first, pmax excluded'''
+        qry = '''
+        SELECT
+            PARTITION_NAME AS name
+        FROM
+            information_schema.PARTITIONS
+        WHERE
+            TABLE_SCHEMA = 'SMART_TRADING' AND TABLE_NAME = %s AND PARTITION_NAME IS NOT NULL
+        ORDER BY
+            PARTITION_ORDINAL_POSITION
+        '''
+        names = self.st_db.executeReadQuery(qry, (PARTITIONED[price_type]['table'],))['name']
+        return [dt.datetime.strptime(name, 'p%Y%m').date() for name in names if name != 'pmax']
+
+
+    def is_partitioned(self, price_type):
+        qry = '''
+        SELECT
+            TABLE_TYPE AS table_type
+        FROM
+            information_schema.TABLES
+        WHERE
+            TABLE_SCHEMA = 'SMART_TRADING' AND TABLE_NAME = %s
+        '''
+        try:
+            table_type = self.st_db.executeReadQuery(qry, (PARTITIONED[price_type]['view'],))
+        except:
+            # Databases without information_schema only hold unpartitioned tables
+            return False
+        return table_type.shape[0] > 0 and table_type['table_type'][0] == 'VIEW'
+
+
+    def _bound(self, price_type, month):
+        return "{}('{:%Y-%m-%d}')".format(PARTITIONED[price_type]['part_fn'], month)
+
+
+    def _partition_defs(self, price_type, months):
+        defs = ['PARTITION {} VALUES LESS THAN ({})'.format(
+            _partition_name(month), self._bound(price_type, _next_month(month)))
+                for month in months]
+        return ',\n'.join(defs + ['PARTITION pmax VALUES LESS THAN MAXVALUE'])
+
+
+    def _months(self, first, last):
+        months = [_month_start(first)]
+        while months[-1] < _month_start(last):
+            months.append(_next_month(months[-1]))
+        return months
+
+
+    def _create_table(self, price_type, months):
+        spec = PARTITIONED[price_type]
+        self.st_db.executeQuery('''
+        CREATE TABLE IF NOT EXISTS SMART_TRADING.{table} (
+        ticker_id smallint unsigned not null,
+        {ts_col} {ts_type} not null,
+        open float,
+        high float,
+        low float,
+        close float,
+        volume int,
+
+        primary key (ticker_id, {ts_col})
+        )
+        PARTITION BY RANGE ({part_fn}({ts_col})) (
+        {partitions}
+        )
+        '''.format(table=spec['table'], ts_col=spec['ts_col'], ts_type=spec['ts_type'],
+                   part_fn=spec['part_fn'], partitions=self._partition_defs(price_type, months)))
+
+
+    def _copy_month(self, price_type, source, month):
+        spec = PARTITIONED[price_type]
+        self.st_db.executeQuery('''
+        INSERT IGNORE INTO SMART_TRADING.{table} (ticker_id, {ts_col}, {cols})
+        SELECT
+            t.ticker_id, p.{ts_col}, {p_cols}
+        FROM
+            SMART_TRADING.{source} p JOIN SMART_TRADING.{ticker_ids} t ON t.ticker = p.ticker
+        WHERE
+            p.{ts_col} >= %s AND p.{ts_col} < %s
+        '''.format(table=spec['table'], ts_col=spec['ts_col'], cols=', '.join(PRICE_COLS),
+                   p_cols=', '.join('p.' + col for col in PRICE_COLS), source=source,
+                   ticker_ids=TICKER_IDS_TABLE), (month, _next_month(month)))
+
+
+    def _retention_start(self, price_type, retention_days=None):
+        retention_days = retention_days or RETENTION_DAYS[price_type]
+        return dt.date.today() - dt.timedelta(days=retention_days)
+
+
+    def migrate(self, price_type):
+        '''Copy the retained prices into a new partitioned table and swap in the view
+
+        Months are copied one transaction each. The unpartitioned table is kept as
+        <view>_legacy to be dropped once verified, and the latest month is copied
+        again after the swap, picking up prices written while the migration ran.
+        '''
+        if self.is_partitioned(price_type):
+            self.logger.info('{} prices are already partitioned.'.format(price_type))
+            return
+        spec = PARTITIONED[price_type]
+        legacy = spec['view'] + '_legacy'
+        self.st_db.executeQuery('''
+        CREATE TABLE IF NOT EXISTS SMART_TRADING.{table} (
+        ticker_id smallint unsigned not null auto_increment,
+        ticker varchar(8) not null,
+
+        primary key (ticker_id),
+        unique key uk_ticker (ticker)
+        )
+        '''.format(table=TICKER_IDS_TABLE))
+        self.st_db.executeQuery('''
+        INSERT IGNORE INTO SMART_TRADING.{table} (ticker)
+        SELECT DISTINCT ticker FROM SMART_TRADING.{view} ORDER BY ticker
+        '''.format(table=TICKER_IDS_TABLE, view=spec['view']))
+
+        first = self.st_db.executeReadQuery('''
+        SELECT
+            MIN({ts_col}) AS first
+        FROM
+            SMART_TRADING.{view}
+        '''.format(ts_col=spec['ts_col'], view=spec['view']))['first'][0]
+        start = self._retention_start(price_type)
+        if not pd.isnull(first):
+            start = max(start, pd.Timestamp(first).date())
+        months = self._months(start, dt.date.today())
+        self._create_table(price_type, self._months(
+            start, dt.date.today() + pd.DateOffset(months=PARTITION_MONTHS_AHEAD)))
+        for month in months:
+            self._copy_month(price_type, spec['view'], month)
+            self.logger.info('Copied {} prices of {:%Y-%m}.'.format(price_type, month))
+
+        self.st_db.executeQuery('RENAME TABLE SMART_TRADING.{view} TO SMART_TRADING.{legacy}'
+                                .format(view=spec['view'], legacy=legacy))
+        self.st_db.executeQuery('''
+        CREATE VIEW SMART_TRADING.{view} AS
+        SELECT
+            t.ticker, b.{ts_col}, {b_cols}
+        FROM
+            SMART_TRADING.{table} b JOIN SMART_TRADING.{ticker_ids} t ON t.ticker_id = b.ticker_id
+        '''.format(view=spec['view'], ts_col=spec['ts_col'],
+                   b_cols=', '.join('b.' + col for col in PRICE_COLS), table=spec['table'],
+                   ticker_ids=TICKER_IDS_TABLE))
+        self._copy_month(price_type, legacy, months[-1])
+        self.logger.info('Migrated {} prices to {}, drop {} once verified.'.format(
+            price_type, spec['table'], legacy))
+
+
+    def add_partitions(self, price_type, months_ahead=PARTITION_MONTHS_AHEAD):
+        '''Split partitions up to months_ahead months from today off pmax, which is empty'''
+        partitions = self._partitions(price_type)
+        last = dt.date.today() + pd.DateOffset(months=months_ahead)
+        months = [month for month in self._months(partitions[-1], last)
+                  if month > partitions[-1]]
+        if not months:
+            return
+        self.st_db.executeQuery('''
+        ALTER TABLE SMART_TRADING.{table} REORGANIZE PARTITION pmax INTO (
+        {partitions}
+        )
+        '''.format(table=PARTITIONED[price_type]['table'],
+                   partitions=self._partition_defs(price_type, months)))
+        self.logger.info('Added {} partitions {} to {}.'.format(
+            price_type, _partition_name(months[0]), _partition_name(months[-1])))
+
+
+    def drop_expired(self, price_type, retention_days=None):
+        '''Drop partitions holding only prices older than retention, the latest one is kept'''
+        start = self._retention_start(price_type, retention_days)
+        partitions = self._partitions(price_type)
+        expired = [month for month in partitions[:-1] if _next_month(month) <= start]
+        if not expired:
+            return
+        self.st_db.executeQuery('ALTER TABLE SMART_TRADING.{} DROP PARTITION {}'.format(
+            PARTITIONED[price_type]['table'], ', '.join(map(_partition_name, expired))))
+        self.logger.info('Dropped {} {} partitions before {:%Y-%m}.'.format(
+            len(expired), price_type, _next_month(expired[-1])))
+        self._prune_row_hashes(price_type, _next_month(expired[-1]))
+
+
+    def _prune_row_hashes(self, price_type, before):
+        '''Delete row hashes of diff upserted prices before a date, dropped with their partitions
+
+        Hashes are deleted by a range of the indexed row date, so pruning does not scan
+        the table. Hashes kept under the view name, written before migrating, are
+        pruned as well.
+        '''
+        spec = PARTITIONED[price_type]
+        self.st_db.executeQuery('''
+        DELETE FROM SMART_TRADING.{rh}
+        WHERE table_name IN (%s, %s) AND row_dt < %s
+        '''.format(rh=ROW_HASHES_TABLE), (spec['table'], spec['view'], '{:%Y-%m-%d}'.format(before)))
+        self.logger.info('Pruned {} row hashes before {:%Y-%m}.'.format(price_type, before))
+
+
+    def maintain(self, price_type):
+        if not self.is_partitioned(price_type):
+            self.logger.warning('{} prices are not partitioned, run with --migrate first.'.format(
+                price_type))
+            return
+        self.add_partitions(price_type)
+        self.drop_expired(price_type)
+
+
+if __name__ == '__main__':
+    st_logger = logger('Partitions')
+    args = parse_args()
+    st_db = DBWrapper('SMART_TRADING')
+    partitions = PartitionManager(st_db=st_db, st_logger=st_logger)
+    for price_type in ([args.price_type] if args.price_type else list(PARTITIONED)):
+        if args.migrate:
+            partitions.migrate(price_type)
+        partitions.maintain(price_type)
+    st_db.close()
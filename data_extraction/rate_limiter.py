@@ -0,0 +1,82 @@
+'''
+Token-bucket rate limiter shared by the API extraction jobs, usable from threads and asyncio
+'''
+
+import asyncio
+import threading
+import time
+
+
+class TokenBucket(object):
+    '''
+    A token bucket refilled at `calls_per_min` tokens per minute
+
+    With the default capacity of 1, calls are spaced evenly and never exceed
+    `calls_per_min` in any rolling minute, which is how AlphaVantage counts quota.
+    A larger capacity allows bursts after idle periods.
+
+    ...
+
+    Attributes
+    ----------
+    calls_per_min : float
+        refill rate of the bucket
+    capacity : int
+        maximum number of tokens held, i.e. burst size
+    wait_sec : float
+        total seconds callers have spent waiting for tokens
+
+    Methods
+    -------
+    acquire()
+        block the calling thread until a token is available and take it
+    acquire_async()
+        coroutine waiting until a token is available and taking it
+    '''
+
+    def __init__(self, calls_per_min, capacity=1):
+        self.calls_per_min = calls_per_min
+        self.capacity = capacity
+        self.wait_sec = 0.0
+        self._rate = calls_per_min / 60.0
+        self._tokens = float(capacity)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+
+    def _take(self):
+        '''Take a token if available and return 0, else return seconds until one is'''
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self._rate)
+            self._last = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self._rate
+
+
+    def acquire(self):
+        '''Block until a token is available and take it, returns seconds waited'''
+        t_start = time.monotonic()
+        wait = self._take()
+        while wait > 0:
+            time.sleep(wait)
+            wait = self._take()
+        waited = time.monotonic() - t_start
+        with self._lock:
+            self.wait_sec += waited
+        return waited
+
+
+    async def acquire_async(self):
+        '''Wait without blocking the event loop until a token is available, returns seconds waited'''
+        t_start = time.monotonic()
+        wait = self._take()
+        while wait > 0:
+            await asyncio.sleep(wait)
+            wait = self._take()
+        waited = time.monotonic() - t_start
+        with self._lock:
+            self.wait_sec += waited
+        return waited
@@ -0,0 +1,165 @@
+'''
+This module maintains materialized OHLCV rollups (hourly, session and weekly bars) of
+intraday_prices, updated for the affected buckets after every intraday write and
+backfilled from history in parallel per ticker.
+'''
+
+import pandas as pd
+import numpy as np
+from multiprocessing import Pool, cpu_count
+
+from constants import *
+from args import parse_args
+from universe import Universe
+from libs.st_logger.logger import logger
+from libs.PriceStore.PriceStore import typical_price
+from libs.PyDB.DBWrapper import DBWrapper
+
+BUCKET_TYPES = ['hour', 'session', 'week']
+
+
+def bucket_start(ts, bucket_type):
+    '''Start of the bucket each timestamp belongs to, weeks start on Monday'''
+    if bucket_type == 'hour':
+        return ts.dt.floor('h')
+    elif bucket_type == 'session':
+        return ts.dt.normalize()
+    elif bucket_type == 'week':
+        return ts.dt.normalize() - pd.to_timedelta(ts.dt.dayofweek, unit='D')
+    raise ValueError('bucket_type must be in {}'.format(BUCKET_TYPES))
+
+
+class Rollup(object):
+    '''
+    A class to maintain rollups of intraday prices in the intraday_rollups table
+
+    ...
+
+    Attributes
+    ----------
+    st_db : PyDB.DBWrapper.DBWrapper
+        DBWrapper object for interacting with database
+    logger : st_logger.logger
+        object of class st_logger.logger
+
+    Methods
+    -------
+    aggregate(bars, bucket_type)
+        aggregates bars into OHLCV, VWAP and bar count per ticker and bucket
+    update(ticker_prices)
+        recomputes only the buckets touched by newly written intraday prices
+    backfill(tickers_list, n_proc=None)
+        builds rollups from all stored intraday prices in parallel per ticker
+    '''
+
+    def __init__(self, st_db, st_logger):
+        self.st_db = st_db
+        self.logger = st_logger
+
+
+    def aggregate(self, bars, bucket_type):
+        '''Aggregate bars into one row per ticker and bucket
+
+        Parameters
+        ----------
+        bars : pandas.DataFrame
+            Columns ticker, ts, open, high, low, close, volume
+        bucket_type : str
+            One of 'hour', 'session' or 'week'
+        '''
+        bars = bars.sort_values(['ticker', 'ts'])
+        price_volume = typical_price(bars['high'], bars['low'], bars['close']) * bars['volume']
+        bars = bars.assign(bucket_start=bucket_start(bars['ts'], bucket_type),
+                           price_volume=price_volume)
+        rollup = bars.groupby(['ticker', 'bucket_start'], sort=False).agg(
+            open=('open', 'first'), high=('high', 'max'), low=('low', 'min'),
+            close=('close', 'last'), volume=('volume', 'sum'),
+            price_volume=('price_volume', 'sum'), bar_count=('ts', 'size'))
+        rollup['vwap'] = rollup['price_volume'] / rollup['volume'].replace(0, np.nan)
+        rollup = rollup.drop('price_volume', axis=1).reset_index()
+        rollup.insert(1, 'bucket_type', bucket_type)
+        return rollup
+
+
+    def _read_bars(self, ticker, start=None, end=None):
+        conditions, params = ['ticker = %s'], [ticker]
+        if start is not None:
+            conditions.append('ts >= %s')
+            params.append(start.to_pydatetime())
+        if end is not None:
+            conditions.append('ts < %s')
+            params.append(end.to_pydatetime())
+        qry = '''
+        SELECT
+            ticker, ts, open, high, low, close, volume
+        FROM
+            SMART_TRADING.intraday_prices
+        WHERE
+            {}
+        '''.format(' AND '.join(conditions))
+        return self.st_db.executeReadQuery(qry, tuple(params))
+
+
+    def _write_rollups(self, bars, affected=None):
+        '''Aggregate bars for all bucket types and upsert, only affected buckets if given'''
+        rollups = []
+        for bucket_type in BUCKET_TYPES:
+            rollup = self.aggregate(bars, bucket_type)
+            if affected is not None:
+                rollup = rollup[rollup['bucket_start'].isin(affected[bucket_type])]
+            rollups.append(rollup)
+        rollups = pd.concat(rollups, ignore_index=True)
+        self.st_db.executeWriteQuery(rollups, 'intraday_rollups')
+        return rollups.shape[0]
+
+
+    def update(self, ticker_prices):
+        '''Recompute the buckets touched by newly written intraday prices of one ticker
+
+        The affected buckets may hold previously stored bars too, so the stored bars
+        from the start of the earliest affected week to the end of the latest one are
+        read back and only those buckets are aggregated and upserted.
+
+        Parameters
+        ----------
+        ticker_prices : pandas.DataFrame
+            Intraday prices indexed by ticker and timestamp, as written by Stock.write_to_db
+        '''
+        if len(ticker_prices.index) == 0:
+            return
+        ticker = ticker_prices.index.get_level_values(0)[0]
+        ts = pd.Series(pd.to_datetime(ticker_prices.index.get_level_values(1)))
+        affected = {bucket_type: bucket_start(ts, bucket_type).unique()
+                    for bucket_type in BUCKET_TYPES}
+        start = affected['week'].min()
+        end = affected['week'].max() + pd.Timedelta(days=7)
+        n_rows = self._write_rollups(self._read_bars(ticker, start, end), affected)
+        self.logger.info('{}: Updated {} rollup buckets.'.format(ticker, n_rows))
+
+
+    def _backfill_ticker(self, ticker):
+        try:
+            bars = self._read_bars(ticker)
+            if bars.shape[0] > 0:
+                return self._write_rollups(bars)
+        except:
+            self.logger.warning('{}: Could not backfill rollups.'.format(ticker))
+        return 0
+
+
+    def backfill(self, tickers_list, n_proc=None):
+        '''Build rollups from all stored intraday prices, one ticker per task in a process pool'''
+        n_proc = n_proc or max(cpu_count()-1, 1)
+        with Pool(n_proc) as pool:
+            n_rows = pool.map(self._backfill_ticker, tickers_list, chunksize=1)
+        self.logger.info('Backfilled {} rollup buckets for {} tickers.'.format(
+            sum(n_rows), len(tickers_list)))
+
+
+if __name__ == '__main__':
+    st_logger = logger('Rollups')
+    args = parse_args()
+    st_db = DBWrapper('SMART_TRADING')
+    tickers_list = args.tickers_list or Universe(st_db, st_logger).get_members(
+        args.stock_index or 'NASDAQ', args.as_of)
+    Rollup(st_db=st_db, st_logger=st_logger).backfill(tickers_list)
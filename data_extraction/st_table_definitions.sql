@@ -68,3 +68,122 @@ created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
 
 primary key (ticker, stock_index)
 );
+
+-- Price and as-of earnings features per ticker and bar, written by modeling/features.py
+create table SMART_TRADING.price_features (
+ticker varchar(8) default '' not null,
+price_type varchar(8) default '' not null,
+ts TIMESTAMP DEFAULT '1990-01-01 00:00:00' NOT NULL,
+ret_1 double,
+ret_5 double,
+ret_20 double,
+vol_20 double,
+vwap_20 double,
+gap double,
+volume_z_20 double,
+days_to_next_earnings double,
+days_since_last_earnings double,
+last_eps_surprise_pct double,
+updated_at TIMESTAMP NOT NULL DEFAULT NOW() ON UPDATE NOW(),
+
+primary key (ticker, price_type, ts)
+);
+
+-- Hourly, session and weekly rollups of intraday prices, maintained by rollups.py
+create table SMART_TRADING.intraday_rollups (
+ticker varchar(8) default '' not null,
+bucket_type varchar(8) default '' not null,
+bucket_start TIMESTAMP DEFAULT '1990-01-01 00:00:00' NOT NULL,
+open float,
+high float,
+low float,
+close float,
+volume bigint,
+vwap double,
+bar_count int,
+updated_at TIMESTAMP NOT NULL DEFAULT NOW() ON UPDATE NOW(),
+
+primary key (ticker, bucket_type, bucket_start)
+);
+
+-- Content hash of every row written with DBWrapper.executeDiffWriteQuery, keyed by table and primary key;
+-- row_dt is the date of timestamp keyed rows, so hashes of dropped partitions are deleted by range
+-- Existing installs: alter table SMART_TRADING.row_hashes add column row_dt date default null after row_hash, add key row_hashes_dt (table_name, row_dt);
+create table SMART_TRADING.row_hashes (
+table_name varchar(64) default '' not null,
+row_key varchar(64) default '' not null,
+row_hash bigint not null,
+row_dt date default null,
+updated_at TIMESTAMP NOT NULL DEFAULT NOW() ON UPDATE NOW(),
+
+primary key (table_name, row_key),
+key row_hashes_dt (table_name, row_dt)
+);
+
+-- Point-in-time index membership, maintained by universe.py; valid_to is exclusive, NULL while a member
+create table SMART_TRADING.ticker_membership (
+ticker varchar(8) default '' not null,
+stock_index varchar(64) default '' not null,
+valid_from date not null,
+valid_to date default null,
+company varchar(64) default '' not null,
+
+primary key (ticker, stock_index, valid_from),
+key idx_membership_as_of (stock_index, valid_from, valid_to)
+);
+
+-- Compact integer ids of tickers, keys of the partitioned price tables
+create table SMART_TRADING.ticker_ids (
+ticker_id smallint unsigned not null auto_increment,
+ticker varchar(8) not null,
+
+primary key (ticker_id),
+unique key uk_ticker (ticker)
+);
+
+-- Intraday prices partitioned by month, created by `partitions.py --migrate`, which adds
+-- monthly partitions ahead (split off pmax) and drops expired ones. intraday_prices then
+-- becomes a view joining ticker_ids; daily_bars (dt date, TO_DAYS(dt)) is alike
+create table SMART_TRADING.intraday_bars (
+ticker_id smallint unsigned not null,
+ts TIMESTAMP not null,
+open float,
+high float,
+low float,
+close float,
+volume int,
+
+primary key (ticker_id, ts)
+)
+partition by range (UNIX_TIMESTAMP(ts)) (
+partition pmax values less than MAXVALUE
+);
+
+-- Forecast closes per horizon in bars, from the bar at origin_ts, written by modeling/forecast.py
+create table SMART_TRADING.forecasts (
+ticker varchar(8) default '' not null,
+price_type varchar(8) default '' not null,
+model varchar(16) default '' not null,
+origin_ts TIMESTAMP DEFAULT '1990-01-01 00:00:00' NOT NULL,
+horizon smallint not null,
+forecast_close double,
+fit_sec double,
+run_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+
+primary key (ticker, price_type, model, origin_ts, horizon)
+);
+
+-- Walk-forward backtest errors of log close per ticker and horizon, written by modeling/forecast.py --backtest
+create table SMART_TRADING.forecast_backtests (
+ticker varchar(8) default '' not null,
+price_type varchar(8) default '' not null,
+model varchar(16) default '' not null,
+horizon smallint not null,
+n_origins int,
+mae double,
+rmse double,
+fit_sec double,
+run_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+
+primary key (ticker, price_type, model, horizon)
+);
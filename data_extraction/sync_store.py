@@ -0,0 +1,146 @@
+'''
+This module mirrors the MySQL tables into the embedded store (DuckDB, or SQLite where DuckDB
+is not installed), so research queries run in-process without loading the MySQL server.
+'''
+
+import pandas as pd
+
+from constants import *
+from args import parse_args
+from libs.st_logger.logger import logger
+from libs.PyDB.DBWrapper import DBWrapper
+from libs.PyDB.backends import MySQLBackend, EmbeddedBackend
+
+
+def _sql_type(dtype):
+    if pd.api.types.is_bool_dtype(dtype):
+        return 'BOOLEAN'
+    if pd.api.types.is_integer_dtype(dtype):
+        return 'BIGINT'
+    if pd.api.types.is_float_dtype(dtype):
+        return 'DOUBLE'
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return 'TIMESTAMP'
+    return 'VARCHAR'
+
+
+class StoreSync(object):
+    '''
+    A class to mirror MySQL tables into the embedded store
+
+    Tables are streamed from MySQL in chunks and upserted into tables of the same
+    name and primary key, created from the column types of the first chunk. Tables
+    with a time column are synced incrementally: mirrored rows from a few days
+    before the latest mirrored row on are deleted and copied again, picking up late
+    restatements. Other tables are copied whole on every sync. Each table is
+    replaced in one transaction of the store.
+
+    ...
+
+    Attributes
+    ----------
+    source_db : PyDB.DBWrapper.DBWrapper
+        DBWrapper object of the MySQL database
+    target_db : PyDB.DBWrapper.DBWrapper
+        DBWrapper object of the embedded store
+    logger : st_logger.logger
+        object of class st_logger.logger
+    tables : dict
+        primary key, time column and overlap in days of every mirrored table
+
+    Methods
+    -------
+    sync_table(table, full=False)
+        mirror one table, returns the number of rows copied
+    sync(full=False)
+        mirror all tables
+    '''
+
+    def __init__(self, source_db, target_db, st_logger, tables=SYNC_TABLES):
+        self.source_db = source_db
+        self.target_db = target_db
+        self.logger = st_logger
+        self.tables = tables
+
+
+    def _create_table(self, table, chunk, key_cols):
+        cols = ', '.join(['`{}` {}'.format(col, _sql_type(dtype))
+                          for col, dtype in chunk.dtypes.items()])
+        self.target_db.executeQuery('CREATE TABLE IF NOT EXISTS {} ({}, PRIMARY KEY ({}))'.format(
+            table, cols, ', '.join(['`{}`'.format(col) for col in key_cols])))
+
+
+    def _cutoff(self, table, ts_col, overlap_days):
+        '''Time from which mirrored rows are replaced, None to replace all of them'''
+        latest = self.target_db.executeReadQuery(
+            'SELECT MAX(`{ts}`) AS ts FROM {table}'.format(ts=ts_col, table=table))['ts'][0]
+        if latest is None or pd.isnull(latest):
+            return None
+        return (pd.Timestamp(latest) - pd.Timedelta(days=overlap_days)).to_pydatetime()
+
+
+    def sync_table(self, table, full=False):
+        '''Mirror one table
+
+        Parameters
+        ----------
+        table : str
+            Name of the table, a key of `tables`
+        full : bool, optional
+            True to copy the whole table even if it has a time column (default=False)
+
+        Returns
+        -------
+        int
+            Rows copied
+        '''
+        key_cols, ts_col, overlap_days = self.tables[table]
+        exists = table in self.target_db.backend.tables()
+        cutoff = None
+        if exists and ts_col and not full:
+            cutoff = self._cutoff(table, ts_col, overlap_days)
+        qry = 'SELECT * FROM SMART_TRADING.{}'.format(table)
+        params = None
+        if cutoff is not None:
+            qry += ' WHERE `{}` >= %s'.format(ts_col)
+            params = (cutoff,)
+        n_rows = 0
+        # Replaced rows are deleted and copied in one transaction, so a failed or
+        # interrupted read leaves the mirror as it was
+        with self.target_db.transaction():
+            if exists and cutoff is not None:
+                self.target_db.executeQuery('DELETE FROM {} WHERE `{}` >= %s'.format(
+                    table, ts_col), (cutoff,))
+            elif exists:
+                self.target_db.executeQuery('DELETE FROM {}'.format(table))
+            for chunk in self.source_db.iterReadQuery(qry, params):
+                if not exists:
+                    self._create_table(table, chunk, key_cols)
+                    exists = True
+                self.target_db.executeWriteQuery(chunk, table)
+                n_rows += chunk.shape[0]
+        self.logger.info('Mirrored {} rows of {}{}.'.format(
+            n_rows, table, ' since {}'.format(cutoff) if cutoff is not None else ''))
+        return n_rows
+
+
+    def sync(self, full=False):
+        '''Mirror all tables, skipping tables that cannot be read'''
+        n_rows = {}
+        for table in self.tables:
+            try:
+                n_rows[table] = self.sync_table(table, full)
+            except:
+                self.logger.warning('Could not mirror {}.'.format(table))
+        return n_rows
+
+
+if __name__ == '__main__':
+    st_logger = logger('StoreSync')
+    args = parse_args()
+    # Read from MySQL explicitly, even where db_path points jobs at the embedded store
+    source_db = DBWrapper('SMART_TRADING', backend=MySQLBackend())
+    target_db = DBWrapper('SMART_TRADING', backend=EmbeddedBackend(EMBEDDED_STORE_PATH))
+    StoreSync(source_db, target_db, st_logger).sync(full=args.full_sync)
+    source_db.close()
+    target_db.close()
@@ -0,0 +1,185 @@
+'''
+Session calendar of the US equity exchanges: holidays, half days and the 15 minute bar grid
+prices are expected on, in exchange time like the stored timestamps.
+'''
+
+import datetime as dt
+import numpy as np
+import pandas as pd
+
+from constants import *
+
+BAR = pd.Timedelta(minutes=15)
+BAR_SEC = 15*60
+
+
+def _sec(t):
+    return t.hour*3600 + t.minute*60
+
+
+def _easter(year):
+    '''Easter Sunday of the Gregorian calendar (anonymous Gregorian algorithm)'''
+    a, b, c = year % 19, year // 100, year % 100
+    d, e = b // 4, b % 4
+    g = (8*b + 13) // 25
+    h = (19*a + b - d - g + 15) % 30
+    i, k = c // 4, c % 4
+    l = (32 + 2*e + 2*i - h - k) % 7
+    m = (a + 11*h + 19*l) // 433
+    month = (h + l - 7*m + 90) // 25
+    return dt.date(year, month, (h + l - 7*m + 33*month + 19) % 32)
+
+
+def _nth_weekday(year, month, weekday, n):
+    '''n-th (or last, for n=-1) given weekday of a month, Monday being 0'''
+    if n > 0:
+        first = dt.date(year, month, 1)
+        return first + dt.timedelta(days=(weekday - first.weekday()) % 7 + 7*(n-1))
+    last = dt.date(year + month // 12, month % 12 + 1, 1) - dt.timedelta(days=1)
+    return last - dt.timedelta(days=(last.weekday() - weekday) % 7)
+
+
+def _observed(day):
+    '''Holidays on Saturday are observed on Friday, on Sunday on Monday'''
+    if day.weekday() == 5:
+        return day - dt.timedelta(days=1)
+    if day.weekday() == 6:
+        return day + dt.timedelta(days=1)
+    return day
+
+
+def exchange_holidays(year):
+    '''Full-day holidays and half days of a year, by the NYSE rules
+
+    Returns
+    -------
+    tuple(list[datetime.date], list[datetime.date])
+        Holidays and half days closing at HALF_DAY_CLOSE
+    '''
+    holidays = [_nth_weekday(year, 2, 0, 3), _easter(year) - dt.timedelta(days=2),
+                _nth_weekday(year, 5, 0, -1), _observed(dt.date(year, 7, 4)),
+                _nth_weekday(year, 9, 0, 1), _nth_weekday(year, 11, 3, 4),
+                _observed(dt.date(year, 12, 25))]
+    # New Year's Day on a Saturday is not observed on the Friday before
+    if dt.date(year, 1, 1).weekday() != 5:
+        holidays.append(_observed(dt.date(year, 1, 1)))
+    if year >= 1998:
+        holidays.append(_nth_weekday(year, 1, 0, 3))
+    if year >= 2022:
+        holidays.append(_observed(dt.date(year, 6, 19)))
+    holidays += [day.date() for day in pd.to_datetime(SPECIAL_CLOSURES) if day.year == year]
+
+    half_days = [_nth_weekday(year, 11, 3, 4) + dt.timedelta(days=1)]
+    # July 3rd and Christmas Eve close early from Monday to Thursday only, on Friday they
+    # are either the observed holiday or followed by a weekend holiday
+    for day in [dt.date(year, 7, 3), dt.date(year, 12, 24)]:
+        if day.weekday() < 4:
+            half_days.append(day)
+    return sorted(set(holidays)), sorted(set(half_days) - set(holidays))
+
+
+class TradingCalendar(object):
+    '''
+    A session calendar of the US equity exchanges
+
+    Intraday bars are labelled by their start like AlphaVantage's, so a regular
+    session has 26 bars from 9:30 to 15:45, and 14 on half days. With after-hours
+    bars the grid runs from 4:00 to 19:45, ending 3 hours earlier on half days.
+    Daily bars are labelled by the session date.
+
+    ...
+
+    Attributes
+    ----------
+    holidays : numpy.ndarray
+        dates of full-day closures, as datetime64[D]
+    half_days : numpy.ndarray
+        dates of sessions closing at HALF_DAY_CLOSE, as datetime64[D]
+
+    Methods
+    -------
+    sessions(start, end)
+        session dates between start and end
+    is_session(day)
+        True if the exchange is open on the date
+    grid(price_type, start, end, after_hours=False)
+        timestamps of all bars expected between start and end
+    latest_bar(price_type, now, after_hours=False)
+        timestamp of the latest bar published by now
+    '''
+
+    def __init__(self, start_year=1990, end_year=None):
+        '''
+        Parameters
+        ----------
+        start_year : int, optional
+            First year of the calendar (default=1990)
+        end_year : int, optional
+            Last year of the calendar, next year by default
+        '''
+        end_year = end_year or dt.date.today().year + 1
+        holidays, half_days = [], []
+        for year in range(start_year, end_year + 1):
+            year_holidays, year_half_days = exchange_holidays(year)
+            holidays += year_holidays
+            half_days += year_half_days
+        self.holidays = np.array(holidays, dtype='datetime64[D]')
+        self.half_days = np.array(half_days, dtype='datetime64[D]')
+
+
+    def sessions(self, start, end):
+        '''Session dates between start and end, both included, as a DatetimeIndex'''
+        days = np.arange(np.datetime64(pd.Timestamp(start).date(), 'D'),
+                         np.datetime64(pd.Timestamp(end).date(), 'D') + 1)
+        return pd.DatetimeIndex(days[np.is_busday(days, holidays=self.holidays)])
+
+
+    def is_session(self, day):
+        return bool(np.is_busday(np.datetime64(pd.Timestamp(day).date(), 'D'),
+                                 holidays=self.holidays))
+
+
+    def grid(self, price_type, start, end, after_hours=False):
+        '''Timestamps of all bars expected between start and end, both included
+
+        Parameters
+        ----------
+        price_type : str
+            'intraday' for the 15 minute grid, 'daily' for session dates
+        start, end : pandas.Timestamp
+            Bounds of the grid
+        after_hours : bool, optional
+            True to include pre-market and after-hours bars (default=False)
+
+        Returns
+        -------
+        pandas.DatetimeIndex
+            Sorted bar timestamps
+        '''
+        start, end = pd.Timestamp(start), pd.Timestamp(end)
+        sessions = self.sessions(start, end)
+        if price_type == 'daily':
+            return sessions[(sessions >= start) & (sessions <= end)]
+        elif price_type != 'intraday':
+            raise ValueError('"price_type" must be one of "intraday" or "daily".')
+        open_sec, close_sec = ((_sec(EXTENDED_OPEN), _sec(EXTENDED_CLOSE)) if after_hours
+                               else (_sec(MARKET_OPEN), _sec(MARKET_CLOSE)))
+        early_sec = close_sec - (_sec(MARKET_CLOSE) - _sec(HALF_DAY_CLOSE))
+        offsets = np.arange(open_sec, close_sec, BAR_SEC)
+        closes = np.where(np.isin(sessions.values.astype('datetime64[D]'), self.half_days),
+                          early_sec, close_sec)
+        ts = (sessions.values[:, None] + offsets[None, :].astype('timedelta64[s]'))
+        ts = ts[offsets[None, :] < closes[:, None]]
+        return pd.DatetimeIndex(ts[(ts >= start.to_datetime64()) & (ts <= end.to_datetime64())])
+
+
+    def latest_bar(self, price_type, now, after_hours=False):
+        '''Timestamp of the latest bar published by now, a bar being published once it ends'''
+        now = pd.Timestamp(now)
+        if price_type == 'daily':
+            sessions = self.sessions(now - pd.Timedelta(days=14), now)
+            closes = sessions + pd.Timedelta(seconds=_sec(MARKET_CLOSE))
+            closes = closes.where(~sessions.isin(pd.DatetimeIndex(self.half_days)),
+                                  sessions + pd.Timedelta(seconds=_sec(HALF_DAY_CLOSE)))
+            return sessions[closes <= now][-1]
+        return self.grid(price_type, now - pd.Timedelta(days=14), now - BAR, after_hours)[-1]
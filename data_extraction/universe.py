@@ -0,0 +1,198 @@
+'''
+This module maintains the point-in-time membership of stock indices in the
+ticker_membership table, from cached and diffed Wikipedia constituent tables.
+'''
+
+import datetime as dt
+import pandas as pd
+
+from constants import *
+from args import parse_args
+from libs.st_logger.logger import logger
+from libs.PyDB.DBWrapper import DBWrapper
+from libs.st_cache.response_cache import ResponseCache
+
+# Wikipedia source per index: url, table position and column names of ticker and company
+SOURCES = {
+    'SP500': {'url': 'https://en.wikipedia.org/wiki/List_of_S%26P_500_companies', 'table': 0,
+              'ticker': 'Symbol', 'company': 'Security', 'bounds': (SP500_LL, SP500_UL)},
+    'NASDAQ': {'url': 'https://en.wikipedia.org/wiki/NASDAQ-100#Components', 'table': 3,
+               'ticker': 'Ticker', 'company': 'Company', 'bounds': (NASDAQ_LL, NASDAQ_UL)},
+}
+
+
+class Universe(object):
+    '''
+    A class to maintain point-in-time membership of stock indices
+
+    Each membership row holds a ticker's stay in an index from valid_from to valid_to
+    (exclusive, NULL while still a member). A refresh fetches the current members
+    through the response cache, diffs them against the open rows and only inserts
+    additions and closes removals, so the members of an index on any date can be
+    read back with one indexed query.
+
+    ...
+
+    Attributes
+    ----------
+    st_db : PyDB.DBWrapper.DBWrapper
+        DBWrapper object for interacting with database
+    logger : st_logger.logger
+        object of class st_logger.logger
+    cache : st_cache.response_cache.ResponseCache
+        on-disk cache of fetched constituent tables, None to always fetch
+
+    Methods
+    -------
+    fetch_members(stock_index)
+        current members of the index from Wikipedia, through the cache
+    refresh(stock_index, as_of=None)
+        records additions and removals of the index as of a date
+    get_members(stock_index, as_of=None)
+        tickers in the index on a date, today by default
+    '''
+
+    def __init__(self, st_db, st_logger, cache=None):
+        self.st_db = st_db
+        self.logger = st_logger
+        self.cache = cache
+
+
+    def _fetch_table(self, stock_index):
+        source = SOURCES[stock_index]
+        self.logger.info('Getting stock tickers for {} from Wiki .....'.format(stock_index))
+        payload = pd.read_html(source['url'], header=0)[source['table']]
+        members = payload.rename({source['ticker']: 'ticker', source['company']: 'company'},
+                                 axis=1)[['ticker', 'company']]
+        return members.astype(str).to_dict('records')
+
+
+    def fetch_members(self, stock_index):
+        '''Current members of the index, with ticker and company columns
+
+        Raises
+        ------
+        ValueError
+            If the index is not supported or the member count is out of the expected
+            range, which usually means the Wikipedia page changed
+        '''
+        if stock_index not in SOURCES:
+            raise ValueError('stock_index must be in {}'.format(list(SOURCES)))
+        if self.cache is None:
+            records = self._fetch_table(stock_index)
+        else:
+            records = self.cache.fetch('wikipedia', 'index_members', stock_index, {},
+                                       lambda: self._fetch_table(stock_index))
+        members = pd.DataFrame(records, columns=['ticker', 'company']).drop_duplicates('ticker')
+        lower, upper = SOURCES[stock_index]['bounds']
+        if not lower < len(members.index) < upper:
+            raise ValueError('Check wikipedia data source for {} at {}, found {} tickers.'.format(
+                stock_index, SOURCES[stock_index]['url'], len(members.index)))
+        return members
+
+
+    def _open_members(self, stock_index):
+        qry = '''
+        SELECT
+            ticker, valid_from
+        FROM
+            SMART_TRADING.ticker_membership
+        WHERE
+            stock_index = %s AND valid_to IS NULL
+        '''
+        return self.st_db.executeReadQuery(qry, (stock_index,))
+
+
+    def _seed_from_tickers(self, stock_index):
+        '''Open membership rows for tickers stored before membership was tracked'''
+        qry = '''
+        SELECT
+            ticker, company, stock_index, DATE(created_at) AS valid_from
+        FROM
+            SMART_TRADING.tickers
+        WHERE
+            stock_index = %s
+        '''
+        seed = self.st_db.executeReadQuery(qry, (stock_index,))
+        if seed.shape[0] > 0:
+            self.st_db.executeWriteQuery(seed, 'ticker_membership')
+            self.logger.info('Seeded {} membership rows of {} from tickers.'.format(
+                seed.shape[0], stock_index))
+
+
+    def refresh(self, stock_index, as_of=None):
+        '''Record additions and removals of the index as of a date
+
+        Parameters
+        ----------
+        stock_index : str
+            Index to refresh, 'SP500' or 'NASDAQ'
+        as_of : datetime.date, optional
+            Date the fetched members are valid from, today by default
+
+        Returns
+        -------
+        tuple(list[str], list[str])
+            Added and removed tickers
+        '''
+        as_of = as_of or dt.date.today()
+        members = self.fetch_members(stock_index)
+        open_members = self._open_members(stock_index)
+        if open_members.shape[0] == 0:
+            self._seed_from_tickers(stock_index)
+            open_members = self._open_members(stock_index)
+
+        current, stored = set(members['ticker']), set(open_members['ticker'])
+        added = members[~members['ticker'].isin(stored)]
+        removed = sorted(stored - current)
+        if added.shape[0] > 0:
+            added = added.assign(stock_index=stock_index, valid_from=as_of)
+            self.st_db.executeWriteQuery(added, 'ticker_membership')
+            self.st_db.executeWriteQuery(added[['ticker', 'company', 'stock_index']], 'tickers')
+        if removed:
+            qry = '''
+            UPDATE
+                SMART_TRADING.ticker_membership
+            SET
+                valid_to = %s
+            WHERE
+                stock_index = %s AND valid_to IS NULL AND ticker IN ({})
+            '''.format(', '.join(['%s'] * len(removed)))
+            self.st_db.executeQuery(qry, tuple([as_of, stock_index] + removed))
+        self.logger.info('{}: {} tickers added, {} removed as of {}.'.format(
+            stock_index, added.shape[0], len(removed), as_of))
+        return list(added['ticker']), removed
+
+
+    def get_members(self, stock_index, as_of=None):
+        '''Tickers in the index on a date, today by default
+
+        Membership of an index never refreshed is seeded from the tickers table first,
+        so deployments predating membership tracking keep their tickers.
+        '''
+        as_of = as_of or dt.date.today()
+        qry = '''
+        SELECT
+            ticker
+        FROM
+            SMART_TRADING.ticker_membership
+        WHERE
+            stock_index = %s AND valid_from <= %s AND (valid_to IS NULL OR valid_to > %s)
+        '''
+        members = self.st_db.executeReadQuery(qry, (stock_index, as_of, as_of))
+        if members.shape[0] == 0 and self._open_members(stock_index).shape[0] == 0:
+            self._seed_from_tickers(stock_index)
+            members = self.st_db.executeReadQuery(qry, (stock_index, as_of, as_of))
+        return list(members['ticker'])
+
+
+if __name__ == '__main__':
+    st_logger = logger('Universe')
+    args = parse_args()
+    st_db = DBWrapper('SMART_TRADING')
+    cache = ResponseCache(RESPONSE_CACHE_PATH, ttl_sec=RESPONSE_CACHE_TTL_SEC,
+                          max_bytes=RESPONSE_CACHE_MAX_BYTES, replay=args.replay)
+    universe = Universe(st_db=st_db, st_logger=st_logger, cache=cache)
+    for stock_index in ([args.stock_index] if args.stock_index else list(SOURCES)):
+        universe.refresh(stock_index)
+    st_db.close()
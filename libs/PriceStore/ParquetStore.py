@@ -0,0 +1,168 @@
+import os
+import threading
+import time
+import uuid
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from libs.st_logger.logger import logger
+
+
+# Column holding the bar timestamp per price type, matching the database tables
+TS_COLS = {'daily': 'dt', 'intraday': 'ts'}
+
+SCHEMA = pa.schema([
+    ('ts', pa.timestamp('s')),
+    ('open', pa.float32()),
+    ('high', pa.float32()),
+    ('low', pa.float32()),
+    ('close', pa.float32()),
+    ('volume', pa.int64()),
+])
+
+COMPACTED_FILE = 'part-0-compacted.parquet' # sorts before every delta file
+
+_stamp_lock = threading.Lock()
+_last_stamp = 0
+
+
+def _next_stamp():
+    '''Nanosecond stamp increasing with every call, so delta file names sort in write order'''
+    global _last_stamp
+    with _stamp_lock:
+        _last_stamp = max(time.time_ns(), _last_stamp + 1)
+        return _last_stamp
+
+
+class ParquetStore(object):
+    '''
+    A columnar price store of Parquet files partitioned by price_type/ticker/year
+
+    Each write appends a new delta file to the partitions it touches, so past
+    history is never copied again. `compact()` periodically merges the deltas of
+    a partition into one file. Bars are stored with typed columns (timestamp,
+    float32 OHLC, int64 volume), and reads are memory mapped through Arrow.
+
+    Layout: <root>/price_type=<type>/ticker=<ticker>/year=<yyyy>/part-*.parquet
+
+    ...
+
+    Attributes
+    ----------
+    root : str
+        root directory of the store
+
+    Methods
+    -------
+    append(ticker_prices, price_type)
+        writes prices as delta files into their partitions
+    read(price_type, tickers=None, start=None, end=None)
+        reads prices into a dataframe indexed by ticker and timestamp
+    compact(price_type=None)
+        merges delta files of each partition into one, dropping duplicate bars
+    '''
+
+    def __init__(self, root):
+        self.root = root
+        self.logger = logger('ParquetStore')
+        os.makedirs(self.root, exist_ok=True)
+
+
+    def _partition_dir(self, price_type, ticker, year):
+        return os.path.join(self.root, 'price_type={}'.format(price_type),
+                            'ticker={}'.format(ticker), 'year={}'.format(year))
+
+
+    def _to_table(self, df):
+        '''Convert prices with a "ts" column to an Arrow table of the store schema'''
+        return pa.Table.from_pandas(df[SCHEMA.names], schema=SCHEMA, preserve_index=False)
+
+
+    def append(self, ticker_prices, price_type):
+        '''Write prices as one delta file per (ticker, year) partition
+
+        Parameters
+        ----------
+        ticker_prices : pandas.DataFrame
+            Prices indexed by ticker and timestamp, as returned by Stock.get_prices_av
+        price_type : str
+            Type of price, 'intraday' or 'daily'
+        '''
+        df = ticker_prices.reset_index()
+        df = df.rename({TS_COLS[price_type]: 'ts', 'index': 'ts'}, axis=1)
+        df['ts'] = pd.to_datetime(df['ts'])
+        # Fixed width, and prefixed so names sort after the second resolution ones of older stores
+        stamp = 'n{:020d}'.format(_next_stamp())
+        n_files = 0
+        for (ticker, year), part in df.groupby(['ticker', df['ts'].dt.year]):
+            part_dir = self._partition_dir(price_type, ticker, year)
+            os.makedirs(part_dir, exist_ok=True)
+            filename = 'part-{}-{}.parquet'.format(stamp, uuid.uuid4().hex[:8])
+            pq.write_table(self._to_table(part.sort_values('ts')),
+                           os.path.join(part_dir, filename))
+            n_files += 1
+        return n_files
+
+
+    def read(self, price_type, tickers=None, start=None, end=None, as_arrow=False):
+        '''Read prices of the given tickers (all if None) between start and end inclusive
+
+        Returns
+        -------
+        pandas.DataFrame or pyarrow.Table
+            Prices indexed by ticker and timestamp, latest written bar kept for duplicates
+        '''
+        path = os.path.join(self.root, 'price_type={}'.format(price_type))
+        ts_col = TS_COLS[price_type]
+        if not os.path.isdir(path):
+            return pd.DataFrame(columns=['ticker', ts_col] + SCHEMA.names[1:]) \
+                .set_index(['ticker', ts_col])
+        filters = []
+        if tickers:
+            filters.append(('ticker', 'in', list(tickers)))
+        if start is not None:
+            start = pd.Timestamp(start)
+            filters.append(('year', '>=', start.year))
+            filters.append(('ts', '>=', start.to_pydatetime()))
+        if end is not None:
+            end = pd.Timestamp(end)
+            filters.append(('year', '<=', end.year))
+            filters.append(('ts', '<=', end.to_pydatetime()))
+        table = pq.read_table(path, columns=['ticker'] + SCHEMA.names,
+                              filters=filters or None, memory_map=True)
+        if as_arrow:
+            return table
+        df = table.to_pandas()
+        df['ticker'] = df['ticker'].astype(str)
+        # Files are read in path order so later deltas win over earlier ones
+        df = df.drop_duplicates(['ticker', 'ts'], keep='last') \
+            .sort_values(['ticker', 'ts']) \
+            .rename({'ts': ts_col}, axis=1) \
+            .set_index(['ticker', ts_col])
+        return df
+
+
+    def compact(self, price_type=None):
+        '''Merge delta files of each partition into one file, keeping latest duplicate bars'''
+        n_compacted = 0
+        for dirpath, _, filenames in os.walk(self.root):
+            files = sorted(f for f in filenames if f.endswith('.parquet'))
+            if len(files) < 2:
+                continue
+            if price_type and 'price_type={}'.format(price_type) not in dirpath:
+                continue
+            df = pd.concat([pq.read_table(os.path.join(dirpath, f), memory_map=True).to_pandas()
+                            for f in files], ignore_index=True)
+            df = df.drop_duplicates('ts', keep='last').sort_values('ts')
+            # Underscore prefixed files are ignored by readers until renamed
+            tmp_path = os.path.join(dirpath, '_' + COMPACTED_FILE)
+            pq.write_table(self._to_table(df), tmp_path)
+            os.replace(tmp_path, os.path.join(dirpath, COMPACTED_FILE))
+            for f in files:
+                if f != COMPACTED_FILE:
+                    os.remove(os.path.join(dirpath, f))
+            n_compacted += 1
+        self.logger.info('Compacted {} partitions.'.format(n_compacted))
+        return n_compacted
@@ -0,0 +1,267 @@
+import json
+import os
+import threading
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from libs.st_logger.logger import logger
+
+
+FIELDS = ['open', 'high', 'low', 'close', 'volume']
+DTYPES = {'ts': np.int64, 'open': np.float32, 'high': np.float32, 'low': np.float32,
+          'close': np.float32, 'volume': np.int64}
+INDEX_FILE = 'index.json'
+
+# Column holding the bar timestamp per price type, matching the database tables
+TS_COLS = {'daily': 'dt', 'intraday': 'ts'}
+
+Bars = namedtuple('Bars', ['ts'] + FIELDS)
+Bars.__doc__ = '''Bars of one ticker sorted by time, ts as int64 epoch seconds'''
+
+
+def to_epoch_sec(timestamp):
+    '''Convert a datetime-like or epoch seconds to int64 epoch seconds'''
+    if isinstance(timestamp, (int, np.integer)):
+        return int(timestamp)
+    return int(pd.Timestamp(timestamp).value // 10**9)
+
+
+def typical_price(high, low, close):
+    '''Typical price (high + low + close) / 3 of bars in float64, the price every VWAP weights by volume'''
+    return (np.asarray(high, dtype=np.float64) + np.asarray(low, dtype=np.float64) +
+            np.asarray(close, dtype=np.float64)) / 3
+
+
+class PriceStore(object):
+    '''
+    An in-memory store of price bars per ticker in contiguous sorted NumPy arrays
+
+    Each ticker holds a timestamp array (int64 epoch seconds) and one array per
+    field (float32 OHLC, int64 volume) with spare capacity, so appending newer bars
+    is amortized O(1). Range lookups are binary searches returning views into the
+    arrays without copying. The store can be snapshot to a directory of .npy files
+    and restored memory mapped, so consumers start warm without reading MySQL.
+
+    ...
+
+    Methods
+    -------
+    append(ticker, ts, **fields)
+        adds bars of a ticker, replacing bars with the same timestamp
+    append_frame(ticker_prices)
+        adds bars from a dataframe indexed by ticker and timestamp
+    slice(ticker, start=None, end=None)
+        returns bars between start and end inclusive as views
+    to_frame(ticker, start=None, end=None, ts_name='dt')
+        returns bars between start and end inclusive as a dataframe
+    load_from_db(st_db, price_type, tickers=None, start=None)
+        fills the store from daily_prices or intraday_prices
+    snapshot(path)
+        saves all bars to a directory
+    restore(path)
+        loads a snapshot memory mapped, class method
+    '''
+
+    def __init__(self):
+        self._arrays = {}
+        self._size = {}
+        self._lock = threading.Lock()
+        self.logger = logger('PriceStore')
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+    def __contains__(self, ticker):
+        return ticker in self._size
+
+
+    def __len__(self):
+        return len(self._size)
+
+
+    def tickers(self):
+        return list(self._size)
+
+
+    def _reserve(self, ticker, capacity):
+        '''Grow arrays of ticker to hold at least capacity bars, doubling to amortize appends'''
+        arrays = self._arrays.get(ticker)
+        if arrays is not None and len(arrays['ts']) >= capacity:
+            return arrays
+        size = self._size.get(ticker, 0)
+        new_capacity = max(capacity, 2 * len(arrays['ts']) if arrays is not None else 0, 16)
+        new_arrays = {}
+        for name, dtype in DTYPES.items():
+            new_arrays[name] = np.empty(new_capacity, dtype=dtype)
+            if arrays is not None:
+                new_arrays[name][:size] = arrays[name][:size]
+        self._arrays[ticker] = new_arrays
+        return new_arrays
+
+
+    def append(self, ticker, ts, **fields):
+        '''Add bars of a ticker, bars with an existing timestamp replace the stored ones
+
+        Parameters
+        ----------
+        ticker : str
+            Ticker of the bars
+        ts : array-like
+            Bar timestamps as int64 epoch seconds
+        **fields : array-like
+            One array per field in FIELDS, aligned with ts
+        '''
+        ts = np.asarray(ts, dtype=np.int64)
+        if len(ts) == 0:
+            return
+        order = np.argsort(ts, kind='stable')
+        new = {'ts': ts[order]}
+        for name in FIELDS:
+            new[name] = np.asarray(fields[name], dtype=DTYPES[name])[order]
+
+        with self._lock:
+            size = self._size.get(ticker, 0)
+            last_ts = self._arrays[ticker]['ts'][size-1] if size else None
+            if last_ts is None or new['ts'][0] > last_ts:
+                # Fast path, all bars are newer than the stored ones
+                arrays = self._reserve(ticker, size + len(ts))
+                for name in DTYPES:
+                    arrays[name][size:size+len(ts)] = new[name]
+                self._size[ticker] = size + len(ts)
+                return
+
+            # Overlapping bars, merge keeping the newly appended bar for equal timestamps
+            arrays = self._arrays[ticker]
+            merged = {name: np.concatenate([arrays[name][:size], new[name]]) for name in DTYPES}
+            order = np.argsort(merged['ts'], kind='stable')
+            merged_ts = merged['ts'][order]
+            keep = np.append(merged_ts[1:] != merged_ts[:-1], True)
+            idx = order[keep]
+            self._arrays[ticker] = {name: merged[name][idx] for name in DTYPES}
+            self._size[ticker] = len(idx)
+
+
+    def append_frame(self, ticker_prices):
+        '''Add bars from a dataframe indexed by ticker and timestamp, e.g. from Stock.get_prices_av'''
+        df = ticker_prices.reset_index()
+        ts_col = df.columns[1]
+        for ticker, part in df.groupby('ticker', sort=False):
+            ts = pd.to_datetime(part[ts_col]).values.astype('datetime64[s]').astype(np.int64)
+            self.append(ticker, ts, **{name: part[name].values for name in FIELDS})
+
+
+    def slice(self, ticker, start=None, end=None):
+        '''Return bars of ticker between start and end inclusive as views, in O(log n)'''
+        size = self._size.get(ticker, 0)
+        if not size:
+            return Bars(*[np.empty(0, dtype=DTYPES[name]) for name in Bars._fields])
+        arrays = self._arrays[ticker]
+        ts = arrays['ts'][:size]
+        i = 0 if start is None else int(np.searchsorted(ts, to_epoch_sec(start), side='left'))
+        j = size if end is None else int(np.searchsorted(ts, to_epoch_sec(end), side='right'))
+        return Bars(*[arrays[name][i:j] for name in Bars._fields])
+
+
+    def to_frame(self, ticker, start=None, end=None, ts_name='dt'):
+        '''Return bars of ticker between start and end inclusive as a dataframe'''
+        bars = self.slice(ticker, start, end)
+        index = pd.MultiIndex.from_arrays(
+            [np.full(len(bars.ts), ticker, dtype=object), pd.to_datetime(bars.ts, unit='s')],
+            names=['ticker', ts_name])
+        return pd.DataFrame({name: getattr(bars, name) for name in FIELDS}, index=index)
+
+
+    def load_from_db(self, st_db, price_type, tickers=None, start=None):
+        '''Fill the store from daily_prices or intraday_prices, streamed in chunks
+
+        Parameters
+        ----------
+        st_db : PyDB.DBWrapper.DBWrapper
+            DBWrapper object for interacting with database
+        price_type : str
+            Type of price, 'intraday' or 'daily'
+        tickers : list[str], optional
+            Tickers to load, all if None
+        start : str or datetime-like, optional
+            Load bars at or after start
+        '''
+        ts_col = TS_COLS[price_type]
+        conditions, params = [], []
+        if tickers:
+            conditions.append('ticker IN ({})'.format(', '.join(['%s'] * len(tickers))))
+            params.extend(tickers)
+        if start is not None:
+            conditions.append('{} >= %s'.format(ts_col))
+            params.append(pd.Timestamp(start).to_pydatetime())
+        qry = '''
+        SELECT
+            ticker, {ts_col}, open, high, low, close, volume
+        FROM
+            SMART_TRADING.{price_type}_prices
+        {where}
+        ORDER BY
+            ticker, {ts_col}
+        '''.format(ts_col=ts_col, price_type=price_type,
+                   where='WHERE ' + ' AND '.join(conditions) if conditions else '')
+        n_rows = 0
+        for chunk in st_db.iterReadQuery(qry, tuple(params)):
+            chunk['volume'] = chunk['volume'].fillna(0)
+            self.append_frame(chunk.set_index(['ticker', ts_col]))
+            n_rows += chunk.shape[0]
+        self.logger.info('Loaded {} {} bars for {} tickers.'.format(n_rows, price_type, len(self)))
+
+
+    def snapshot(self, path):
+        '''Save all bars to path as one .npy file per field plus an offsets index
+
+        Files are written to a temporary directory and moved into place, so a store
+        restored from the same path keeps reading its (unlinked) mapped files.
+        '''
+        tmp_path = path.rstrip('/') + '.tmp'
+        os.makedirs(tmp_path, exist_ok=True)
+        with self._lock:
+            tickers = sorted(self._size)
+            offsets, start = {}, 0
+            for ticker in tickers:
+                offsets[ticker] = [start, start + self._size[ticker]]
+                start += self._size[ticker]
+            for name, dtype in DTYPES.items():
+                out = np.lib.format.open_memmap(os.path.join(tmp_path, name + '.npy'), mode='w+',
+                                                dtype=dtype, shape=(start,))
+                for ticker in tickers:
+                    i, j = offsets[ticker]
+                    out[i:j] = self._arrays[ticker][name][:j-i]
+                out.flush()
+                del out
+        with open(os.path.join(tmp_path, INDEX_FILE), 'w') as f:
+            json.dump(offsets, f)
+        os.makedirs(path, exist_ok=True)
+        for filename in [name + '.npy' for name in DTYPES] + [INDEX_FILE]:
+            os.replace(os.path.join(tmp_path, filename), os.path.join(path, filename))
+        os.rmdir(tmp_path)
+        self.logger.info('Saved snapshot of {} tickers to {}'.format(len(tickers), path))
+
+
+    @classmethod
+    def restore(cls, path):
+        '''Load a snapshot memory mapped, bars are only copied once appended to'''
+        store = cls()
+        with open(os.path.join(path, INDEX_FILE)) as f:
+            offsets = json.load(f)
+        mapped = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+                  for name in DTYPES}
+        for ticker, (i, j) in offsets.items():
+            store._arrays[ticker] = {name: mapped[name][i:j] for name in DTYPES}
+            store._size[ticker] = j - i
+        return store
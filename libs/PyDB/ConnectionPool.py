@@ -0,0 +1,179 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+POOL_SIZE = 4 # max open connections per process
+POOL_TIMEOUT_SEC = 30 # max wait for a free connection before giving up
+HEALTH_CHECK_SEC = 60 # ping connections idle for longer than this before reuse
+
+
+class ConnectionPool(object):
+    '''
+    A bounded pool of reusable database connections
+
+    Connections are created lazily by `connect` up to `pool_size`, handed out
+    one caller at a time and returned to the pool for reuse. The pool is safe
+    to share between threads, and it resets itself when used from a forked
+    child process so that parent sockets are never shared across processes.
+
+    ...
+
+    Attributes
+    ----------
+    connect : callable
+        function with no arguments returning a new DB-API connection
+    pool_size : int
+        maximum number of open connections
+    timeout : float
+        seconds to wait for a free connection before raising TimeoutError
+    health_check_sec : float
+        idle connections older than this are pinged (and reconnected) before reuse
+
+    Methods
+    -------
+    acquire()
+        check out a healthy connection, opening one if needed
+    release(con, discard=False)
+        return a connection to the pool, or close it if discarded
+    connection()
+        context manager checking out a connection for the duration of the block
+    close_all()
+        close all idle connections
+    '''
+
+    def __init__(self, connect, pool_size=POOL_SIZE, timeout=POOL_TIMEOUT_SEC,
+                 health_check_sec=HEALTH_CHECK_SEC):
+        self.connect = connect
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.health_check_sec = health_check_sec
+        self._reset()
+
+
+    def _reset(self):
+        '''Forget all connections, used on init and after a fork'''
+        self._pid = os.getpid()
+        self._cond = threading.Condition(threading.Lock())
+        self._idle = []
+        self._n_open = 0
+        # close_all starts a new generation, connections checked out before it
+        # are closed when released
+        self._generation = 0
+        self._checked_out = {}
+
+
+    def _check_pid(self):
+        # Connections inherited from a parent process share its sockets, drop
+        # them without closing (closing would end the parent's sessions)
+        if os.getpid() != self._pid:
+            self._reset()
+
+
+    def _is_healthy(self, con, last_used):
+        if time.time() - last_used < self.health_check_sec:
+            return True
+        try:
+            con.ping(reconnect=True, attempts=2, delay=1)
+            return True
+        except Exception:
+            return False
+
+
+    def acquire(self):
+        '''Check out a connection, waiting up to `timeout` seconds for a free one'''
+        self._check_pid()
+        deadline = time.time() + self.timeout
+        with self._cond:
+            while True:
+                if self._idle:
+                    con, last_used = self._idle.pop()
+                    break
+                if self._n_open < self.pool_size:
+                    self._n_open += 1
+                    con, last_used = None, None
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise TimeoutError('No free database connection after {} sec.'.format(self.timeout))
+                self._cond.wait(remaining)
+
+        if con is None or not self._is_healthy(con, last_used):
+            if con is not None:
+                self._close(con)
+            try:
+                con = self.connect()
+            except:
+                with self._cond:
+                    self._n_open -= 1
+                    self._cond.notify()
+                raise
+        with self._cond:
+            self._checked_out[id(con)] = self._generation
+        return con
+
+
+    def release(self, con, discard=False):
+        '''Return connection to the pool, closing it instead if `discard` is True'''
+        if os.getpid() != self._pid:
+            return
+        with self._cond:
+            generation = self._checked_out.pop(id(con), self._generation)
+            discard = discard or generation != self._generation
+        if not discard:
+            try:
+                con.rollback()
+            except Exception:
+                discard = True
+        if discard:
+            self._close(con)
+        with self._cond:
+            if discard:
+                self._n_open -= 1
+            else:
+                self._idle.append((con, time.time()))
+            self._cond.notify()
+
+
+    @contextmanager
+    def connection(self):
+        '''Check out a connection for the duration of the block
+
+        The connection is discarded rather than reused if the block raised
+        and the connection is no longer alive.
+        '''
+        con = self.acquire()
+        try:
+            yield con
+        except:
+            self.release(con, discard=not self._is_alive(con))
+            raise
+        else:
+            self.release(con)
+
+
+    def close_all(self):
+        '''Close all idle connections, checked out connections are closed on release'''
+        self._check_pid()
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._n_open -= len(idle)
+            self._generation += 1
+            self._cond.notify_all()
+        for con, _ in idle:
+            self._close(con)
+
+
+    def _is_alive(self, con):
+        try:
+            return con.is_connected()
+        except Exception:
+            return False
+
+
+    def _close(self, con):
+        try:
+            con.close()
+        except Exception:
+            pass
@@ -1,71 +1,475 @@
-import mysql.connector
-from os import environ
+import numpy as np
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
 from pdb import set_trace
 from libs.st_logger.logger import logger
+from libs.PyDB.ConnectionPool import ConnectionPool, POOL_SIZE
+from libs.PyDB.backends import default_backend
 import pandas as pd
 
 
+DEFAULT_BATCH_SIZE = 5000 # rows per multi-row upsert statement / transaction
+DEFAULT_CHUNK_SIZE = 50000 # rows per chunk yielded by streaming reads
+ROW_HASHES_TABLE = 'row_hashes' # content hashes of rows written by executeDiffWriteQuery
+
+
 class DBWrapper(object):
-    
-    def __init__(self, db=None):
+
+    def __init__(self, db=None, pool_size=POOL_SIZE, backend=None, cache=None):
+        '''
+        Parameters
+        ----------
+        db : str, optional
+            Database to connect to
+        pool_size : int, optional
+            Max open connections per process
+        backend : PyDB.backends.MySQLBackend or PyDB.backends.EmbeddedBackend, optional
+            Storage backend, the embedded store at environ['db_path'] if set or else
+            MySQL by default
+        cache : PyDB.QueryCache.QueryCache, optional
+            Read-through cache of executeReadQuery results, invalidated by the writes
+            of executeWriteQuery, executeDiffWriteQuery and executeQuery (default=None)
+        '''
         self.db = db
-        self.con = None
-        self.cursor = None
+        self.pool_size = pool_size
+        self.backend = backend or default_backend()
+        self.cache = cache
         self.logger = logger('DBWrapper')
-    
-    
+        self._pool = None
+        self._local = threading.local()
+
+
     def create_connection(self):
-        if self.db:
-            self.con = mysql.connector.connect(user=environ['db_user'], password=environ['db_pwd'],
-                                          host='127.0.0.1', db=self.db)
+        return self.backend.connect(self.db)
+
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = ConnectionPool(self.create_connection, pool_size=self.pool_size)
+        return self._pool
+
+
+    @contextmanager
+    def session(self):
+        '''Pin one pooled connection for every query issued in this thread within the block
+
+        Usage
+        -----
+        with st_db.session():
+            st_db.executeReadQuery(...)
+            st_db.executeWriteQuery(...)
+        '''
+        if getattr(self._local, 'con', None) is not None:
+            yield self
+            return
+        with self.pool.connection() as con:
+            self._local.con = con
+            try:
+                yield self
+            finally:
+                self._local.con = None
+
+
+    @contextmanager
+    def transaction(self):
+        '''Run every write issued in this thread within the block as one transaction
+
+        Commits of the writes are deferred to the end of the block, and all of them
+        are rolled back if the block raises.
+
+        Usage
+        -----
+        with st_db.transaction():
+            st_db.executeQuery('DELETE FROM ...')
+            st_db.executeWriteQuery(...)
+        '''
+        with self.session():
+            con = self._local.con
+            con.start_transaction()
+            self._local.in_transaction = True
+            try:
+                yield self
+                con.commit()
+            except:
+                con.rollback()
+                raise
+            finally:
+                self._local.in_transaction = False
+
+
+    def _commit(self, con):
+        if not getattr(self._local, 'in_transaction', False):
+            con.commit()
+
+
+    @contextmanager
+    def _connection(self):
+        '''Connection of the current session, or one checked out of the pool'''
+        con = getattr(self._local, 'con', None)
+        if con is not None:
+            yield con
         else:
-            self.con = mysql.connector.connect(user=environ['db_user'], password=environ['db_pwd'],
-                                          host='127.0.0.1')
-        self.cursor = self.con.cursor()
+            with self.pool.connection() as con:
+                yield con
+
 
-        
-    def executeReadQuery(self, query):
+    def close(self):
+        '''Close idle pooled connections'''
+        if self._pool is not None:
+            self._pool.close_all()
+        if self.cache is not None:
+            self.logger.info('Query cache: {}'.format(self.cache.stats()))
+
+
+    def _invalidate(self, tables=None, query=None):
+        if self.cache is None:
+            return
+        if query is not None:
+            self.cache.invalidate_query(query)
+        else:
+            self.cache.invalidate(tables)
+
+
+    def _to_records(self, df):
+        '''Convert dataframe to list of row lists with MySQL friendly values (NaN -> None)'''
+        df = df.copy()
+        for col in df.columns:
+            if pd.api.types.is_datetime64_any_dtype(df[col]):
+                df[col] = df[col].dt.strftime('%Y-%m-%d %H:%M:%S')
+        df = df.astype(object).where(pd.notnull(df), None)
+        return df.values.tolist()
+
+
+    def _upsert_batches(self, con, cursor, df, table, batch_size):
+        '''Write rows as parameterized multi-row upserts, one transaction per batch'''
+        cols = ", ".join(["`"+str(i)+"`" for i in df.columns.tolist()])
+        update_values = ", ".join(["`"+str(i)+"` = new.`"+str(i)+"`" for i in df.columns.tolist()])
+        row_placeholder = "(" + ", ".join(["%s"] * df.shape[1]) + ")"
+        if self.backend.max_params:
+            batch_size = max(1, min(batch_size, self.backend.max_params // max(df.shape[1], 1)))
+        records = self._to_records(df)
+        n_batches = 0
+        for start in range(0, len(records), batch_size):
+            batch = records[start:start+batch_size]
+            query = '''INSERT INTO {table} ({cols})
+            VALUES {rows} AS new
+            ON DUPLICATE KEY UPDATE {uv}
+            '''.format(table=table, cols=cols,
+                       rows=", ".join([row_placeholder] * len(batch)), uv=update_values)
+            try:
+                cursor.execute(query, [v for row in batch for v in row])
+                self._commit(con)
+            except:
+                con.rollback()
+                raise
+            n_batches += 1
+        return n_batches
+
+
+    def _upsert_load_infile(self, con, cursor, df, table):
+        '''Stage rows through LOAD DATA LOCAL INFILE into a temporary table and merge in one statement'''
+        cols = ", ".join(["`"+str(i)+"`" for i in df.columns.tolist()])
+        update_values = ", ".join(["`"+str(i)+"` = new.`"+str(i)+"`" for i in df.columns.tolist()])
+        staging = '_staging_{}'.format(table.split('.')[-1])
+        fd, filepath = tempfile.mkstemp(suffix='.csv')
+        os.close(fd)
         try:
-            self.create_connection()
-            self.cursor.execute(query)
-            dat = self.cursor.fetchall()
-            cols = [column[0] for column in self.cursor.description]
-            df = pd.DataFrame(dat, columns=cols)
+            df.to_csv(filepath, header=False, index=False, na_rep='\\N',
+                      date_format='%Y-%m-%d %H:%M:%S')
+            cursor.execute('DROP TEMPORARY TABLE IF EXISTS {}'.format(staging))
+            # Not LIKE, which MySQL rejects for partitioned tables; only column types are copied
+            cursor.execute('CREATE TEMPORARY TABLE {stg} SELECT {cols} FROM {table} WHERE 1 = 0'
+                           .format(stg=staging, cols=cols, table=table))
+            cursor.execute('''LOAD DATA LOCAL INFILE '{path}' INTO TABLE {stg}
+            FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '"'
+            LINES TERMINATED BY '\\n' ({cols})
+            '''.format(path=filepath, stg=staging, cols=cols))
+            cursor.execute('''INSERT INTO {table} ({cols})
+            SELECT * FROM (SELECT {cols} FROM {stg}) AS new
+            ON DUPLICATE KEY UPDATE {uv}
+            '''.format(table=table, cols=cols, stg=staging, uv=update_values))
+            self._commit(con)
+            cursor.execute('DROP TEMPORARY TABLE IF EXISTS {}'.format(staging))
         except:
-            raise Exception('Could not read data from MySQL.')
+            con.rollback()
+            raise
         finally:
-            self.con.close()
+            os.remove(filepath)
+        return 1
+
+
+    def _typed_frame(self, rows, description):
+        return self.backend.typed_frame(rows, description)
+
+
+    def _read(self, query, params=None):
+        with self._connection() as con:
+            cursor = con.cursor()
+            cursor.execute(query, params)
+            df = self.backend.read_frame(cursor)
+            cursor.close()
         return df
-    
-    
-    def executeWriteQuery(self, df, table, index=False):
+
+
+    def executeReadQuery(self, query, params=None, cache=True):
+        '''Run a select query and return all rows as a typed dataframe
+
+        Parameters
+        ----------
+        query : str
+            SQL query, with %s placeholders for params
+        params : tuple or dict, optional
+            Parameters bound to the query placeholders
+        cache : bool, optional
+            False to bypass the query cache, for reads that must see writes made
+            outside DBWrapper (default=True)
+        '''
+        try:
+            if self.cache is not None and cache:
+                df = self.cache.fetch(query, params, lambda: self._read(query, params),
+                                      namespace='{}/{}'.format(self.backend.name, self.db))
+            else:
+                df = self._read(query, params)
+        except:
+            raise Exception('Could not read data from MySQL.')
+        return df
+
+
+    def iterReadQuery(self, query, params=None, chunksize=DEFAULT_CHUNK_SIZE, as_records=False):
+        '''Stream a select query in fixed size chunks through an unbuffered cursor
+
+        Rows are read from the server as chunks are consumed, so large scans run in
+        bounded memory and the first chunk arrives before the query completes. The
+        scan holds its own pooled connection until the generator is exhausted or closed.
+
+        Parameters
+        ----------
+        query : str
+            SQL query, with %s placeholders for params
+        params : tuple or dict, optional
+            Parameters bound to the query placeholders
+        chunksize : int, optional
+            Rows per yielded chunk
+        as_records : bool, optional
+            True to yield NumPy record arrays instead of dataframes (default=False)
+
+        Yields
+        ------
+        pandas.DataFrame or numpy.recarray
+            Chunks of at most chunksize rows with dtypes taken from the table schema
+        '''
+        with self.pool.connection() as con:
+            cursor = con.cursor(buffered=False)
+            exhausted = False
+            try:
+                cursor.execute(query, params)
+                while True:
+                    rows = cursor.fetchmany(chunksize)
+                    if not rows:
+                        exhausted = True
+                        break
+                    chunk = self._typed_frame(rows, cursor.description)
+                    yield chunk.to_records(index=False) if as_records else chunk
+            finally:
+                # Unread rows must be discarded before the connection can be reused
+                if not exhausted:
+                    con.consume_results()
+                cursor.close()
+
+
+    def executeWriteQuery(self, df, table, index=False, batch_size=DEFAULT_BATCH_SIZE,
+                          load_infile=False):
+        '''Upsert dataframe rows into table
+
+        Parameters
+        ----------
+        df : pandas.DataFrame
+            Rows to write, column names must match the table
+        table : str
+            Name of the table to write to
+        index : bool, optional
+            True if index levels are to be written as columns (default=False)
+        batch_size : int, optional
+            Rows per multi-row upsert statement, each committed as one transaction
+        load_infile : bool, optional
+            True to stage rows through LOAD DATA LOCAL INFILE into a temporary table
+            and merge with a single upsert, for very large frames (default=False).
+            Backends without LOAD DATA write batched upserts instead
+
+        Returns
+        -------
+        dict
+            Row count, batch count, elapsed seconds and rows per second of the write
+        '''
+        t_start = time.time()
         try:
-            self.create_connection()
             if index:
-                df.reset_index(inplace=True)
-            cols = "`,`".join([str(i) for i in df.columns.tolist()])
-            update_values = ", ".join(["`"+str(i)+"`= new.`"+str(i)+"`" for i in df.columns.tolist()])
-            for index, row in df.iterrows():
-                query = '''INSERT INTO {table} (`{cols}`)
-                VALUES {row} as new
-                ON DUPLICATE KEY UPDATE {uv}
-                '''.format(table=table, cols=cols, row=tuple(row.values), uv=update_values)
-                self.cursor.execute(query)
-                self.con.commit()
-            self.logger.info('''Successfully inserted {r} rows to {table}
-            '''.format(r=df.shape[0],table=table))
+                df = df.reset_index()
+            with self._connection() as con:
+                cursor = con.cursor()
+                if load_infile and self.backend.load_infile:
+                    n_batches = self._upsert_load_infile(con, cursor, df, table)
+                else:
+                    n_batches = self._upsert_batches(con, cursor, df, table, batch_size)
+                cursor.close()
+        except:
+            raise Exception('Could not write data to MySQL.')
+        finally:
+            # Also after a failure, earlier batches may have been committed
+            self._invalidate([table])
+        t_elapsed = time.time() - t_start
+        stats = {'table': table, 'rows': df.shape[0], 'batches': n_batches,
+                 'seconds': round(t_elapsed, 4),
+                 'rows_per_sec': round(df.shape[0] / t_elapsed, 1) if t_elapsed > 0 else None}
+        self.logger.info('''Successfully inserted {r} rows to {table} in {b} batches
+        ({s} sec, {rps} rows/sec)'''.format(r=stats['rows'], table=table, b=n_batches,
+                                            s=stats['seconds'], rps=stats['rows_per_sec']))
+        return stats
+
+
+    def _row_keys(self, df, key_cols):
+        keys = df[key_cols[0]].astype(str)
+        for col in key_cols[1:]:
+            keys = keys + '|' + df[col].astype(str)
+        return keys.tolist()
+
+
+    def _row_hashes(self, df):
+        '''64-bit hashes of the rows of df, independent of the dtypes the values are held in
+
+        Hashes depend on dtypes, so columns are cast to canonical ones first: integers
+        and booleans to int64, kept exact as volumes exceed the float32 mantissa, floats
+        to float64 rounded through float32 as prices are stored as MySQL FLOAT,
+        datetimes to datetime64[ns] and everything else to object with None for nulls.
+        '''
+        canonical = {}
+        for col in df.columns:
+            values = df[col]
+            if (pd.api.types.is_bool_dtype(values) or pd.api.types.is_integer_dtype(values)) \
+                    and not values.isna().any():
+                canonical[col] = values.to_numpy(dtype=np.int64)
+            elif pd.api.types.is_float_dtype(values):
+                canonical[col] = values.to_numpy(dtype=np.float64, na_value=np.nan) \
+                    .astype(np.float32).astype(np.float64)
+            elif pd.api.types.is_datetime64_any_dtype(values):
+                canonical[col] = pd.to_datetime(values).astype('datetime64[ns]')
+            else:
+                canonical[col] = values.astype(object).where(values.notna(), None)
+        return pd.util.hash_pandas_object(pd.DataFrame(canonical, index=df.index),
+                                          index=False).to_numpy().view(np.int64)
+
+
+    def _row_dates(self, values):
+        '''Dates of a timestamp key column as objects, None if the column holds no timestamps'''
+        if not pd.api.types.is_datetime64_any_dtype(values):
+            return np.full(len(values), None, dtype=object)
+        return np.array(pd.to_datetime(values).dt.date, dtype=object)
+
+
+    def _stored_hashes(self, cursor, table, keys, batch_size):
+        stored = {}
+        for start in range(0, len(keys), batch_size):
+            batch = keys[start:start+batch_size]
+            cursor.execute('''SELECT row_key, row_hash FROM {rh}
+            WHERE table_name = %s AND row_key IN ({keys})
+            '''.format(rh=ROW_HASHES_TABLE, keys=", ".join(["%s"] * len(batch))),
+                           [table] + batch)
+            stored.update(cursor.fetchall())
+        return stored
+
+
+    def executeDiffWriteQuery(self, df, table, key_cols, index=False,
+                              batch_size=DEFAULT_BATCH_SIZE):
+        '''Upsert only the rows of df that are new or changed since they were last written
+
+        A 64-bit hash of the non-key columns of every row is kept in the row_hashes
+        table. Incoming rows are hashed and compared against the stored hashes of their
+        keys, and only inserted or changed rows are written, together with their new
+        hashes. Rows written to table by other means are not tracked, so tables are to
+        be written through this method consistently. When the last key column holds
+        timestamps, its date is kept with the hash, so hashes of expired rows can be
+        pruned by an index range.
+
+        Parameters
+        ----------
+        df : pandas.DataFrame
+            Rows to write, column names must match the table
+        table : str
+            Name of the table to write to
+        key_cols : list[str]
+            Primary key columns of the table
+        index : bool, optional
+            True if index levels are to be written as columns (default=False)
+        batch_size : int, optional
+            Rows per multi-row upsert statement and per hash lookup
+
+        Returns
+        -------
+        dict
+            Inserted, updated and unchanged row counts, and elapsed seconds
+        '''
+        t_start = time.time()
+        if index:
+            df = df.reset_index()
+        keys = self._row_keys(df, key_cols)
+        content_cols = [col for col in df.columns if col not in key_cols]
+        hashes = self._row_hashes(df[content_cols])
+        try:
+            with self._connection() as con:
+                cursor = con.cursor()
+                stored = self._stored_hashes(cursor, table, keys, batch_size)
+                is_new = np.array([key not in stored for key in keys], dtype=bool)
+                stored_hashes = np.array([stored.get(key, 0) for key in keys], dtype=np.int64)
+                changed = is_new | (stored_hashes != hashes)
+                if changed.any():
+                    # Hashes after data, so a failure in between only causes a rewrite
+                    self._upsert_batches(con, cursor, df[changed], table, batch_size)
+                    hash_df = pd.DataFrame({'table_name': table,
+                                            'row_key': np.array(keys, dtype=object)[changed],
+                                            'row_hash': hashes[changed],
+                                            'row_dt': self._row_dates(df[key_cols[-1]])[changed]})
+                    self._upsert_batches(con, cursor, hash_df, ROW_HASHES_TABLE, batch_size)
+                cursor.close()
         except:
             raise Exception('Could not write data to MySQL.')
         finally:
-            self.con.close()
-            
-            
-    def executeQuery(self, query):
+            self._invalidate([table, ROW_HASHES_TABLE])
+        n_inserted = int(is_new.sum())
+        stats = {'table': table, 'rows': int(changed.sum()), 'inserted': n_inserted,
+                 'updated': int(changed.sum()) - n_inserted,
+                 'unchanged': int((~changed).sum()),
+                 'seconds': round(time.time() - t_start, 4)}
+        self.logger.info('''Diff upsert to {table}: {i} inserted, {u} updated, {n} unchanged rows
+        ({s} sec)'''.format(table=table, i=stats['inserted'], u=stats['updated'],
+                              n=stats['unchanged'], s=stats['seconds']))
+        return stats
+
+
+    def executeQuery(self, query, params=None):
         try:
-            self.create_connection()
-            self.cursor.execute(query)
-            self.con.commit()
+            with self._connection() as con:
+                cursor = con.cursor()
+                cursor.execute(query, params)
+                self._commit(con)
+                cursor.close()
         except:
             raise ValueError('Could not read data from MySQL.')
         finally:
-            self.con.close()
+            self._invalidate(query=query)
+
+
+    def __getstate__(self):
+        # Connections, locks and sessions are per process, workers open their own pool
+        self_dict = self.__dict__.copy()
+        self_dict['_pool'] = None
+        del self_dict['_local']
+        return self_dict
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
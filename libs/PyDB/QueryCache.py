@@ -0,0 +1,357 @@
+import hashlib
+import os
+import pickle
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from libs.st_logger.logger import logger
+
+
+DEFAULT_MAX_BYTES = 256 * 1024**2 # in-memory result size above which least recently used results are evicted
+DEFAULT_DISK_MAX_BYTES = 2 * 1024**3 # on-disk result size above which least recently used results are evicted
+EVICT_TO = 0.9 # fraction of disk_max_bytes evicted down to, so evictions are not rescanned on every write
+ALL_TABLES = '_all' # invalidation mark of statements whose tables cannot be told
+
+TOKEN_RE = re.compile(r'[A-Za-z_][\w$]*')
+# Tables written by a statement: INSERT INTO, UPDATE, DELETE FROM, ALTER/DROP/TRUNCATE TABLE,
+# RENAME TABLE ... TO, CREATE TABLE/VIEW and REPLACE INTO
+WRITE_TABLE_RE = re.compile(r'\b(?:INTO|UPDATE|FROM|TABLE|TO|VIEW|EXISTS)\s+`?([\w$.]+)`?', re.IGNORECASE)
+# Results that change without a write, or describe the schema rather than table rows
+UNCACHEABLE_RE = re.compile(r'\b(?:information_schema|sqlite_master|NOW|CURDATE|CURTIME|SYSDATE|'
+                            r'CURRENT_DATE|CURRENT_TIME|CURRENT_TIMESTAMP|RAND|RANDOM|UUID)\b',
+                            re.IGNORECASE)
+
+
+def _table_name(name):
+    '''Table name without schema and quotes, lower case'''
+    return name.strip('`"').split('.')[-1].strip('`"').lower()
+
+
+class QueryCache(object):
+    '''
+    A read-through cache of query results with table-level invalidation
+
+    Results are keyed by the whitespace normalized SQL and its parameters, and kept
+    in a memory tier bounded in bytes with least recently used eviction, and
+    optionally on disk where they are shared by processes. Every result remembers
+    the identifiers of its query and when the query started; a write to a table
+    marks the table invalidated, and results whose query names a marked table and
+    started before the mark are stale. Marks are kept on disk next to the results,
+    so writes of one process invalidate the results of all. Writes made outside
+    DBWrapper are not seen, `ttl_sec` bounds how stale such results can get.
+
+    ...
+
+    Attributes
+    ----------
+    max_bytes : int
+        size of results kept in memory above which least recently used ones are evicted
+    cache_dir : str
+        directory of the on-disk tier, None for a memory only cache
+    disk_max_bytes : int
+        size of results on disk above which least recently used ones are evicted
+    ttl_sec : float
+        seconds a result is served for at most, None for no limit
+    dependents : dict[str, list[str]]
+        views reading each table, invalidated together with the table
+
+    Methods
+    -------
+    fetch(query, params, read_fn, namespace='')
+        cached result of the query, else calls read_fn and caches its result
+    invalidate(tables)
+        mark tables written, dropping the results reading them
+    invalidate_query(query)
+        invalidate the tables written by a statement, or all if they cannot be told
+    clear()
+        drop all cached results
+    stats()
+        hit, miss and eviction counts and sizes of both tiers
+    '''
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, cache_dir=None,
+                 disk_max_bytes=DEFAULT_DISK_MAX_BYTES, ttl_sec=None, dependents=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.ttl_sec = ttl_sec
+        self.dependents = {_table_name(table): [_table_name(view) for view in views]
+                           for table, views in (dependents or {}).items()}
+        self.logger = logger('QueryCache')
+        if self.cache_dir:
+            os.makedirs(os.path.join(self.cache_dir, 'marks'), exist_ok=True)
+        self._reset()
+
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._n_bytes = 0
+        # Running total size on disk, scanned once and kept up to date by writes and removals
+        self._disk_bytes = self._scan_disk()[1] if self.cache_dir else 0
+        self._marks = {}
+        self._marks_mtime = None
+        self._stats = dict.fromkeys(['hits', 'disk_hits', 'misses', 'stale', 'uncacheable',
+                                     'evictions', 'invalidations'], 0)
+
+
+    def _key(self, namespace, query, params):
+        raw = '\x00'.join([namespace, ' '.join(query.split()), repr(params)])
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.pkl')
+
+
+    def _refresh_marks(self):
+        '''Reload invalidation marks written by other processes, if any changed'''
+        if not self.cache_dir:
+            return
+        marks_dir = os.path.join(self.cache_dir, 'marks')
+        try:
+            mtime = os.stat(marks_dir).st_mtime_ns
+        except OSError:
+            return
+        if mtime == self._marks_mtime:
+            return
+        for entry in os.scandir(marks_dir):
+            if entry.name.endswith('.tmp'):
+                continue
+            try:
+                marked = entry.stat().st_mtime
+            except OSError:
+                continue
+            if marked > self._marks.get(entry.name, 0):
+                self._marks[entry.name] = marked
+        self._marks_mtime = mtime
+
+
+    def _is_fresh(self, entry):
+        started, tokens = entry['started'], entry['tokens']
+        if self.ttl_sec is not None and time.time() - started > self.ttl_sec:
+            return False
+        if self._marks.get(ALL_TABLES, 0) >= started:
+            return False
+        return all(self._marks.get(token, 0) < started for token in tokens)
+
+
+    def _remember(self, key, entry):
+        '''Add a result to the memory tier and evict least recently used ones over max_bytes'''
+        if entry['n_bytes'] > self.max_bytes:
+            return
+        if key in self._entries:
+            self._n_bytes -= self._entries.pop(key)['n_bytes']
+        self._entries[key] = entry
+        self._n_bytes += entry['n_bytes']
+        while self._n_bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._n_bytes -= evicted['n_bytes']
+            self._stats['evictions'] += 1
+
+
+    def _read_disk(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                entry = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if not self._is_fresh(entry):
+            self._remove_disk(path)
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry
+
+
+    def _write_disk(self, key, entry):
+        '''Store a result, written atomically so concurrent readers never see partial files'''
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            replaced = os.path.getsize(path)
+        except OSError:
+            replaced = 0
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except:
+            os.remove(tmp_path)
+            raise
+        self._disk_bytes += os.path.getsize(path) - replaced
+        # Results written by other processes are counted by the scan of the next eviction
+        if self._disk_bytes > self.disk_max_bytes:
+            self._evict_disk()
+
+
+    def _remove_disk(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+        self._disk_bytes -= size
+
+
+    def _scan_disk(self):
+        '''Last use, size and path of all results on disk, and their total size'''
+        files = []
+        total = 0
+        for shard in os.scandir(self.cache_dir):
+            if not shard.is_dir() or shard.name == 'marks':
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith('.pkl'):
+                    st = entry.stat()
+                    files.append((st.st_mtime, st.st_size, entry.path))
+                    total += st.st_size
+        return files, total
+
+
+    def _evict_disk(self):
+        '''Remove least recently used results until total size is within EVICT_TO of disk_max_bytes'''
+        files, total = self._scan_disk()
+        self._disk_bytes = total
+        if total <= self.disk_max_bytes:
+            return
+        files.sort()
+        for _, size, path in files:
+            if total <= self.disk_max_bytes * EVICT_TO:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self._stats['evictions'] += 1
+        self._disk_bytes = total
+
+
+    def fetch(self, query, params, read_fn, namespace=''):
+        '''Cached result of the query, else read, cache and return it
+
+        Parameters
+        ----------
+        query : str
+            SQL query
+        params : tuple or dict
+            Parameters bound to the query placeholders
+        read_fn : callable
+            function with no arguments running the query and returning a dataframe
+        namespace : str, optional
+            Database the query runs against, results of different ones never mix
+
+        Returns
+        -------
+        pandas.DataFrame
+            A copy of the result, callers may modify it
+        '''
+        if UNCACHEABLE_RE.search(query):
+            with self._lock:
+                self._stats['uncacheable'] += 1
+            return read_fn()
+        key = self._key(namespace, query, params)
+        with self._lock:
+            self._refresh_marks()
+            entry = self._entries.get(key)
+            if entry is not None:
+                if self._is_fresh(entry):
+                    self._entries.move_to_end(key)
+                    self._stats['hits'] += 1
+                    return entry['frame'].copy()
+                self._n_bytes -= self._entries.pop(key)['n_bytes']
+                self._stats['stale'] += 1
+            if self.cache_dir:
+                entry = self._read_disk(key)
+                if entry is not None:
+                    self._remember(key, entry)
+                    self._stats['disk_hits'] += 1
+                    return entry['frame'].copy()
+            self._stats['misses'] += 1
+        # Started before the read, so a write committed while reading marks the result stale
+        started = time.time()
+        frame = read_fn()
+        tokens = sorted(set(token.lower() for token in TOKEN_RE.findall(query)))
+        entry = {'started': started, 'tokens': tokens, 'frame': frame.copy(),
+                 'n_bytes': int(frame.memory_usage(index=True, deep=True).sum())}
+        with self._lock:
+            self._refresh_marks()
+            if not self._is_fresh(entry):
+                return frame
+            self._remember(key, entry)
+            if self.cache_dir:
+                try:
+                    self._write_disk(key, entry)
+                except OSError:
+                    self.logger.warning('Could not write query result to disk cache.')
+        return frame
+
+
+    def invalidate(self, tables):
+        '''Mark tables, and the views reading them, written now'''
+        names = set()
+        for table in tables:
+            name = _table_name(table)
+            names.add(name)
+            names.update(self.dependents.get(name, []))
+        marked = time.time()
+        with self._lock:
+            for name in names:
+                self._marks[name] = max(marked, self._marks.get(name, 0))
+                if self.cache_dir:
+                    self._write_mark(name)
+            stale = [key for key, entry in self._entries.items()
+                     if ALL_TABLES in names or names.intersection(entry['tokens'])]
+            for key in stale:
+                self._n_bytes -= self._entries.pop(key)['n_bytes']
+            self._stats['invalidations'] += 1
+
+
+    def _write_mark(self, name):
+        # A new file replacing the old one updates the directory mtime other processes poll
+        marks_dir = os.path.join(self.cache_dir, 'marks')
+        fd, tmp_path = tempfile.mkstemp(dir=marks_dir, suffix='.tmp')
+        os.close(fd)
+        os.replace(tmp_path, os.path.join(marks_dir, name))
+
+
+    def invalidate_query(self, query):
+        '''Invalidate the tables written by a statement, or all tables if none can be told'''
+        tables = WRITE_TABLE_RE.findall(query)
+        self.invalidate(tables or [ALL_TABLES])
+
+
+    def clear(self):
+        self.invalidate([ALL_TABLES])
+
+
+    def stats(self):
+        '''Hit and miss counts, hit rate and sizes of both tiers of this process'''
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._n_bytes
+        n_reads = stats['hits'] + stats['disk_hits'] + stats['misses']
+        stats['hit_rate'] = round((stats['hits'] + stats['disk_hits']) / n_reads, 4) if n_reads else None
+        return stats
+
+
+    def __getstate__(self):
+        # Results, marks and locks are per process, workers start empty and share the disk tier
+        state = self.__dict__.copy()
+        for name in ['_lock', '_entries', '_n_bytes', '_disk_bytes', '_marks', '_marks_mtime', '_stats']:
+            del state[name]
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset()
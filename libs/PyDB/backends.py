@@ -0,0 +1,304 @@
+'''
+Storage backends of DBWrapper: the MySQL server, and an embedded store kept in one local
+file, DuckDB if installed or else SQLite, for in-process research queries and for running
+without a server.
+'''
+
+import re
+import sqlite3
+from os import environ
+
+import mysql.connector
+from mysql.connector import FieldType
+import numpy as np
+import pandas as pd
+
+
+SQLITE_MAX_PARAMS = 32766 # bound parameters per SQLite statement
+
+# NumPy dtypes of MySQL column types, nullable integers use pandas' Int64
+INT_TYPES = {FieldType.TINY, FieldType.SHORT, FieldType.INT24, FieldType.LONG,
+             FieldType.LONGLONG, FieldType.YEAR}
+FLOAT_TYPES = {FieldType.FLOAT: 'float32', FieldType.DOUBLE: 'float64',
+               FieldType.DECIMAL: 'float64', FieldType.NEWDECIMAL: 'float64'}
+DATETIME_TYPES = {FieldType.DATE, FieldType.NEWDATE, FieldType.DATETIME, FieldType.TIMESTAMP}
+
+UPSERT_RE = re.compile(r'\s+AS new\s+ON DUPLICATE KEY UPDATE\s+', re.IGNORECASE)
+UPSERT_CLAUSE_RE = re.compile(r'\s+AS new\s+ON DUPLICATE KEY UPDATE\s+.*$', re.IGNORECASE | re.DOTALL)
+INSERT_IGNORE_RE = re.compile(r'\bINSERT\s+IGNORE\b', re.IGNORECASE)
+ISO_DATETIME_RE = re.compile(r'^\d{4}-\d{2}-\d{2}([ T]\d{2}:\d{2}(:\d{2}(\.\d+)?)?)?$')
+
+
+class MySQLBackend(object):
+    '''
+    The MySQL server, credentials taken from environ['db_user'] and environ['db_pwd']
+
+    ...
+
+    Attributes
+    ----------
+    name : str
+        name of the backend
+    host : str
+        address of the server
+    load_infile : bool
+        True as LOAD DATA LOCAL INFILE is supported
+    max_params : int
+        bound parameters per statement, None if unbounded
+
+    Methods
+    -------
+    connect(db=None)
+        new DB-API connection
+    typed_frame(rows, description)
+        dataframe of fetched rows with dtypes taken from the cursor description
+    read_frame(cursor)
+        dataframe of all rows of an executed cursor
+    '''
+
+    name = 'mysql'
+    load_infile = True
+    max_params = None
+
+    def __init__(self, host='127.0.0.1'):
+        self.host = host
+
+
+    def connect(self, db=None):
+        if db:
+            return mysql.connector.connect(user=environ['db_user'], password=environ['db_pwd'],
+                                           host=self.host, db=db, allow_local_infile=True)
+        return mysql.connector.connect(user=environ['db_user'], password=environ['db_pwd'],
+                                       host=self.host, allow_local_infile=True)
+
+
+    def typed_frame(self, rows, description):
+        '''Build a dataframe column by column with dtypes taken from the cursor description'''
+        columns = list(zip(*rows)) if rows else [()] * len(description)
+        data = {}
+        for (name, type_code, _, _, _, _, null_ok, *_), values in zip(description, columns):
+            if type_code in FLOAT_TYPES:
+                data[name] = np.array([np.nan if v is None else v for v in values],
+                                      dtype=FLOAT_TYPES[type_code])
+            elif type_code in INT_TYPES:
+                data[name] = pd.array(values, dtype='Int64') if null_ok else \
+                    np.array(values, dtype=np.int64)
+            elif type_code in DATETIME_TYPES:
+                data[name] = pd.to_datetime(pd.Series(values, dtype=object))
+            else:
+                data[name] = np.array(values, dtype=object)
+        return pd.DataFrame(data, columns=[column[0] for column in description])
+
+
+    def read_frame(self, cursor):
+        return self.typed_frame(cursor.fetchall(), cursor.description)
+
+
+class EmbeddedCursor(object):
+    '''Cursor of the embedded store, translating the MySQL dialect of every query'''
+
+    def __init__(self, cursor, translate, shared=False):
+        self._cursor = cursor
+        self._translate = translate
+        self._shared = shared
+
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+    def execute(self, query, params=None):
+        return self._cursor.execute(self._translate(query), params or ())
+
+
+    def close(self):
+        # A shared cursor is the connection itself, closed with the connection
+        if not self._shared:
+            self._cursor.close()
+
+
+class EmbeddedConnection(object):
+    '''Wraps a DuckDB or sqlite3 connection with the mysql.connector methods used by DBWrapper'''
+
+    def __init__(self, con, translate, engine):
+        self._con = con
+        self._translate = translate
+        self._engine = engine
+
+
+    def cursor(self, **kwargs):
+        # DuckDB cursors are separate connections with their own transactions, so
+        # queries run on the connection itself
+        if self._engine == 'duckdb':
+            return EmbeddedCursor(self._con, self._translate, shared=True)
+        return EmbeddedCursor(self._con.cursor(), self._translate)
+
+
+    def start_transaction(self):
+        # sqlite3 opens a transaction before the first write by itself
+        if self._engine == 'duckdb':
+            self._con.execute('BEGIN TRANSACTION')
+
+
+    def commit(self):
+        self._con.commit()
+
+
+    def rollback(self):
+        try:
+            self._con.rollback()
+        except Exception:
+            # DuckDB autocommits every statement and has no transaction to roll back
+            pass
+
+
+    def close(self):
+        self._con.close()
+
+
+    def is_connected(self):
+        return True
+
+
+    def ping(self, **kwargs):
+        pass
+
+
+    def consume_results(self):
+        pass
+
+
+class EmbeddedBackend(object):
+    '''
+    An embedded store in one local file, DuckDB if installed or else SQLite
+
+    Queries are written for MySQL throughout the repo, so the MySQL dialect issued by
+    DBWrapper and the jobs is translated: the SMART_TRADING schema prefix is dropped,
+    %s placeholders become ?, and multi-row upserts and INSERT IGNORE use the
+    embedded engine's syntax. MySQL only statements (information_schema lookups,
+    partition maintenance, LOAD DATA) are not translated and stay on MySQL. DuckDB
+    allows a single process to write the file at a time.
+
+    ...
+
+    Attributes
+    ----------
+    name : str
+        'duckdb' or 'sqlite', the engine in use
+    path : str
+        path of the store file
+    load_infile : bool
+        False, large writes fall back to batched upserts
+    max_params : int
+        bound parameters per statement, None if unbounded
+
+    Methods
+    -------
+    connect(db=None)
+        new connection to the store file
+    translate(query)
+        query in the dialect of the engine
+    typed_frame(rows, description)
+        dataframe of fetched rows, dtypes inferred from the values
+    read_frame(cursor)
+        dataframe of all rows of an executed cursor, columnar on DuckDB
+    tables()
+        names of the tables in the store
+    '''
+
+    load_infile = False
+
+    def __init__(self, path, engine=None):
+        '''
+        Parameters
+        ----------
+        path : str
+            Path of the store file, created if missing
+        engine : str, optional
+            'duckdb' or 'sqlite', DuckDB if installed by default
+        '''
+        if engine is None:
+            try:
+                import duckdb
+                engine = 'duckdb'
+            except ImportError:
+                engine = 'sqlite'
+        if engine not in ('duckdb', 'sqlite'):
+            raise ValueError('"engine" must be one of "duckdb" or "sqlite".')
+        self.name = engine
+        self.path = path
+        self.max_params = SQLITE_MAX_PARAMS if engine == 'sqlite' else None
+
+
+    def connect(self, db=None):
+        if self.name == 'duckdb':
+            import duckdb
+            con = duckdb.connect(self.path)
+        else:
+            con = sqlite3.connect(self.path, check_same_thread=False)
+            con.execute('pragma journal_mode=wal')
+            con.execute('pragma synchronous=normal')
+        return EmbeddedConnection(con, self.translate, self.name)
+
+
+    def translate(self, query):
+        '''Translate the MySQL dialect issued by DBWrapper and the jobs'''
+        query = query.replace('SMART_TRADING.', '').replace('%s', '?')
+        query = INSERT_IGNORE_RE.sub('INSERT OR IGNORE', query)
+        if self.name == 'duckdb':
+            # DuckDB quotes identifiers with double quotes and cannot update key
+            # columns on conflict, INSERT OR REPLACE updates all other columns
+            query = query.replace('`', '"')
+            if UPSERT_CLAUSE_RE.search(query):
+                query = re.sub(r'^\s*INSERT\s+INTO\b', 'INSERT OR REPLACE INTO',
+                               UPSERT_CLAUSE_RE.sub('', query), flags=re.IGNORECASE)
+        elif UPSERT_RE.search(query):
+            query = UPSERT_RE.sub(' ON CONFLICT DO UPDATE SET ', query).replace('new.`', 'excluded.`')
+        return query
+
+
+    def typed_frame(self, rows, description):
+        '''Build a dataframe of fetched rows, parsing ISO date and time text as datetimes
+
+        SQLite stores DATE and TIMESTAMP values as text and reports no column types,
+        also for expressions like MAX(ts), so text columns whose values are all ISO
+        dates or timestamps are parsed, matching the dtypes read from MySQL.
+        '''
+        df = pd.DataFrame.from_records(rows, columns=[column[0] for column in description])
+        for col in df.columns:
+            if not (pd.api.types.is_object_dtype(df[col]) or pd.api.types.is_string_dtype(df[col])):
+                continue
+            values = df[col].dropna()
+            if len(values) == 0 or not isinstance(values.iloc[0], str) or \
+                    not ISO_DATETIME_RE.match(values.iloc[0]):
+                continue
+            parsed = pd.to_datetime(df[col], format='ISO8601', errors='coerce')
+            if parsed.notna().sum() == len(values):
+                df[col] = parsed
+        return df
+
+
+    def read_frame(self, cursor):
+        if self.name == 'duckdb':
+            return cursor.df()
+        return self.typed_frame(cursor.fetchall(), cursor.description)
+
+
+    def tables(self):
+        if self.name == 'duckdb':
+            qry = "SELECT table_name FROM information_schema.tables"
+        else:
+            qry = "SELECT name FROM sqlite_master WHERE type = 'table'"
+        con = self.connect()
+        try:
+            cursor = con.cursor()
+            cursor.execute(qry)
+            return [row[0] for row in cursor.fetchall()]
+        finally:
+            con.close()
+
+
+def default_backend():
+    '''The embedded store at environ['db_path'] if set, else MySQL'''
+    path = environ.get('db_path')
+    return EmbeddedBackend(path) if path else MySQLBackend()
@@ -0,0 +1,195 @@
+import gzip
+import hashlib
+import json
+import os
+import struct
+import tempfile
+import time
+
+from libs.st_logger.logger import logger
+
+
+DEFAULT_MAX_BYTES = 2 * 1024**3 # evict least recently used payloads above this total size
+EVICT_TO = 0.9 # fraction of max_bytes evicted down to, so evictions are not rescanned on every put
+
+
+class CacheMiss(KeyError):
+    '''Raised when a payload is not cached (or expired) and cannot be fetched'''
+
+
+class ResponseCache(object):
+    '''
+    A content-addressed on-disk cache of API payloads
+
+    Payloads are keyed by (source, endpoint, ticker, params) and stored as gzip
+    compressed JSON files, one per key, so the cache can be shared by worker
+    processes. File modification time tracks last use for LRU eviction, and the
+    gzip header records when a payload was fetched, so expiry can be told without
+    decompressing it.
+
+    ...
+
+    Attributes
+    ----------
+    cache_dir : str
+        directory to store payloads in
+    ttl_sec : dict[str, float]
+        time to live in seconds per endpoint, endpoints not listed never expire
+    max_bytes : int
+        total size above which least recently used payloads are evicted
+    replay : bool
+        True if payloads are to be served from cache only, including expired ones,
+        without ever calling the fetch function
+
+    Methods
+    -------
+    get(source, endpoint, ticker, params)
+        returns cached payload or raises CacheMiss
+    put(source, endpoint, ticker, params, value)
+        stores payload and evicts least recently used ones if over size
+    fetch(source, endpoint, ticker, params, fetch_fn)
+        returns cached payload, else calls fetch_fn and caches its result
+    contains(source, endpoint, ticker, params)
+        True if a servable payload is cached
+    '''
+
+    def __init__(self, cache_dir, ttl_sec=None, max_bytes=DEFAULT_MAX_BYTES, replay=False):
+        self.cache_dir = cache_dir
+        self.ttl_sec = ttl_sec or {}
+        self.max_bytes = max_bytes
+        self.replay = replay
+        self.logger = logger('ResponseCache')
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._n_bytes = None # running total size, scanned on first put
+
+
+    def _key(self, source, endpoint, ticker, params):
+        raw = json.dumps([source, endpoint, ticker, params or {}], sort_keys=True)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.json.gz')
+
+
+    def _read(self, source, endpoint, ticker, params):
+        path = self._path(self._key(source, endpoint, ticker, params))
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None, path
+        ttl = self.ttl_sec.get(endpoint)
+        if not self.replay and ttl is not None and time.time() - entry['created'] > ttl:
+            return None, path
+        return entry, path
+
+
+    def contains(self, source, endpoint, ticker, params=None):
+        '''True if a servable payload is cached, told from the gzip header alone'''
+        path = self._path(self._key(source, endpoint, ticker, params))
+        ttl = self.ttl_sec.get(endpoint)
+        if self.replay or ttl is None:
+            return os.path.isfile(path)
+        try:
+            with open(path, 'rb') as f:
+                header = f.read(8)
+        except OSError:
+            return False
+        if len(header) < 8 or header[:2] != b'\x1f\x8b':
+            return False
+        created = struct.unpack('<I', header[4:8])[0]
+        return time.time() - created <= ttl
+
+
+    def get(self, source, endpoint, ticker, params=None):
+        '''Return cached payload, raises CacheMiss if missing or expired'''
+        entry, path = self._read(source, endpoint, ticker, params)
+        if entry is None:
+            raise CacheMiss('{}/{}: {} not cached'.format(source, endpoint, ticker))
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry['value']
+
+
+    def put(self, source, endpoint, ticker, params, value):
+        '''Store payload, written atomically so concurrent readers never see partial files'''
+        path = self._path(self._key(source, endpoint, ticker, params))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if self._n_bytes is None:
+            self._n_bytes = self._scan()[1]
+        try:
+            replaced = os.path.getsize(path)
+        except OSError:
+            replaced = 0
+        entry = {'created': time.time(), 'source': source, 'endpoint': endpoint,
+                 'ticker': ticker, 'params': params or {}, 'value': value}
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f, \
+                    gzip.GzipFile(fileobj=f, mode='wb', mtime=int(entry['created'])) as gz:
+                gz.write(json.dumps(entry).encode('utf-8'))
+            os.replace(tmp_path, path)
+        except:
+            os.remove(tmp_path)
+            raise
+        self._n_bytes += os.path.getsize(path) - replaced
+        # Payloads written by other processes are counted by the scan of the next eviction
+        if self._n_bytes > self.max_bytes:
+            self._evict()
+
+
+    def fetch(self, source, endpoint, ticker, params, fetch_fn):
+        '''Return cached payload, else fetch, cache and return it
+
+        Raises
+        ------
+        CacheMiss
+            If in replay mode and payload is not cached
+        '''
+        try:
+            return self.get(source, endpoint, ticker, params)
+        except CacheMiss:
+            if self.replay:
+                raise
+        value = fetch_fn()
+        self.put(source, endpoint, ticker, params, value)
+        return value
+
+
+    def _scan(self):
+        '''Last use, size and path of all cached payloads, and their total size'''
+        files = []
+        total = 0
+        for shard in os.scandir(self.cache_dir):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith('.json.gz'):
+                    st = entry.stat()
+                    files.append((st.st_mtime, st.st_size, entry.path))
+                    total += st.st_size
+        return files, total
+
+
+    def _evict(self):
+        '''Remove least recently used payloads until total size is within EVICT_TO of max_bytes'''
+        files, total = self._scan()
+        self._n_bytes = total
+        if total <= self.max_bytes:
+            return
+        files.sort()
+        n_evicted = 0
+        for _, size, path in files:
+            if total <= self.max_bytes * EVICT_TO:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            n_evicted += 1
+        self._n_bytes = total
+        self.logger.info('Evicted {} least recently used payloads.'.format(n_evicted))
@@ -0,0 +1,238 @@
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Upper bounds in seconds of the histogram buckets, as in Prometheus
+BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, float('inf')]
+PREFIX = 'smarttrading_'
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def get_metrics(run_name='SmartTrading', metrics_dir=None):
+    '''Return the metrics registry of this process for the given run, creating it if needed
+
+    Unpickled registries resolve to this function, so pool workers record into one
+    registry per worker process and report it through files in metrics_dir.
+    '''
+    key = (run_name, metrics_dir)
+    with _registry_lock:
+        metrics = _registry.get(key)
+        if metrics is None or metrics._pid != os.getpid():
+            metrics = Metrics(run_name, metrics_dir)
+            _registry[key] = metrics
+        return metrics
+
+
+def _key(name, labels):
+    if not labels:
+        return name
+    return name + '{' + ','.join('{}="{}"'.format(k, v) for k, v in sorted(labels.items())) + '}'
+
+
+class Metrics(object):
+    '''
+    A registry of counters, timers and histograms for one run
+
+    Each process records into its own registry. `flush()` writes the process'
+    cumulative values to <metrics_dir>/proc-<pid>.json, and `collect()` merges the
+    files of all processes of the run, so pool workers report into the same summary.
+
+    ...
+
+    Attributes
+    ----------
+    run_name : str
+        name of the run, used as the job label
+    metrics_dir : str
+        directory to exchange per process values and write summaries in, None to keep
+        metrics in memory only
+
+    Methods
+    -------
+    inc(name, value=1, **labels)
+        increments a counter
+    observe(name, value, **labels)
+        records a value into a histogram
+    timer(name, **labels)
+        context manager recording the elapsed seconds of the block into a histogram
+    flush()
+        writes this process' values to metrics_dir
+    collect()
+        merges the values of all processes of the run
+    write_summary(path=None)
+        writes merged values as a JSON summary and a Prometheus text file
+    '''
+
+    def __init__(self, run_name='SmartTrading', metrics_dir=None):
+        self.run_name = run_name
+        self.metrics_dir = metrics_dir
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._t_start = time.time()
+        self.counters = {}
+        self.histograms = {}
+        if metrics_dir:
+            os.makedirs(metrics_dir, exist_ok=True)
+
+
+    def __reduce__(self):
+        return (get_metrics, (self.run_name, self.metrics_dir))
+
+
+    def inc(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            counter = self.counters.setdefault(key, {'name': name, 'labels': labels, 'value': 0})
+            counter['value'] += value
+
+
+    def observe(self, name, value, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = {'name': name, 'labels': labels, 'count': 0,
+                                               'sum': 0.0, 'max': 0.0,
+                                               'buckets': [0] * len(BUCKETS)}
+            hist['count'] += 1
+            hist['sum'] += value
+            hist['max'] = max(hist['max'], value)
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    hist['buckets'][i] += 1
+                    break
+
+
+    @contextmanager
+    def timer(self, name, **labels):
+        '''Record elapsed seconds of the block into histogram name'''
+        t_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t_start, **labels)
+
+
+    def snapshot(self):
+        with self._lock:
+            return json.loads(json.dumps({'counters': self.counters,
+                                          'histograms': self.histograms}))
+
+
+    def flush(self):
+        '''Write cumulative values of this process, atomically replacing the previous ones'''
+        if not self.metrics_dir:
+            return
+        path = os.path.join(self.metrics_dir, 'proc-{}.json'.format(os.getpid()))
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(path + '.tmp', path)
+
+
+    def collect(self):
+        '''Merge values of all processes of the run, this one included'''
+        self.flush()
+        snapshots = []
+        if self.metrics_dir:
+            for path in glob.glob(os.path.join(self.metrics_dir, 'proc-*.json')):
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+        else:
+            snapshots.append(self.snapshot())
+        merged = {'counters': {}, 'histograms': {}}
+        for snap in snapshots:
+            for key, counter in snap['counters'].items():
+                merged_counter = merged['counters'].setdefault(key, dict(counter, value=0))
+                merged_counter['value'] += counter['value']
+            for key, hist in snap['histograms'].items():
+                merged_hist = merged['histograms'].get(key)
+                if merged_hist is None:
+                    merged['histograms'][key] = hist
+                    continue
+                merged_hist['count'] += hist['count']
+                merged_hist['sum'] += hist['sum']
+                merged_hist['max'] = max(merged_hist['max'], hist['max'])
+                merged_hist['buckets'] = [a + b for a, b in zip(merged_hist['buckets'],
+                                                                hist['buckets'])]
+        return merged
+
+
+    def _summary(self, merged, run_seconds):
+        summary = {'run_name': self.run_name, 'run_seconds': round(run_seconds, 3),
+                   'counters': {}, 'timers': {}}
+        for key, counter in sorted(merged['counters'].items()):
+            summary['counters'][key] = counter['value']
+        for key, hist in sorted(merged['histograms'].items()):
+            summary['timers'][key] = {
+                'count': hist['count'], 'total_sec': round(hist['sum'], 4),
+                'mean_sec': round(hist['sum'] / hist['count'], 4) if hist['count'] else None,
+                'max_sec': round(hist['max'], 4),
+                'share_of_run': round(hist['sum'] / run_seconds, 4) if run_seconds else None}
+        return summary
+
+
+    def _prometheus(self, merged, run_seconds):
+        lines = []
+        job = 'job="{}"'.format(self.run_name)
+
+        def label_str(labels, extra=None):
+            parts = [job] + ['{}="{}"'.format(k, v) for k, v in sorted(labels.items())]
+            if extra:
+                parts.append(extra)
+            return '{' + ','.join(parts) + '}'
+
+        typed = set()
+        for counter in sorted(merged['counters'].values(), key=lambda c: c['name']):
+            name = PREFIX + counter['name'] + '_total'
+            if name not in typed:
+                lines.append('# TYPE {} counter'.format(name))
+                typed.add(name)
+            lines.append('{}{} {}'.format(name, label_str(counter['labels']), counter['value']))
+        for hist in sorted(merged['histograms'].values(), key=lambda h: h['name']):
+            name = PREFIX + hist['name'] + '_seconds'
+            if name not in typed:
+                lines.append('# TYPE {} histogram'.format(name))
+                typed.add(name)
+            cumulative = 0
+            for bound, count in zip(BUCKETS, hist['buckets']):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{}_bucket{} {}'.format(
+                    name, label_str(hist['labels'], 'le="{}"'.format(le)), cumulative))
+            lines.append('{}_sum{} {}'.format(name, label_str(hist['labels']), hist['sum']))
+            lines.append('{}_count{} {}'.format(name, label_str(hist['labels']), hist['count']))
+        lines.append('# TYPE {}run_seconds gauge'.format(PREFIX))
+        lines.append('{}run_seconds{} {}'.format(PREFIX, label_str({}), run_seconds))
+        return '\n'.join(lines) + '\n'
+
+
+    def write_summary(self, path=None):
+        '''Write merged values of the run as summary.json and metrics.prom
+
+        Parameters
+        ----------
+        path : str, optional
+            Directory to write to, defaults to metrics_dir
+
+        Returns
+        -------
+        dict
+            The JSON summary
+        '''
+        run_seconds = time.time() - self._t_start
+        merged = self.collect()
+        summary = self._summary(merged, run_seconds)
+        path = path or self.metrics_dir
+        if path:
+            os.makedirs(path, exist_ok=True)
+            with open(os.path.join(path, 'summary.json'), 'w') as f:
+                json.dump(summary, f, indent=2)
+            with open(os.path.join(path, 'metrics.prom'), 'w') as f:
+                f.write(self._prometheus(merged, run_seconds))
+        return summary
@@ -0,0 +1,315 @@
+import json
+import os
+import threading
+import time
+import uuid
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from libs.st_logger.logger import logger
+
+
+MANIFEST_FILE = 'manifest.jsonl'
+SEGMENT_SUFFIX = '.arrow'
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Spool(object):
+    '''
+    A durable append-only spool of fetched frames in Arrow IPC (Feather) segments
+
+    Every `put()` writes one segment atomically and then appends a 'fetched' record
+    for the ticker to an append-only manifest, so a ticker is only recorded once its
+    frame is on disk. Drained segments get a 'written' record and are deleted. After
+    a crash, `completed_tickers(run)` tells which tickers of the run need no new API
+    call and `pending_segments()` which segments still have to reach the database.
+
+    Layout: <spool_dir>/manifest.jsonl, <spool_dir>/seg-<stamp>-<uuid>.arrow
+
+    ...
+
+    Attributes
+    ----------
+    spool_dir : str
+        directory holding the manifest and segments
+    logger : st_logger.logger
+        object of class st_logger.logger
+
+    Methods
+    -------
+    put(run, ticker, frame)
+        spools the frame of one ticker and records the ticker as completed for run
+    completed_tickers(run)
+        tickers recorded as completed for run
+    pending_segments()
+        segments not yet written to the database, oldest first
+    read(segments)
+        reads segments into one frame
+    mark_written(segments)
+        records segments as written and deletes them
+    compact(keep_runs=())
+        rewrites the manifest with only pending segments and the records of keep_runs
+    clear()
+        truncates the manifest once a run is complete and drained
+    '''
+
+    def __init__(self, spool_dir, st_logger=None):
+        self.spool_dir = spool_dir
+        self.logger = st_logger or logger('Spool')
+        self._lock = threading.Lock()
+        os.makedirs(spool_dir, exist_ok=True)
+        self._manifest_path = os.path.join(spool_dir, MANIFEST_FILE)
+
+
+    def _append_manifest(self, records):
+        with self._lock:
+            with open(self._manifest_path, 'a+b') as f:
+                # Terminate a line torn by a crash, so it does not swallow the next record
+                if f.tell() > 0:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b'\n':
+                        f.write(b'\n')
+                for record in records:
+                    f.write((json.dumps(record) + '\n').encode('utf-8'))
+                f.flush()
+                os.fsync(f.fileno())
+
+
+    def _read_manifest(self):
+        records = []
+        if not os.path.exists(self._manifest_path):
+            return records
+        with open(self._manifest_path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # Torn last line of a crashed append, its segment is rewritten on resume
+                    self.logger.warning('Skipping corrupt spool manifest line.')
+        return records
+
+
+    def put(self, run, ticker, frame):
+        '''Spool the frame of one ticker and record the ticker as completed for run
+
+        Parameters
+        ----------
+        run : str
+            Key of the run, tickers completed in other runs are not resumed
+        ticker : str
+            Ticker the frame belongs to
+        frame : pandas.DataFrame
+            Frame to write later, empty frames only record the ticker as completed
+        '''
+        segment = None
+        if len(frame.index) > 0:
+            segment = 'seg-{}-{}{}'.format(time.strftime('%Y%m%d%H%M%S'), uuid.uuid4().hex[:8],
+                                            SEGMENT_SUFFIX)
+            path = os.path.join(self.spool_dir, segment)
+            table = pa.Table.from_pandas(frame, preserve_index=True)
+            feather.write_feather(table, path + '.tmp')
+            with open(path + '.tmp', 'rb') as f:
+                os.fsync(f.fileno())
+            os.replace(path + '.tmp', path)
+            _fsync_dir(self.spool_dir)
+        self._append_manifest([{'event': 'fetched', 'run': run, 'ticker': ticker,
+                                'segment': segment, 'rows': len(frame.index)}])
+        return segment
+
+
+    def completed_tickers(self, run):
+        return {r['ticker'] for r in self._read_manifest()
+                if r['event'] == 'fetched' and r['run'] == run}
+
+
+    def pending_segments(self):
+        '''Segments recorded as fetched but not as written, in spool order'''
+        written = set()
+        fetched = []
+        for r in self._read_manifest():
+            if r['event'] == 'written':
+                written.add(r['segment'])
+            elif r['segment'] is not None:
+                fetched.append(r)
+        return [r for r in fetched if r['segment'] not in written
+                and os.path.exists(os.path.join(self.spool_dir, r['segment']))]
+
+
+    def read(self, segments):
+        frames = [feather.read_table(os.path.join(self.spool_dir, segment), memory_map=True)
+                  .to_pandas() for segment in segments]
+        return pd.concat(frames)
+
+
+    def mark_written(self, segments):
+        self._append_manifest([{'event': 'written', 'segment': segment} for segment in segments])
+        for segment in segments:
+            try:
+                os.remove(os.path.join(self.spool_dir, segment))
+            except FileNotFoundError:
+                pass
+
+
+    def compact(self, keep_runs=()):
+        '''Rewrite the manifest with only what later runs still need
+
+        Fetched records of pending segments are kept, so they are drained by the next
+        run, and completed tickers of keep_runs, so those runs can still be resumed.
+        Everything else, such as records of runs held back by a ticker that always
+        fails, is dropped. The manifest is replaced atomically.
+        '''
+        with self._lock:
+            records = self._read_manifest()
+            written = {r['segment'] for r in records if r['event'] == 'written'}
+            kept = []
+            for r in records:
+                if r['event'] != 'fetched':
+                    continue
+                pending = r['segment'] is not None and r['segment'] not in written \
+                    and os.path.exists(os.path.join(self.spool_dir, r['segment']))
+                if pending:
+                    kept.append(r)
+                elif r['run'] in keep_runs:
+                    kept.append(dict(r, segment=None))
+            tmp_path = self._manifest_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                for record in kept:
+                    f.write((json.dumps(record) + '\n').encode('utf-8'))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self._manifest_path)
+            _fsync_dir(self.spool_dir)
+        self.logger.info('Compacted spool manifest from {} to {} records.'.format(
+            len(records), len(kept)))
+
+
+    def clear(self):
+        '''Truncate the manifest, only once all segments are written'''
+        if self.pending_segments():
+            raise RuntimeError('Spool still holds segments not written to database.')
+        with self._lock:
+            open(self._manifest_path, 'w').close()
+
+
+class SpoolWriter(object):
+    '''
+    A background thread draining spool segments to the database in large batches
+
+    Pending segments are concatenated into batches of up to batch_rows rows and
+    passed to write_fn. Failed batches are retried with exponential backoff, and
+    left in the spool for the next run once retries are exhausted.
+
+    ...
+
+    Attributes
+    ----------
+    spool : Spool
+        spool to drain
+    write_fn : callable
+        writes one batch frame to the database, raising on failure
+    batch_rows : int
+        rows to collect before writing a batch
+    max_retries : int
+        attempts per batch before leaving it in the spool
+    retry_sec : float
+        wait before the first retry, doubled on every further one
+
+    Methods
+    -------
+    start()
+        starts draining in the background, beginning with segments left by earlier runs
+    notify()
+        wakes the writer after new segments were spooled
+    stop()
+        drains the remaining segments and stops the writer, returns True if all were written
+    '''
+
+    def __init__(self, spool, write_fn, st_logger=None, batch_rows=200000,
+                 max_retries=5, retry_sec=2.0):
+        self.spool = spool
+        self.write_fn = write_fn
+        self.logger = st_logger or logger('SpoolWriter')
+        self.batch_rows = batch_rows
+        self.max_retries = max_retries
+        self.retry_sec = retry_sec
+        self.rows_written = 0
+        self._wake = threading.Event()
+        self._stopping = False
+        self._failed = set()
+        self._thread = None
+
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='SpoolWriter', daemon=True)
+        self._thread.start()
+
+
+    def notify(self):
+        self._wake.set()
+
+
+    def _batches(self, final):
+        '''Group pending segments into batches, holding back a partial one unless final'''
+        batch, rows = [], 0
+        for record in self.spool.pending_segments():
+            if record['segment'] in self._failed:
+                continue
+            batch.append(record['segment'])
+            rows += record['rows']
+            if rows >= self.batch_rows:
+                yield batch
+                batch, rows = [], 0
+        if batch and final:
+            yield batch
+
+
+    def _write_batch(self, segments):
+        frame = self.spool.read(segments)
+        wait_sec = self.retry_sec
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                self.write_fn(frame)
+                self.spool.mark_written(segments)
+                self.rows_written += frame.shape[0]
+                self.logger.info('Wrote {} spooled rows from {} segments.'.format(
+                    frame.shape[0], len(segments)))
+                return
+            except Exception as e:
+                self.logger.warning('Spooled batch write failed ({}/{}): {}'.format(
+                    attempt, self.max_retries, e))
+                if attempt < self.max_retries:
+                    time.sleep(wait_sec)
+                    wait_sec *= 2
+        self._failed.update(segments)
+        self.logger.warning('Left {} segments in spool for the next run.'.format(len(segments)))
+
+
+    def _run(self):
+        # Segments left by earlier runs are drained first
+        final = True
+        while True:
+            # Read before the pass, so a stopping pass sees every segment spooled before stop()
+            stopping = self._stopping
+            for segments in self._batches(final or stopping):
+                self._write_batch(segments)
+            if stopping:
+                return
+            final = False
+            self._wake.wait(timeout=5)
+            self._wake.clear()
+
+
+    def stop(self):
+        self._stopping = True
+        self._wake.set()
+        self._thread.join()
+        return not self._failed and not self.spool.pending_segments()
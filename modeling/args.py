@@ -0,0 +1,35 @@
+from argparse import ArgumentParser
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument('--stock-index', 
+        type=str, required=False, default='NASDAQ',
+        help='Index to get tickers - "SP500" or "NASDAQ".')
+    parser.add_argument('--price-type', 
+        type=str, required=False, default='daily',
+        help='Frequency of prices - "daily" or "intraday".')
+    parser.add_argument('--full-refresh',
+        action='store_true', required=False, default=False,
+        help='Whether to recompute features over all history instead of only new bars.')
+    parser.add_argument('--model',
+        type=str, required=False, default='ar',
+        help='Per-ticker forecasting model - "ar" or "drift".')
+    parser.add_argument('--horizon',
+        type=int, required=False, default=None,
+        help='Bars to forecast ahead, default per price type in constants.py.')
+    parser.add_argument('--train-bars',
+        type=int, required=False, default=None,
+        help='Bars each model fit uses, default per price type in constants.py.')
+    parser.add_argument('--backtest',
+        action='store_true', required=False, default=False,
+        help='Whether to score walk-forward forecasts over history instead of forecasting.')
+    parser.add_argument('--step',
+        type=int, required=False, default=None,
+        help='Bars between walk-forward forecast origins, the horizon by default.')
+    parser.add_argument('--start-date',
+        type=str, required=False, default=None,
+        help='Start date of prices to backtest on, as yyyy-mm-dd.')
+    parser.add_argument('--n-proc',
+        type=int, required=False, default=None,
+        help='Worker processes, one less than the cores by default.')
+    return parser.parse_args()
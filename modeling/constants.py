@@ -0,0 +1,20 @@
+import sys
+
+ST_HOME = '/Users/akshit/SmartTrading/'
+sys.path.append(ST_HOME)
+
+# Column holding the bar timestamp in the price tables, per price type
+TS_COLS = {'daily': 'dt', 'intraday': 'ts'}
+BARS_PER_DAY = {'daily': 1, 'intraday': 26} # regular session 15 minute bars per day
+
+# Feature windows in bars, fixed since they name the columns of price_features
+RETURN_WINDOWS = [1, 5, 20]
+VOL_WINDOW = 20
+VWAP_WINDOW = 20
+ZSCORE_WINDOW = 20
+
+# Forecasting: bars forecast ahead and bars per fit, per price type
+FORECAST_HORIZON = {'daily': 5, 'intraday': 26}
+TRAIN_BARS = {'daily': 250, 'intraday': 26*10}
+FORECAST_BATCH_MB = 256 # estimated megabytes of prices loaded per batch of tickers
+FORECAST_BYTES_PER_BAR = 120 # estimated memory per loaded bar, ticker object included
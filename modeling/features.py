@@ -0,0 +1,229 @@
+'''
+This module computes price and earnings features for all tickers of an index at once,
+with grouped vectorized operations, and writes them to the price_features table.
+'''
+
+import numpy as np
+import pandas as pd
+
+from constants import *
+from args import parse_args
+from libs.st_logger.logger import logger
+from libs.PriceStore.PriceStore import typical_price
+from libs.PyDB.DBWrapper import DBWrapper
+
+
+class FeatureEngine(object):
+    '''
+    A class to compute features across all tickers of an index
+
+    Price features are rolling returns, volatility of log returns, VWAP, opening
+    gaps and volume z-scores, computed per ticker with grouped rolling windows over
+    one long frame sorted by ticker and time. Earnings features are as-of joined
+    with a sorted merge-asof: days to the next and since the last earnings date,
+    and the surprise of the last reported earnings.
+
+    ...
+
+    Attributes
+    ----------
+    st_db : PyDB.DBWrapper.DBWrapper
+        DBWrapper object for interacting with database
+    logger : st_logger.logger
+        object of class st_logger.logger
+    price_type : str
+        type of price, 'intraday' or 'daily'
+
+    Methods
+    -------
+    compute_price_features(prices)
+        computes rolling price features from prices of many tickers
+    add_earnings_features(features, earnings)
+        as-of joins earnings features onto price features
+    update(stock_index, full_refresh=False)
+        computes features for bars newer than the stored ones and writes them
+    '''
+
+    def __init__(self, st_db, st_logger, price_type='daily'):
+        if price_type not in TS_COLS:
+            raise ValueError('"price_type" must be one of "intraday" or "daily".')
+        self.st_db = st_db
+        self.logger = st_logger
+        self.price_type = price_type
+
+
+    def _lookback(self):
+        '''Calendar time covering the longest window in bars, with weekends and holidays'''
+        max_window = max(RETURN_WINDOWS + [VOL_WINDOW, VWAP_WINDOW, ZSCORE_WINDOW])
+        trading_days = int(np.ceil(max_window / BARS_PER_DAY[self.price_type])) + 1
+        return pd.Timedelta(days=int(np.ceil(trading_days * 7 / 5)) + 5)
+
+
+    def compute_price_features(self, prices):
+        '''Compute rolling price features for many tickers at once
+
+        Parameters
+        ----------
+        prices : pandas.DataFrame
+            Columns ticker, ts, open, high, low, close, volume
+
+        Returns
+        -------
+        pandas.DataFrame
+            One row per input bar, sorted by ticker and ts
+        '''
+        df = prices.sort_values(['ticker', 'ts']).reset_index(drop=True)
+        close = df['close'].astype(np.float64)
+        volume = df['volume'].astype(np.float64)
+        by_ticker = df['ticker']
+
+        def rolling(series, window):
+            return series.groupby(by_ticker, sort=False).rolling(window, min_periods=window)
+
+        features = df[['ticker', 'ts']].copy()
+        prev_close = close.groupby(by_ticker, sort=False).shift(1)
+        for w in RETURN_WINDOWS:
+            features['ret_{}'.format(w)] = close / close.groupby(by_ticker, sort=False).shift(w) - 1
+        log_ret = np.log(close / prev_close)
+        features['vol_{}'.format(VOL_WINDOW)] = \
+            rolling(log_ret, VOL_WINDOW).std().droplevel(0)
+        price_volume = pd.Series(typical_price(df['high'], df['low'], df['close']),
+                                 index=df.index) * volume
+        features['vwap_{}'.format(VWAP_WINDOW)] = \
+            rolling(price_volume, VWAP_WINDOW).sum().droplevel(0) / \
+            rolling(volume, VWAP_WINDOW).sum().droplevel(0)
+        features['gap'] = df['open'].astype(np.float64) / prev_close - 1
+        volume_mean = rolling(volume, ZSCORE_WINDOW).mean().droplevel(0)
+        volume_std = rolling(volume, ZSCORE_WINDOW).std().droplevel(0)
+        features['volume_z_{}'.format(ZSCORE_WINDOW)] = (volume - volume_mean) / volume_std
+        return features.replace([np.inf, -np.inf], np.nan)
+
+
+    def add_earnings_features(self, features, earnings):
+        '''As-of join earnings features onto price features
+
+        Parameters
+        ----------
+        features : pandas.DataFrame
+            Price features with columns ticker and ts
+        earnings : pandas.DataFrame
+            Columns ticker, earnings_dt and eps_surprise_pct
+
+        Returns
+        -------
+        pandas.DataFrame
+            Features with days_to_next_earnings, days_since_last_earnings and
+            last_eps_surprise_pct, sorted by ticker and ts
+        '''
+        left = features.sort_values('ts')
+        right = earnings[['ticker', 'earnings_dt', 'eps_surprise_pct']] \
+            .dropna(subset=['earnings_dt']).sort_values('earnings_dt')
+        last = pd.merge_asof(left[['ticker', 'ts']], right, left_on='ts', right_on='earnings_dt',
+                             by='ticker', direction='backward')
+        nxt = pd.merge_asof(left[['ticker', 'ts']], right[['ticker', 'earnings_dt']],
+                            left_on='ts', right_on='earnings_dt', by='ticker',
+                            direction='forward', allow_exact_matches=False)
+        one_day = pd.Timedelta(days=1)
+        left = left.assign(
+            days_to_next_earnings=((nxt['earnings_dt'] - nxt['ts']) / one_day).values,
+            days_since_last_earnings=((last['ts'] - last['earnings_dt']) / one_day).values,
+            last_eps_surprise_pct=last['eps_surprise_pct'].values)
+        return left.sort_values(['ticker', 'ts']).reset_index(drop=True)
+
+
+    def _get_feature_high_water_marks(self, stock_index):
+        qry = '''
+        SELECT
+            f.ticker, MAX(f.ts) AS hwm
+        FROM
+            SMART_TRADING.price_features f
+            JOIN SMART_TRADING.ticker_membership m ON f.ticker = m.ticker
+        WHERE
+            m.stock_index = %s AND m.valid_to IS NULL AND f.price_type = %s
+        GROUP BY
+            f.ticker
+        '''
+        hwm_df = self.st_db.executeReadQuery(qry, (stock_index, self.price_type))
+        return pd.Series(pd.to_datetime(hwm_df['hwm']).values, index=hwm_df['ticker'])
+
+
+    def _load_prices(self, stock_index, hwm=None):
+        '''Prices of the index from the lookback before each ticker's stored features on
+
+        Tickers are grouped by their load start (to the day), so one condition covers
+        each group, and tickers without stored features load their full history.
+        '''
+        ts_col = TS_COLS[self.price_type]
+        conds, params = [], [stock_index]
+        if hwm is not None and len(hwm):
+            conds.append('p.ticker NOT IN ({})'.format(', '.join(['%s'] * len(hwm))))
+            params += list(hwm.index)
+            starts = (hwm - self._lookback()).dt.floor('D')
+            for start, group in starts.groupby(starts):
+                conds.append('(p.ticker IN ({tickers}) AND p.{ts_col} >= %s)'.format(
+                    tickers=', '.join(['%s'] * len(group)), ts_col=ts_col))
+                params += list(group.index) + [start.to_pydatetime()]
+        qry = '''
+        SELECT
+            p.ticker, p.{ts_col} AS ts, p.open, p.high, p.low, p.close, p.volume
+        FROM
+            SMART_TRADING.{price_type}_prices p
+            JOIN SMART_TRADING.ticker_membership m ON p.ticker = m.ticker
+        WHERE
+            m.stock_index = %s AND m.valid_to IS NULL {start_cond}
+        '''.format(ts_col=ts_col, price_type=self.price_type,
+                   start_cond='AND ({})'.format(' OR '.join(conds)) if conds else '')
+        params = tuple(params)
+        chunks = list(self.st_db.iterReadQuery(qry, params))
+        if not chunks:
+            return pd.DataFrame(columns=['ticker', 'ts', 'open', 'high', 'low', 'close', 'volume'])
+        return pd.concat(chunks, ignore_index=True)
+
+
+    def _load_earnings(self, stock_index):
+        qry = '''
+        SELECT
+            e.ticker, e.earnings_dt, NULLIF(e.eps_surprise_pct, -99.0) AS eps_surprise_pct
+        FROM
+            SMART_TRADING.earnings e
+            JOIN SMART_TRADING.ticker_membership m ON e.ticker = m.ticker
+        WHERE
+            m.stock_index = %s AND m.valid_to IS NULL
+        '''
+        return self.st_db.executeReadQuery(qry, (stock_index,))
+
+
+    def update(self, stock_index, full_refresh=False):
+        '''Compute features for bars newer than the stored features and write them
+
+        Only the windows touched by new bars are recomputed: prices of each ticker are
+        loaded from the lookback of the longest window before its stored features, and
+        only rows after them are written. Tickers without stored features (new members,
+        or all of them on a full refresh) are computed from their full history.
+        '''
+        hwm = pd.Series(dtype='datetime64[ns]') if full_refresh \
+            else self._get_feature_high_water_marks(stock_index)
+        prices = self._load_prices(stock_index, hwm)
+        if prices.shape[0] == 0:
+            self.logger.info('No prices to compute features for.')
+            return
+        features = self.compute_price_features(prices)
+        features = self.add_earnings_features(features, self._load_earnings(stock_index))
+
+        # Keep rows newer than the stored features, tickers without features keep all rows
+        ticker_hwm = hwm.reindex(features['ticker']).to_numpy()
+        features = features[pd.isna(ticker_hwm) | (features['ts'].to_numpy() > ticker_hwm)]
+        features.insert(1, 'price_type', self.price_type)
+        self.st_db.executeWriteQuery(features, 'price_features')
+        self.logger.info('Computed {n} {pt} feature rows for {t} tickers.'.format(
+            n=features.shape[0], pt=self.price_type, t=features['ticker'].nunique()))
+
+
+if __name__ == '__main__':
+    st_logger = logger('Features')
+    args = parse_args()
+    st_db = DBWrapper('SMART_TRADING')
+    engine = FeatureEngine(st_db=st_db, st_logger=st_logger, price_type=args.price_type)
+    with st_db.session():
+        engine.update(args.stock_index, full_refresh=args.full_refresh)
+    st_db.close()
@@ -0,0 +1,305 @@
+'''
+This module fits a per-ticker forecasting model for all tickers of an index in a process
+pool and writes forecasts (or walk-forward backtest scores) with fit timings.
+'''
+
+import datetime as dt
+import time
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+import pandas as pd
+
+from constants import *
+from args import parse_args
+from models import MODELS
+from libs.st_logger.logger import logger
+from libs.PyDB.DBWrapper import DBWrapper
+
+
+# Model and run settings of a worker process, set once when the worker starts
+_worker = {}
+
+
+def init_worker(model, horizon, train_bars, step):
+    '''Process pool initializer, so tasks only carry the arrays of one ticker'''
+    _worker.update(model=model, horizon=horizon, train_bars=train_bars, step=step)
+
+
+def walk_forward(model, log_close, exog, train_bars, horizon, step):
+    '''Forecast from every step-th bar with the preceding train_bars bars, and score
+
+    For Gram-fitted models the per-bar outer products are summed once, so the
+    X'X and X'y of any window are a difference of two running sums, and the
+    windows of all origins are solved and forecast in one stacked pass instead
+    of a refit per step.
+
+    Returns
+    -------
+    numpy.ndarray
+        Forecast errors of log close, shaped (origins, horizon)
+    '''
+    X, y = model.design(log_close, exog)
+    origins = np.arange(max(train_bars, model.lags), len(log_close) - horizon, step)
+    # Rows t-train_bars .. t-1 have their next-bar return known at the close of bar t
+    if model.gram:
+        valid = ~np.isnan(y) & ~np.isnan(X).any(axis=1)
+        Xv = np.where(valid[:, None], X, 0.0)
+        yv = np.where(valid, y, 0.0)
+        k = X.shape[1]
+        cum_xtx = np.concatenate([np.zeros((1, k, k)),
+                                  np.cumsum(Xv[:, :, None] * Xv[:, None, :], axis=0)])
+        cum_xty = np.concatenate([np.zeros((1, k)), np.cumsum(Xv * yv[:, None], axis=0)])
+        coefs = model.solve(cum_xtx[origins] - cum_xtx[origins - train_bars],
+                            cum_xty[origins] - cum_xty[origins - train_bars])
+    else:
+        coefs = np.array([model.fit(X[t - train_bars:t], y[t - train_bars:t]) for t in origins])
+    returns = np.diff(log_close)[origins[:, None] - model.lags + np.arange(model.lags)]
+    paths = model.forecast_paths(coefs, log_close[origins], returns,
+                                 None if exog is None else exog[origins], horizon)
+    return paths - log_close[origins[:, None] + 1 + np.arange(horizon)]
+
+
+def run_task(task):
+    '''Fit and forecast, or backtest, one ticker in a worker
+
+    Parameters
+    ----------
+    task : tuple
+        Mode ('forecast' or 'backtest'), ticker, bar timestamps, closes and exogenous
+        columns (None without earnings features)
+
+    Returns
+    -------
+    tuple(str, numpy.ndarray, float)
+        Ticker, forecast closes (or errors of the backtest) and fit seconds
+    '''
+    mode, ticker, ts, close, exog = task
+    model, horizon, train_bars = _worker['model'], _worker['horizon'], _worker['train_bars']
+    t_start = time.perf_counter()
+    log_close = np.log(close)
+    if mode == 'backtest':
+        result = walk_forward(model, log_close, exog, train_bars, horizon, _worker['step'])
+    else:
+        X, y = model.design(log_close[-(train_bars + 1):],
+                            None if exog is None else exog[-(train_bars + 1):])
+        coef = model.fit(X, y)
+        history = slice(len(log_close) - model.lags - 1, None)
+        result = np.exp(model.forecast(coef, log_close[history],
+                                       None if exog is None else exog[history], horizon))
+    return ticker, result, time.perf_counter() - t_start
+
+
+class Forecaster(object):
+    '''
+    A class to forecast prices of all tickers of an index with a per-ticker model
+
+    Tickers are grouped into batches of at most batch_mb of estimated price data,
+    so memory stays bounded for any index size or history. Each batch is loaded
+    with one streamed query, split into per-ticker arrays and distributed over
+    the process pool in chunks. Workers receive the model once, through the pool
+    initializer, and only arrays per ticker, so throughput scales with cores.
+
+    ...
+
+    Attributes
+    ----------
+    st_db : PyDB.DBWrapper.DBWrapper
+        DBWrapper object for interacting with database
+    logger : st_logger.logger
+        object of class st_logger.logger
+    price_type : str
+        type of price, 'intraday' or 'daily'
+    model : models.ForecastModel
+        model fitted per ticker
+    horizon : int
+        bars forecast ahead
+    train_bars : int
+        bars each fit uses
+    n_proc : int
+        worker processes
+    batch_mb : int
+        estimated megabytes of prices loaded per batch
+
+    Methods
+    -------
+    forecast(stock_index)
+        fits the model on the latest bars of every ticker and writes forecasts
+    backtest(stock_index, step=None, start=None)
+        scores walk-forward forecasts over the history of every ticker
+    '''
+
+    def __init__(self, st_db, st_logger, price_type='daily', model=None,
+                 horizon=None, train_bars=None, n_proc=None, batch_mb=FORECAST_BATCH_MB):
+        if price_type not in TS_COLS:
+            raise ValueError('"price_type" must be one of "intraday" or "daily".')
+        self.st_db = st_db
+        self.logger = st_logger
+        self.price_type = price_type
+        self.model = model or MODELS['ar']()
+        self.horizon = horizon or FORECAST_HORIZON[price_type]
+        self.train_bars = train_bars or TRAIN_BARS[price_type]
+        self.n_proc = n_proc or max(cpu_count()-1, 1)
+        self.batch_mb = batch_mb
+
+
+    def _lookback(self):
+        '''Calendar time covering the bars of one fit, with weekends and holidays'''
+        trading_days = int(np.ceil((self.train_bars + self.model.lags + 1) /
+                                   BARS_PER_DAY[self.price_type])) + 1
+        return pd.Timedelta(days=int(np.ceil(trading_days * 7 / 5)) + 5)
+
+
+    def _bar_counts(self, stock_index, start=None):
+        ts_col = TS_COLS[self.price_type]
+        qry = '''
+        SELECT
+            p.ticker, COUNT(*) AS n
+        FROM
+            SMART_TRADING.{price_type}_prices p
+            JOIN SMART_TRADING.ticker_membership m ON p.ticker = m.ticker
+        WHERE
+            m.stock_index = %s AND m.valid_to IS NULL {start_cond}
+        GROUP BY
+            p.ticker
+        '''.format(price_type=self.price_type,
+                   start_cond='AND p.{} >= %s'.format(ts_col) if start is not None else '')
+        params = (stock_index,) if start is None else (stock_index, start.to_pydatetime())
+        counts = self.st_db.executeReadQuery(qry, params)
+        return counts.sort_values('ticker')
+
+
+    def _batches(self, counts):
+        '''Group tickers into batches of at most batch_mb of estimated price data'''
+        batch, batch_bytes = [], 0
+        for ticker, n in zip(counts['ticker'], counts['n']):
+            if batch and batch_bytes + n * FORECAST_BYTES_PER_BAR > self.batch_mb * 1024**2:
+                yield batch
+                batch, batch_bytes = [], 0
+            batch.append(ticker)
+            batch_bytes += n * FORECAST_BYTES_PER_BAR
+        if batch:
+            yield batch
+
+
+    def _load_batch(self, tickers, start=None):
+        '''Closes and last earnings surprise of the tickers, sorted by ticker and ts'''
+        ts_col = TS_COLS[self.price_type]
+        qry = '''
+        SELECT
+            p.ticker, p.{ts_col} AS ts, p.close, f.last_eps_surprise_pct
+        FROM
+            SMART_TRADING.{price_type}_prices p
+            LEFT JOIN SMART_TRADING.price_features f
+                ON f.ticker = p.ticker AND f.ts = p.{ts_col} AND f.price_type = %s
+        WHERE
+            p.ticker IN ({tickers}) {start_cond}
+        '''.format(ts_col=ts_col, price_type=self.price_type,
+                   tickers=', '.join(['%s'] * len(tickers)),
+                   start_cond='AND p.{} >= %s'.format(ts_col) if start is not None else '')
+        params = (self.price_type,) + tuple(tickers)
+        if start is not None:
+            params += (start.to_pydatetime(),)
+        chunks = list(self.st_db.iterReadQuery(qry, params))
+        if not chunks:
+            return pd.DataFrame(columns=['ticker', 'ts', 'close', 'last_eps_surprise_pct'])
+        prices = pd.concat(chunks, ignore_index=True)
+        return prices.sort_values(['ticker', 'ts']).reset_index(drop=True)
+
+
+    def _tasks(self, mode, prices, min_bars):
+        '''Split a batch into per-ticker arrays, skipping tickers with too few bars'''
+        exog = prices[['last_eps_surprise_pct']].to_numpy(dtype=np.float64) / 100
+        ts = prices['ts'].to_numpy()
+        close = prices['close'].to_numpy(dtype=np.float64)
+        bounds = np.flatnonzero(prices['ticker'].to_numpy()[1:] !=
+                                prices['ticker'].to_numpy()[:-1]) + 1
+        for start, end in zip(np.r_[0, bounds], np.r_[bounds, len(prices.index)]):
+            if end - start >= min_bars:
+                yield (mode, prices['ticker'].iat[start], ts[start:end], close[start:end],
+                       exog[start:end])
+
+
+    def _run(self, mode, stock_index, start, min_bars, step=None):
+        '''Run the tasks of every batch through the pool, yielding the results of each batch'''
+        counts = self._bar_counts(stock_index, start)
+        with Pool(self.n_proc, initializer=init_worker,
+                  initargs=(self.model, self.horizon, self.train_bars, step)) as pool:
+            for tickers in self._batches(counts):
+                prices = self._load_batch(tickers, start)
+                tasks = list(self._tasks(mode, prices, min_bars))
+                # A few chunks per worker balance uneven histories with little IPC
+                chunksize = max(1, len(tasks) // (self.n_proc * 4))
+                yield prices, list(pool.imap_unordered(run_task, tasks, chunksize=chunksize))
+
+
+    def forecast(self, stock_index):
+        '''Fit the model on the latest train_bars bars of every ticker and write forecasts
+
+        Forecasts of horizons 1 to horizon are written to the forecasts table, keyed by
+        model and the timestamp of the last bar they are made from, with fit seconds.
+        '''
+        t_start = time.time()
+        start = pd.Timestamp(dt.date.today()) - self._lookback()
+        run_at = dt.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        n_tickers = 0
+        for prices, results in self._run('forecast', stock_index, start,
+                                         self.train_bars + self.model.lags + 1):
+            origin = prices.groupby('ticker', sort=False)['ts'].max()
+            forecasts = pd.DataFrame([
+                {'ticker': ticker, 'price_type': self.price_type, 'model': self.model.name,
+                 'origin_ts': origin[ticker], 'horizon': h + 1, 'forecast_close': path[h],
+                 'fit_sec': fit_sec, 'run_at': run_at}
+                for ticker, path, fit_sec in results for h in range(self.horizon)])
+            if forecasts.shape[0] > 0:
+                self.st_db.executeWriteQuery(forecasts, 'forecasts')
+            n_tickers += len(results)
+        self.logger.info('Forecast {} bars ahead for {} tickers with {} in {} sec.'.format(
+            self.horizon, n_tickers, self.model.name, round(time.time() - t_start, 2)))
+
+
+    def backtest(self, stock_index, step=None, start=None):
+        '''Score walk-forward forecasts over the history of every ticker
+
+        From every step-th bar the model is fitted on the preceding train_bars bars
+        and forecasts horizon bars ahead. Mean absolute and root mean squared errors
+        of log close are written to forecast_backtests per ticker and horizon.
+        '''
+        t_start = time.time()
+        step = step or self.horizon
+        run_at = dt.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        scores = []
+        for prices, results in self._run('backtest', stock_index, start,
+                                         self.train_bars + self.horizon + 1, step):
+            for ticker, errors, fit_sec in results:
+                for h in range(self.horizon):
+                    err = errors[:, h][~np.isnan(errors[:, h])]
+                    scores.append({'ticker': ticker, 'price_type': self.price_type,
+                                   'model': self.model.name, 'horizon': h + 1,
+                                   'n_origins': len(err),
+                                   'mae': float(np.abs(err).mean()) if len(err) else None,
+                                   'rmse': float(np.sqrt((err ** 2).mean())) if len(err) else None,
+                                   'fit_sec': fit_sec, 'run_at': run_at})
+        scores = pd.DataFrame(scores)
+        if scores.shape[0] > 0:
+            self.st_db.executeWriteQuery(scores, 'forecast_backtests')
+            summary = scores.groupby('horizon')['mae'].mean().round(5).to_dict()
+            self.logger.info('Backtested {} tickers with {}, mean MAE by horizon: {}'.format(
+                scores['ticker'].nunique(), self.model.name, summary))
+        self.logger.info('Backtest took {} sec.'.format(round(time.time() - t_start, 2)))
+
+
+if __name__ == '__main__':
+    st_logger = logger('Forecast')
+    args = parse_args()
+    st_db = DBWrapper('SMART_TRADING')
+    model = MODELS[args.model]()
+    forecaster = Forecaster(st_db=st_db, st_logger=st_logger, price_type=args.price_type,
+                            model=model, horizon=args.horizon, train_bars=args.train_bars,
+                            n_proc=args.n_proc)
+    if args.backtest:
+        forecaster.backtest(args.stock_index, step=args.step,
+                            start=pd.Timestamp(args.start_date) if args.start_date else None)
+    else:
+        forecaster.forecast(args.stock_index)
+    st_db.close()
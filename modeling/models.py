@@ -0,0 +1,170 @@
+'''
+Per-ticker forecasting models used by forecast.py. Models are fitted from the Gram matrices
+of their design, so a walk-forward backtest fits every window from running sums.
+'''
+
+import numpy as np
+
+
+class ForecastModel(object):
+    '''
+    Base class of per-ticker models forecasting log close prices
+
+    A model turns the log closes (and optional exogenous columns) of one ticker into
+    a design matrix X and the next-bar log returns y, where row t only uses what is
+    known at the close of bar t. Coefficients are solved from X'X and X'y, and
+    forecasts iterate one bar ahead. Models that cannot be fitted from Gram matrices
+    set `gram = False` and override `fit`, and are refitted per window in backtests.
+
+    ...
+
+    Attributes
+    ----------
+    name : str
+        name of the model, stored with its forecasts
+    lags : int
+        past returns the design of one bar uses
+    ridge : float
+        ridge penalty keeping short or flat windows solvable
+    gram : bool
+        True if the model is fitted from X'X and X'y alone
+
+    Methods
+    -------
+    design(log_close, exog=None)
+        design matrix and next-bar log returns of every bar
+    rows(returns, exog_rows=None)
+        design rows of the next bar of many origins, given their latest returns
+    solve(xtx, xty)
+        coefficients from Gram matrices, or from stacks of them
+    fit(X, y)
+        coefficients from the rows of a window, rows with NaNs are skipped
+    forecast_paths(coefs, last_log_close, returns, exog_rows, horizon)
+        log close paths of the next horizon bars of many origins at once
+    forecast(coef, log_close, exog=None, horizon=1)
+        log close path of the next horizon bars
+    '''
+
+    name = None
+    gram = True
+
+    def __init__(self, lags=0, ridge=1e-6):
+        self.lags = lags
+        self.ridge = ridge
+
+
+    def design(self, log_close, exog=None):
+        raise NotImplementedError
+
+
+    def rows(self, returns, exog_rows=None):
+        raise NotImplementedError
+
+
+    def solve(self, xtx, xty):
+        '''Coefficients of one (k, k) Gram matrix or a stack (m, k, k) of them'''
+        xtx = xtx + self.ridge * np.eye(xtx.shape[-1])
+        return np.linalg.solve(xtx, xty[..., None])[..., 0]
+
+
+    def fit(self, X, y):
+        valid = ~np.isnan(y) & ~np.isnan(X).any(axis=1)
+        X, y = X[valid], y[valid]
+        return self.solve(X.T @ X, X.T @ y)
+
+
+    def forecast_paths(self, coefs, last_log_close, returns, exog_rows, horizon):
+        '''Iterate one bar ahead from many origins at once
+
+        Parameters
+        ----------
+        coefs : numpy.ndarray
+            Coefficients per origin, shaped (m, k)
+        last_log_close : numpy.ndarray
+            Log close at each origin, shaped (m,)
+        returns : numpy.ndarray
+            Latest `lags` log returns per origin, oldest first, shaped (m, lags)
+        exog_rows : numpy.ndarray
+            Exogenous columns at each origin, held over the horizon, None if unused
+        horizon : int
+            Bars to forecast
+
+        Returns
+        -------
+        numpy.ndarray
+            Log close paths, shaped (m, horizon)
+        '''
+        paths = np.empty((len(last_log_close), horizon))
+        level = np.asarray(last_log_close, dtype=np.float64)
+        for h in range(horizon):
+            ret = np.einsum('ij,ij->i', coefs, self.rows(returns, exog_rows))
+            if self.lags:
+                returns = np.column_stack([returns[:, 1:], ret])
+            level = level + ret
+            paths[:, h] = level
+        return paths
+
+
+    def forecast(self, coef, log_close, exog=None, horizon=1):
+        '''Log close path from the last close, exogenous columns held at their last value'''
+        returns = np.diff(log_close[-(self.lags + 1):])[None, :]
+        return self.forecast_paths(coef[None, :], log_close[-1:], returns,
+                                   None if exog is None else exog[-1:], horizon)[0]
+
+
+def _next_returns(log_close):
+    '''Log return from each bar to the next, NaN for the last bar'''
+    return np.append(np.diff(log_close), np.nan)
+
+
+class DriftModel(ForecastModel):
+    '''Random walk with drift: the mean log return of the window, extrapolated'''
+
+    name = 'drift'
+
+    def __init__(self, ridge=1e-6):
+        super(DriftModel, self).__init__(lags=0, ridge=ridge)
+
+
+    def design(self, log_close, exog=None):
+        return np.ones((len(log_close), 1)), _next_returns(log_close)
+
+
+    def rows(self, returns, exog_rows=None):
+        return np.ones((returns.shape[0], 1))
+
+
+class ARModel(ForecastModel):
+    '''
+    Autoregression of log returns on their last `lags` values and an intercept
+
+    With `use_earnings`, the surprise of the last reported earnings (from
+    price_features) is an exogenous column, capturing post-earnings drift.
+    '''
+
+    name = 'ar'
+
+    def __init__(self, lags=5, use_earnings=True, ridge=1e-6):
+        super(ARModel, self).__init__(lags=lags, ridge=ridge)
+        self.use_earnings = use_earnings
+
+
+    def design(self, log_close, exog=None):
+        returns = np.append(np.nan, np.diff(log_close))
+        n = len(log_close)
+        columns = [np.ones(n)]
+        for lag in range(self.lags):
+            columns.append(np.append(np.full(min(lag, n), np.nan), returns[:n - lag]))
+        if self.use_earnings and exog is not None:
+            columns += [np.nan_to_num(exog[:, j]) for j in range(exog.shape[1])]
+        return np.column_stack(columns), _next_returns(log_close)
+
+
+    def rows(self, returns, exog_rows=None):
+        columns = [np.ones((returns.shape[0], 1)), returns[:, ::-1]]
+        if self.use_earnings and exog_rows is not None:
+            columns.append(np.nan_to_num(exog_rows))
+        return np.hstack(columns)
+
+
+MODELS = {'drift': DriftModel, 'ar': ARModel}
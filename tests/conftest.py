@@ -0,0 +1,24 @@
+'''
+Puts the repository and data_extraction on the path and replaces the API clients by the
+offline fakes of the benchmarks, so tests never need credentials or network.
+'''
+
+import os
+import sys
+import types
+
+ST_HOME = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ST_HOME, 'benchmarks'))
+sys.path.insert(0, os.path.join(ST_HOME, 'data_extraction'))
+sys.path.insert(0, ST_HOME)
+
+sys.modules.setdefault('auth', types.ModuleType('auth'))
+import fakes
+yec_module = types.ModuleType('yahoo_earnings_calendar')
+yec_module.YahooEarningsCalendar = fakes.FakeEarningsCalendar
+sys.modules['yahoo_earnings_calendar'] = yec_module
+av_module = types.ModuleType('alpha_vantage')
+av_module.timeseries = types.ModuleType('alpha_vantage.timeseries')
+av_module.timeseries.TimeSeries = fakes.FakeTimeSeries
+sys.modules['alpha_vantage'] = av_module
+sys.modules['alpha_vantage.timeseries'] = av_module.timeseries
@@ -0,0 +1,60 @@
+import os
+import pickle
+
+import fakes
+from av_parser import shared_frame
+from extract_prices import WORKER_FIELDS, Stock, fetch_shared, init_worker
+from partitions import TickerIds
+from rollups import Rollup
+from libs.st_cache.response_cache import ResponseCache
+from libs.st_logger.logger import logger
+from libs.st_logger.metrics import get_metrics
+from libs.st_spool.spool import Spool
+from libs.PriceStore.ParquetStore import ParquetStore
+from libs.PriceStore.PriceStore import PriceStore
+
+
+def make_stock(tmp_path):
+    st_db = fakes.SQLiteDBWrapper(str(tmp_path / 'st.db'))
+    st_logger = logger('Test')
+    price_store = PriceStore()
+    price_store.append('AAPL', [0, 60], open=[1, 2], high=[1, 2], low=[1, 2], close=[1, 2],
+                       volume=[10, 20])
+    return Stock(tickers_list=['AAPL'], stock_index='NASDAQ', price_type='intraday',
+                 ts=fakes.FakeTimeSeries(), after_hours=True, start_date='2024-01-02',
+                 write_csv=True, write_db=True, st_db=st_db, st_logger=st_logger,
+                 load_infile=True, diff_upsert=True, incremental=True,
+                 cache=ResponseCache(str(tmp_path / 'cache')),
+                 parquet_store=ParquetStore(str(tmp_path / 'parquet')),
+                 price_store=price_store, rollup=Rollup(st_db, st_logger),
+                 metrics=get_metrics('Test'), spool=Spool(str(tmp_path / 'spool')),
+                 ticker_ids=TickerIds(st_db))
+
+
+def test_stock_with_every_option_pickles(tmp_path):
+    stock = pickle.loads(pickle.dumps(make_stock(tmp_path)))
+    assert stock.price_type == 'intraday'
+    assert not hasattr(stock, 'price_store')
+
+
+def test_price_store_pickles():
+    store = PriceStore()
+    store.append('AAPL', [0, 60], open=[1, 2], high=[1, 2], low=[1, 2], close=[1, 2],
+                 volume=[10, 20])
+    restored = pickle.loads(pickle.dumps(store))
+    assert list(restored.slice('AAPL').close) == [1, 2]
+    restored.append('AAPL', [120], open=[3], high=[3], low=[3], close=[3], volume=[30])
+    assert len(restored.slice('AAPL').ts) == 3
+
+
+def test_workers_get_only_worker_fields(tmp_path):
+    stock = make_stock(tmp_path)
+    stock.incremental = False
+    stock._check_start_date_format()
+    worker = pickle.loads(pickle.dumps(stock._for_worker()))
+    assert sorted(vars(worker)) == sorted(WORKER_FIELDS)
+    init_worker({'intraday': worker})
+    shared = fetch_shared(stock._task('AAPL'))
+    with shared_frame('AAPL', shared) as ticker_prices:
+        assert len(ticker_prices.index) == shared.n > 0
+        assert (ticker_prices.index.get_level_values(1) >= stock.start_date).all()
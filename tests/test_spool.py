@@ -0,0 +1,21 @@
+import os
+
+import pandas as pd
+
+from libs.st_spool.spool import MANIFEST_FILE, Spool
+
+
+def test_compact_keeps_only_pending_segments_and_kept_runs(tmp_path):
+    spool = Spool(str(tmp_path))
+    frame = pd.DataFrame({'close': [1.0]}, index=pd.Index(['AAPL'], name='ticker'))
+    written = spool.put('run1', 'AAPL', frame)
+    pending = spool.put('run1', 'MSFT', frame)
+    spool.put('run2', 'GOOG', frame.iloc[:0])
+    spool.mark_written([written])
+
+    spool.compact(keep_runs=('run2',))
+
+    assert [r['segment'] for r in spool.pending_segments()] == [pending]
+    assert spool.completed_tickers('run2') == {'GOOG'}
+    with open(os.path.join(str(tmp_path), MANIFEST_FILE)) as f:
+        assert len(f.readlines()) == 2